@@ -11,9 +11,39 @@ Find your LAMINI_API_KEY at https://app.lamini.ai/account"""
 
 # When inference call failed, how much retry should we perform.
 retry_limit = int(os.environ.get("LAMINI_RETRY_LIMIT", 3))
+# Backoff in seconds before a failed inference batch is retried, doubled on
+# every further retry of the same prompts and capped at retry_max_delay.
+retry_base_delay = float(os.environ.get("LAMINI_RETRY_BASE_DELAY", 0.5))
+retry_max_delay = float(os.environ.get("LAMINI_RETRY_MAX_DELAY", 30))
 
 max_workers = int(os.environ.get("LAMINI_MAX_WORKERS", 4))
 batch_size = int(os.environ.get("LAMINI_BATCH_SIZE", 5))
+# Prompts per request when Embedding.generate splits a long list of prompts.
+embedding_batch_size = int(os.environ.get("LAMINI_EMBEDDING_BATCH_SIZE", 128))
+# Directory of a persistent embedding cache, disabled if unset, and the number
+# of embeddings kept per model, unbounded if unset.
+embedding_cache_path = os.environ.get("LAMINI_EMBEDDING_CACHE_PATH", None)
+embedding_cache_max_rows = os.environ.get("LAMINI_EMBEDDING_CACHE_MAX_ROWS", None)
+embedding_cache_max_rows = (
+    int(embedding_cache_max_rows) if embedding_cache_max_rows else None
+)
+# Longest time in seconds a pipeline batch waits to fill up before it is sent
+# partially full. By default batches wait until they are full.
+batch_max_wait = os.environ.get("LAMINI_BATCH_MAX_WAIT", None)
+batch_max_wait = float(batch_max_wait) if batch_max_wait else None
+# Polling interval in seconds for the result of a batch job, starting at the
+# min and backing off up to the max while the job is running.
+batch_poll_min_interval = float(os.environ.get("LAMINI_BATCH_POLL_MIN_INTERVAL", 0.5))
+batch_poll_max_interval = float(os.environ.get("LAMINI_BATCH_POLL_MAX_INTERVAL", 10))
+# Seconds after which a poll of a batch job counts as failed.
+batch_poll_timeout = float(os.environ.get("LAMINI_BATCH_POLL_TIMEOUT", 30))
+# SQLite file recording submitted batch and streaming jobs, so that they are
+# reattached to instead of resubmitted after a restart. Disabled if unset.
+job_registry_path = os.environ.get("LAMINI_JOB_REGISTRY_PATH", None)
+# OpenMP threads FAISS uses to search and train indexes, all cores if unset.
+# Lower it so that index searches leave cores to the asyncio pipeline.
+faiss_num_threads = os.environ.get("LAMINI_FAISS_NUM_THREADS", None)
+faiss_num_threads = int(faiss_num_threads) if faiss_num_threads else None
 static_batching = bool(os.environ.get("LAMINI_STATIC_BATCHING", False))
 bypass_reservation = bool(os.environ.get("LAMINI_BYPASS_RESERVATION", False))
 gate_pipeline_batch_completions = bool(
@@ -33,6 +63,7 @@ from lamini.api.model_downloader import DownloadedModel
 from lamini.classify.lamini_classifier import LaminiClassifier
 from lamini.generation.generation_node import GenerationNode
 from lamini.generation.generation_pipeline import GenerationPipeline
+from lamini.generation.pipeline_profiler import PipelineProfiler
 from lamini.generation.base_prompt_object import PromptObject
 from lamini.generation.split_response_node import SplitResponseNode
 from lamini.api.streaming_completion import StreamingCompletion
@@ -1,9 +1,26 @@
-from typing import List, Union
+import asyncio
+import logging
+import random
+from typing import List, Optional, Union
 
+import aiohttp
 import lamini
 import numpy as np
 from lamini.api.lamini_config import get_config, get_configured_key, get_configured_url
-from lamini.api.rest_requests import make_web_request
+from lamini.api.rest_requests import make_async_web_request
+from lamini.api.synchronize import client_session, sync
+from lamini.api.utils.embedding_cache import EmbeddingCache, get_embedding_cache
+from lamini.error.error import (
+    APIUnprocessableContentError,
+    AuthenticationError,
+    UserError,
+)
+from tqdm import tqdm
+
+logger = logging.getLogger(__name__)
+
+# Errors retrying a chunk won't fix
+NON_RETRYABLE_ERRORS = (AuthenticationError, UserError, APIUnprocessableContentError)
 
 
 class Embedding:
@@ -26,6 +43,10 @@ class Embedding:
             i.e. localhost, staging.lamini.ai, or api.lamini.ai
             Additionally, LLAMA_ENVIRONMENT can be set as an environment variable
             that will be grabbed for the url before any of the above defaults
+
+    cache: Optional[EmbeddingCache] = None
+        Cache consulted before requesting embeddings, defaults to the one at
+        lamini.embedding_cache_path, if set
     """
 
     def __init__(
@@ -33,35 +54,213 @@ class Embedding:
         model_name: str = None,
         api_key: str = None,
         api_url: str = None,
+        cache: Optional[EmbeddingCache] = None,
     ):
         self.config = get_config()
         self.api_key = api_key or lamini.api_key or get_configured_key(self.config)
         self.api_url = api_url or lamini.api_url or get_configured_url(self.config)
         self.api_prefix = self.api_url + "/v1/"
         self.model_name = model_name
+        self.cache = cache or get_embedding_cache()
 
-    def generate(self, prompt: Union[str, List[str]]) -> List[np.ndarray]:
+    def generate(
+        self,
+        prompt: Union[str, List[str]],
+        batch_size: Optional[int] = None,
+        max_concurrency: Optional[int] = None,
+        show_progress: bool = False,
+    ) -> np.ndarray:
         """Request to Lamini platform for an embedding encoding of the provided
         prompt
 
+        Failed requests are retried, see async_generate. Lists longer than
+        batch_size are split into chunks, which are sent concurrently. Only
+        prompts missing from the cache, if any, are requested.
+
+        Parameters
+        ----------
+        prompt: Union[str, List[str]]
+            Prompt to encoding into an embedding
+
+        batch_size: Optional[int] = None
+            Prompts per request, defaults to lamini.embedding_batch_size
+
+        max_concurrency: Optional[int] = None
+            Requests in flight at a time, defaults to lamini.max_workers
+
+        show_progress: bool = False
+            Show a progress bar of the embedded prompts
+
+        Returns
+        -------
+        np.ndarray
+            Contiguous float32 matrix of shape (n, d) with one row per prompt,
+            n is 1 for a single prompt
+        """
+
+        if self.cache is not None:
+            return self.cache.get_embeddings(
+                self.model_name,
+                [prompt] if isinstance(prompt, str) else list(prompt),
+                lambda missing: self.generate_uncached(
+                    missing, batch_size, max_concurrency, show_progress
+                ),
+            )
+        return self.generate_uncached(
+            prompt, batch_size, max_concurrency, show_progress
+        )
+
+    def generate_uncached(
+        self,
+        prompt: Union[str, List[str]],
+        batch_size: Optional[int] = None,
+        max_concurrency: Optional[int] = None,
+        show_progress: bool = False,
+    ) -> np.ndarray:
+        return sync(
+            self.async_generate_uncached(
+                prompt, batch_size, max_concurrency, show_progress
+            )
+        )
+
+    async def async_generate(
+        self,
+        prompt: Union[str, List[str]],
+        batch_size: Optional[int] = None,
+        max_concurrency: Optional[int] = None,
+        show_progress: bool = False,
+    ) -> np.ndarray:
+        """Asynchronous version of generate
+
+        The prompts are split into chunks of batch_size, up to max_concurrency
+        of which are requested at a time over one session. A failed chunk is
+        retried up to lamini.retry_limit times with exponential backoff. The
+        embeddings are written into a single matrix in prompt order.
 
         Parameters
         ----------
         prompt: Union[str, List[str]]
             Prompt to encoding into an embedding
 
+        batch_size: Optional[int] = None
+            Prompts per request, defaults to lamini.embedding_batch_size
+
+        max_concurrency: Optional[int] = None
+            Requests in flight at a time, defaults to lamini.max_workers
+
+        show_progress: bool = False
+            Show a progress bar of the embedded prompts
+
         Returns
         -------
-        List[np.ndarray]
-            Formatted returned embedding from the Lamini platform
+        np.ndarray
+            Contiguous float32 matrix of shape (n, d) with one row per prompt
         """
 
-        params = {"prompt": prompt, "model_name": self.model_name}
-        resp = make_web_request(
-            self.api_key, self.api_prefix + "embedding", "post", params
+        if self.cache is not None:
+
+            async def compute(missing: List[str]) -> np.ndarray:
+                return await self.async_generate_uncached(
+                    missing, batch_size, max_concurrency, show_progress
+                )
+
+            return await self.cache.async_get_embeddings(
+                self.model_name,
+                [prompt] if isinstance(prompt, str) else list(prompt),
+                compute,
+            )
+        return await self.async_generate_uncached(
+            prompt, batch_size, max_concurrency, show_progress
         )
-        embeddings = resp["embedding"]
 
+    async def async_generate_uncached(
+        self,
+        prompt: Union[str, List[str]],
+        batch_size: Optional[int] = None,
+        max_concurrency: Optional[int] = None,
+        show_progress: bool = False,
+    ) -> np.ndarray:
         if isinstance(prompt, str):
-            return np.reshape(embeddings, (1, -1))
-        return [np.reshape(embedding, (1, -1)) for embedding in embeddings]
+            async with client_session() as client:
+                return await self.request_chunk(client, prompt)
+        prompts = list(prompt)
+        batch_size = self.get_batch_size(batch_size)
+        max_concurrency = max_concurrency or int(lamini.max_workers)
+        semaphore = asyncio.Semaphore(max_concurrency)
+        # Allocated once the dimension is known from the first chunk
+        embeddings: Optional[np.ndarray] = None
+        progress = tqdm(
+            total=len(prompts),
+            desc="Embedding",
+            unit=" prompts",
+            disable=not show_progress,
+        )
+
+        async def embed_chunk(client: aiohttp.ClientSession, start: int):
+            nonlocal embeddings
+            chunk = prompts[start : start + batch_size]
+            async with semaphore:
+                chunk_embeddings = await self.request_chunk(client, chunk)
+            if embeddings is None:
+                embeddings = np.empty(
+                    (len(prompts), chunk_embeddings.shape[1]), dtype=np.float32
+                )
+            embeddings[start : start + len(chunk)] = chunk_embeddings
+            progress.update(len(chunk))
+
+        try:
+            # The semaphore bounds the requests on the shared session
+            async with client_session() as client:
+                tasks = [
+                    asyncio.create_task(embed_chunk(client, start))
+                    for start in range(0, len(prompts), batch_size)
+                ]
+                try:
+                    await asyncio.gather(*tasks)
+                finally:
+                    for task in tasks:
+                        task.cancel()
+        finally:
+            progress.close()
+        if embeddings is None:
+            return np.empty((0, 0), dtype=np.float32)
+        return embeddings
+
+    async def request_chunk(
+        self, client: aiohttp.ClientSession, chunk: Union[str, List[str]]
+    ) -> np.ndarray:
+        """Request the embeddings of chunk, retrying failures up to
+        lamini.retry_limit times with exponential backoff"""
+        params = {"prompt": chunk, "model_name": self.model_name}
+        retry_limit = int(lamini.retry_limit)
+        attempt = 0
+        while True:
+            try:
+                resp = await make_async_web_request(
+                    client, self.api_key, self.api_prefix + "embedding", "post", params
+                )
+                return self.to_matrix(resp["embedding"], chunk)
+            except NON_RETRYABLE_ERRORS:
+                raise
+            except Exception as e:
+                attempt += 1
+                if attempt > retry_limit:
+                    raise e
+                delay = min(
+                    float(lamini.retry_max_delay),
+                    float(lamini.retry_base_delay) * 2 ** (attempt - 1),
+                )
+                delay *= random.uniform(0.5, 1.0)
+                n = 1 if isinstance(chunk, str) else len(chunk)
+                logger.warning(
+                    f"Embedding {n} prompts failed, retry {attempt} in {delay:.2f}s: {e}"
+                )
+                await asyncio.sleep(delay)
+
+    def get_batch_size(self, batch_size: Optional[int] = None) -> int:
+        return int(batch_size or lamini.embedding_batch_size)
+
+    @staticmethod
+    def to_matrix(embeddings: list, prompt: Union[str, List[str]]) -> np.ndarray:
+        n = 1 if isinstance(prompt, str) else len(prompt)
+        return np.asarray(embeddings, dtype=np.float32).reshape(n, -1)
@@ -1,9 +1,10 @@
-import asyncio
 from typing import Any, Dict
 
 from lamini.api.rest_requests import make_async_web_request
 from lamini.api.utils.batch_completions import BatchCompletions
 from lamini.api.utils.batch_embeddings import BatchEmbeddings
+from lamini.api.utils.batch_poller import get_batch_poller
+from lamini.api.utils.job_registry import async_finish_job
 
 
 class PipelineClient:
@@ -28,12 +29,19 @@ class PipelineClient:
             model_name=json["model_name"],
             output_type=json["output_type"],
             max_new_tokens=json["max_new_tokens"],
+            client=client,
         )
-        while True:
-            await asyncio.sleep(5)
-            result = await batch_api.async_check_result(submit_response["id"])
-            if result and all(result["finish_reason"]):
-                break
+        try:
+            result = await get_batch_poller().wait(
+                submit_response["id"],
+                batch_api.async_check_result,
+                lambda result: all(result["finish_reason"]),
+            )
+        except Exception:
+            # Given up on, a retry submits the request again. An interrupted
+            # run keeps the job, to reattach to it after a restart.
+            await async_finish_job(submit_response["id"])
+            raise
         return result
 
     async def batch_embeddings(
@@ -43,12 +51,16 @@ class PipelineClient:
     ) -> Dict[str, Any]:
         batch_api = BatchEmbeddings()
         submit_response = await batch_api.async_submit(
-            prompt=json["prompt"], model_name=json["model_name"]
+            prompt=json["prompt"], model_name=json["model_name"], client=client
         )
-        while True:
-            await asyncio.sleep(1)
-            result = await batch_api.async_check_result(submit_response["id"])
-            if result:
-                break
+        try:
+            result = await get_batch_poller().wait(
+                submit_response["id"], batch_api.async_check_result, bool
+            )
+        except Exception:
+            # Given up on, a retry submits the request again. An interrupted
+            # run keeps the job, to reattach to it after a restart.
+            await async_finish_job(submit_response["id"])
+            raise
         result = result["embedding"]
         return result
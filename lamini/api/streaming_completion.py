@@ -1,11 +1,85 @@
 import asyncio
+import contextlib
+import logging
 import time
-from typing import Any, Dict, List, Optional, Union
+from typing import Any, AsyncIterator, Dict, Iterator, List, Optional, Union
 
-import aiohttp
 import lamini
 from lamini.api.lamini_config import get_config, get_configured_key, get_configured_url
 from lamini.api.rest_requests import make_async_web_request, make_web_request
+from lamini.api.synchronize import client_session
+from lamini.api.utils.event_stream import async_stream_results, stream_results
+from lamini.api.utils.job_registry import (
+    async_find_job,
+    async_finish_job,
+    async_record_job,
+    finish_job,
+    find_job,
+    record_job,
+)
+
+logger = logging.getLogger(__name__)
+
+TRANSPORTS = ("auto", "push", "poll")
+
+
+def check_transport(transport: str) -> str:
+    if transport not in TRANSPORTS:
+        raise ValueError(f"transport must be one of {TRANSPORTS}, got {transport}")
+    return transport
+
+
+class StreamCursor:
+    """Tracks how much of every output an incremental stream has returned
+
+    The offsets are sent to the server, which may then only return the text
+    following them. Such a response lists the offset its outputs start at in
+    "offsets". Otherwise the outputs are taken to be cumulative. Results that
+    were already seen, e.g. returned again after an error, yield no delta.
+    """
+
+    def __init__(self):
+        self.offsets: Optional[List[int]] = None
+        self.finish_reason: Optional[List[Optional[str]]] = None
+
+    def url(self, url: str) -> str:
+        if self.offsets is None:
+            return url
+        return url + "?offsets=" + ",".join(str(offset) for offset in self.offsets)
+
+    def advance(self, result: Optional[Dict[str, Any]]) -> Optional[Dict[str, Any]]:
+        """Return the text of result following the offsets and move them past
+        it, or None if result has nothing new"""
+
+        if not result:
+            return None
+        outputs = [output or "" for output in result["outputs"]]
+        starts = result.get("offsets") or [0] * len(outputs)
+        if self.offsets is None:
+            self.offsets = [0] * len(outputs)
+        deltas = []
+        for i, (output, start) in enumerate(zip(outputs, starts)):
+            end = start + len(output)
+            if start > self.offsets[i]:
+                # The server skipped text we never received, resync to its
+                # offset rather than slicing from a negative index.
+                logger.warning(
+                    f"Output {i} resumed at offset {start}, after {self.offsets[i]}"
+                )
+                self.offsets[i] = start
+            deltas.append(
+                output[self.offsets[i] - start :] if end > self.offsets[i] else ""
+            )
+            self.offsets[i] = max(self.offsets[i], end)
+        finish_reason = list(result["finish_reason"])
+        if not any(deltas) and finish_reason == self.finish_reason:
+            return None
+        self.finish_reason = finish_reason
+        return {
+            "outputs": deltas,
+            "finish_reason": finish_reason,
+            "offsets": list(self.offsets),
+        }
 
 
 class StreamingCompletionObject:
@@ -30,6 +104,16 @@ class StreamingCompletionObject:
 
     max_errors: int = 0
         Number of errors before raising an exception
+
+    transport: str = "poll"
+        "poll" fetches the result every polling_interval. "push" receives
+        results from the server as they are generated, as server-sent events
+        or chunked JSON lines. "auto" uses push and falls back to polling if
+        the server doesn't support it.
+
+    incremental: bool = False
+        Return only the text generated since the previous result, instead of
+        the full outputs so far, see StreamCursor
     """
 
     def __init__(
@@ -39,16 +123,23 @@ class StreamingCompletionObject:
         id: str,
         polling_interval: int,
         max_errors: int = 0,
+        transport: str = "poll",
+        incremental: bool = False,
     ):
+        self.id = id
         self.api_url = api_url + f"/{id}/result"
+        self.stream_url = api_url + f"/{id}/stream"
         self.api_key = api_key
         self.done_streaming = False
         self.polling_interval = polling_interval
         self.current_result = None
         self.error_count = 0
         self.max_errors = max_errors
+        self.transport = check_transport(transport)
+        self.stream = None
+        self.cursor = StreamCursor() if incremental else None
 
-    def __iter__(self) -> object:
+    def __iter__(self) -> Iterator[Dict[str, Any]]:
         """Iteration definition
 
         Parameters
@@ -57,11 +148,25 @@ class StreamingCompletionObject:
 
         Returns
         -------
-        Reference to self
+        Iterator over the streamed results, which closes the push connection
+        when the iteration ends or is abandoned
         """
 
+        try:
+            while True:
+                try:
+                    yield self.next()
+                except StopIteration:
+                    return
+        finally:
+            self.close()
+
+    def __enter__(self) -> "StreamingCompletionObject":
         return self
 
+    def __exit__(self, *exc) -> None:
+        self.close()
+
     def __next__(self) -> str:
         """Iterator next step definition
 
@@ -87,16 +192,29 @@ class StreamingCompletionObject:
         Returns
         -------
         self.current_result: str
-            Streamed result from the web request
+            Streamed result from the web request, or in incremental mode the
+            text generated since the previous result
         """
 
+        if self.cursor is None:
+            return self.next_result()
+        while True:
+            delta = self.cursor.advance(self.next_result())
+            if delta is not None:
+                return delta
+
+    def next_result(self) -> Optional[Dict[str, Any]]:
         if self.done_streaming:
             raise StopIteration()
+        if self.transport != "poll":
+            result = self.next_pushed()
+            if result is not None:
+                return result
         time.sleep(self.polling_interval)
         try:
             resp = make_web_request(
                 self.api_key,
-                self.api_url,
+                self.poll_url(),
                 "get",
             )
             if len(resp) == 0:
@@ -105,13 +223,55 @@ class StreamingCompletionObject:
 
             if all(r is not None for r in resp["finish_reason"]):
                 self.done_streaming = True
+                finish_job(self.id)
             self.current_result = resp
         except Exception as e:
             self.error_count += 1
             if self.error_count > self.max_errors:
+                # Given up on, a retry submits the request again.
+                finish_job(self.id)
                 raise e
         return self.current_result
 
+    def next_pushed(self) -> Optional[Dict[str, Any]]:
+        """Wait for the next result pushed by the server. Returns None after
+        falling back to polling."""
+
+        try:
+            if self.stream is None:
+                self.stream = stream_results(self.api_key, self.push_url())
+            resp = next(self.stream, None)
+            if resp is not None:
+                if all(r is not None for r in resp["finish_reason"]):
+                    self.done_streaming = True
+                    finish_job(self.id)
+                    self.close()
+                self.current_result = resp
+                return self.current_result
+            reason = "the stream ended before the result was complete"
+        except Exception as e:
+            if self.transport == "push":
+                raise e
+            reason = e
+        logger.info(f"Falling back to polling {self.api_url}: {reason}")
+        self.close()
+        self.transport = "poll"
+        return None
+
+    def poll_url(self) -> str:
+        return self.api_url if self.cursor is None else self.cursor.url(self.api_url)
+
+    def push_url(self) -> str:
+        if self.cursor is None:
+            return self.stream_url
+        return self.cursor.url(self.stream_url)
+
+    def close(self) -> None:
+        """Close the connection of the push transport, if open"""
+        if self.stream is not None:
+            self.stream.close()
+            self.stream = None
+
 
 class AsyncStreamingCompletionObject:
     """Handler for asynchronous streaming API endpoint on the Lamini Platform
@@ -135,6 +295,16 @@ class AsyncStreamingCompletionObject:
 
     max_errors: int = 5
         Number of errors before raising an exception
+
+    transport: str = "poll"
+        "poll" fetches the result every polling_interval. "push" receives
+        results from the server as they are generated, as server-sent events
+        or chunked JSON lines. "auto" uses push and falls back to polling if
+        the server doesn't support it.
+
+    incremental: bool = False
+        Return only the text generated since the previous result, instead of
+        the full outputs so far, see StreamCursor
     """
 
     def __init__(
@@ -144,16 +314,25 @@ class AsyncStreamingCompletionObject:
         id: str,
         polling_interval: int,
         max_errors: int = 5,
+        transport: str = "poll",
+        incremental: bool = False,
     ):
+        self.id = id
         self.api_url = api_url + f"/{id}/result"
+        self.stream_url = api_url + f"/{id}/stream"
         self.api_key = api_key
         self.done_streaming = False
         self.polling_interval = polling_interval
         self.current_result = None
         self.error_count = 0
         self.max_errors = max_errors
+        self.transport = check_transport(transport)
+        self.stream = None
+        self.cursor = StreamCursor() if incremental else None
+        # Holds the session of the push transport
+        self.session = contextlib.AsyncExitStack()
 
-    def __aiter__(self) -> object:
+    async def __aiter__(self) -> AsyncIterator[Dict[str, Any]]:
         """Asychronous iteration definition
 
         Parameters
@@ -162,11 +341,25 @@ class AsyncStreamingCompletionObject:
 
         Returns
         -------
-        Reference to this instance of AsyncStreamingCompletionObject
+        Async iterator over the streamed results, which closes the push
+        connection and its session when the iteration ends or is abandoned
         """
 
+        try:
+            while True:
+                try:
+                    yield await self.next()
+                except StopAsyncIteration:
+                    return
+        finally:
+            await self.aclose()
+
+    async def __aenter__(self) -> "AsyncStreamingCompletionObject":
         return self
 
+    async def __aexit__(self, *exc) -> None:
+        await self.aclose()
+
     async def __anext__(self):
         """Asynchronous next definition
 
@@ -192,18 +385,31 @@ class AsyncStreamingCompletionObject:
         Returns
         -------
         self.current_result: str
-            Streamed result from the web request
+            Streamed result from the web request, or in incremental mode the
+            text generated since the previous result
         """
 
+        if self.cursor is None:
+            return await self.next_result()
+        while True:
+            delta = self.cursor.advance(await self.next_result())
+            if delta is not None:
+                return delta
+
+    async def next_result(self) -> Optional[Dict[str, Any]]:
         if self.done_streaming:
             raise StopAsyncIteration()
+        if self.transport != "poll":
+            result = await self.next_pushed()
+            if result is not None:
+                return result
         await asyncio.sleep(self.polling_interval)
         try:
-            async with aiohttp.ClientSession() as client:
+            async with client_session() as client:
                 resp = await make_async_web_request(
                     client,
                     self.api_key,
-                    self.api_url,
+                    self.poll_url(),
                     "get",
                 )
             if len(resp) == 0:
@@ -211,13 +417,63 @@ class AsyncStreamingCompletionObject:
                 return self.current_result
             if all(r is not None for r in resp["finish_reason"]):
                 self.done_streaming = True
+                await async_finish_job(self.id)
             self.current_result = resp
         except Exception as e:
             self.error_count += 1
             if self.error_count > self.max_errors:
+                # Given up on, a retry submits the request again.
+                await async_finish_job(self.id)
                 raise e
         return self.current_result
 
+    async def next_pushed(self) -> Optional[Dict[str, Any]]:
+        """Wait for the next result pushed by the server. Returns None after
+        falling back to polling."""
+
+        try:
+            if self.stream is None:
+                client = await self.session.enter_async_context(client_session())
+                self.stream = async_stream_results(
+                    client, self.api_key, self.push_url()
+                )
+            try:
+                resp = await self.stream.__anext__()
+            except StopAsyncIteration:
+                resp = None
+            if resp is not None:
+                if all(r is not None for r in resp["finish_reason"]):
+                    self.done_streaming = True
+                    await async_finish_job(self.id)
+                    await self.aclose()
+                self.current_result = resp
+                return self.current_result
+            reason = "the stream ended before the result was complete"
+        except Exception as e:
+            if self.transport == "push":
+                await self.aclose()
+                raise e
+            reason = e
+        logger.info(f"Falling back to polling {self.api_url}: {reason}")
+        await self.aclose()
+        self.transport = "poll"
+        return None
+
+    def poll_url(self) -> str:
+        return self.api_url if self.cursor is None else self.cursor.url(self.api_url)
+
+    def push_url(self) -> str:
+        if self.cursor is None:
+            return self.stream_url
+        return self.cursor.url(self.stream_url)
+
+    async def aclose(self) -> None:
+        """Close the connection of the push transport, if open"""
+        if self.stream is not None:
+            await self.stream.aclose()
+            self.stream = None
+        await self.session.aclose()
+
 
 class StreamingCompletion:
     """Handler for streaming completions API endpoint on the Lamini Platform
@@ -281,9 +537,15 @@ class StreamingCompletion:
             model_name=model_name,
             max_new_tokens=max_new_tokens,
         )
+        resp = find_job(
+            "streaming_completions", self.api_url, req_data, self.check_result
+        )
+        if resp is not None:
+            return resp
         resp = make_web_request(
             self.api_key, self.streaming_completions_url, "post", req_data
         )
+        record_job("streaming_completions", self.api_url, req_data, resp)
         return resp
 
     async def async_submit(
@@ -319,18 +581,42 @@ class StreamingCompletion:
             model_name=model_name,
             max_new_tokens=max_new_tokens,
         )
-        async with aiohttp.ClientSession() as client:
+        resp = await async_find_job(
+            "streaming_completions", self.api_url, req_data, self.async_check_result
+        )
+        if resp is not None:
+            return resp
+        async with client_session() as client:
             resp = await make_async_web_request(
                 client, self.api_key, self.streaming_completions_url, "post", req_data
             )
+        await async_record_job("streaming_completions", self.api_url, req_data, resp)
         return resp
 
+    def check_result(self, id: str) -> Dict[str, Any]:
+        """Check for the current result of a streaming completion."""
+        return make_web_request(
+            self.api_key, self.streaming_completions_url + f"/{id}/result", "get"
+        )
+
+    async def async_check_result(self, id: str) -> Dict[str, Any]:
+        """Check for the current result of a streaming completion."""
+        async with client_session() as client:
+            return await make_async_web_request(
+                client,
+                self.api_key,
+                self.streaming_completions_url + f"/{id}/result",
+                "get",
+            )
+
     def create(
         self,
         prompt: Union[str, List[str]],
         model_name: str,
         max_new_tokens: Optional[int] = None,
         polling_interval: Optional[float] = 1,
+        transport: str = "poll",
+        incremental: bool = False,
     ) -> object:
         """Instantiate a new StreamingCompletionObject
 
@@ -348,6 +634,12 @@ class StreamingCompletion:
         polling_interval: Optional[float] = 1
             Interval to wait before polling again
 
+        transport: str = "poll"
+            "poll", "push" or "auto", see StreamingCompletionObject
+
+        incremental: bool = False
+            Return only the text generated since the previous result
+
         Returns
         -------
         StreamingCompletionObject
@@ -362,6 +654,8 @@ class StreamingCompletion:
             api_url=self.streaming_completions_url,
             id=req_data["id"],
             polling_interval=polling_interval,
+            transport=transport,
+            incremental=incremental,
         )
 
     async def async_create(
@@ -370,6 +664,8 @@ class StreamingCompletion:
         model_name: str,
         max_new_tokens: Optional[int] = None,
         polling_interval: Optional[float] = 1,
+        transport: str = "poll",
+        incremental: bool = False,
     ) -> object:
         """Instantiate a new AsyncStreamingCompletionObject
 
@@ -387,6 +683,12 @@ class StreamingCompletion:
         polling_interval: Optional[float] = 1
             Interval to wait before polling again
 
+        transport: str = "poll"
+            "poll", "push" or "auto", see StreamingCompletionObject
+
+        incremental: bool = False
+            Return only the text generated since the previous result
+
         Returns
         -------
         AsyncStreamingCompletionObject
@@ -401,6 +703,8 @@ class StreamingCompletion:
             api_url=self.streaming_completions_url,
             polling_interval=polling_interval,
             id=req_data["id"],
+            transport=transport,
+            incremental=incremental,
         )
 
     def make_llm_req_map(
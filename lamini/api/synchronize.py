@@ -1,11 +1,166 @@
-from typing import Any
+from typing import Any, AsyncIterable, Iterator, Optional
 import asyncio
+import atexit
+import functools
+import logging
+import os
+import threading
 from threading import Thread, current_thread
 
+import aiohttp
+
+logger = logging.getLogger(__name__)
+
+
+class BackgroundLoop:
+    """Event loop running in a daemon thread for the lifetime of the process
+
+    Synchronous facades submit their coroutines to this loop instead of
+    starting a new loop, and a new thread, for every call. Sessions and queues
+    created by those coroutines stay bound to the one loop, so they can be
+    reused across calls, e.g. the loop's shared session, see client_session().
+    """
+
+    def __init__(self):
+        self.pid = os.getpid()
+        self.loop = asyncio.new_event_loop()
+        self.sessions = []
+        self.session = None
+        self.thread = Thread(
+            target=self.run_forever, name="lamini-background-loop", daemon=True
+        )
+        self.thread.start()
+
+    def run_forever(self) -> None:
+        asyncio.set_event_loop(self.loop)
+        self.loop.run_forever()
+
+    def is_running(self) -> bool:
+        return self.pid == os.getpid() and self.thread.is_alive()
+
+    def in_loop_thread(self) -> bool:
+        return current_thread() is self.thread
+
+    def submit(self, awaitable):
+        """Schedule awaitable on the loop, returning a concurrent.futures.Future"""
+        return asyncio.run_coroutine_threadsafe(await_any(awaitable), self.loop)
+
+    def run(self, awaitable) -> Any:
+        """Block until awaitable finished on the loop and return its result"""
+        return self.submit(awaitable).result()
+
+    def register_session(self, session) -> None:
+        """Close an aiohttp session bound to the loop when the loop shuts down"""
+        self.sessions.append(session)
+
+    def get_session(self) -> aiohttp.ClientSession:
+        """The aiohttp session shared by the requests running on the loop,
+        created on first use. Must be called on the loop."""
+        if self.session is None or self.session.closed:
+            self.session = aiohttp.ClientSession()
+            self.register_session(self.session)
+        return self.session
+
+    async def close_sessions(self) -> None:
+        for session in self.sessions:
+            if not session.closed:
+                await session.close()
+        self.sessions = []
+
+    def shutdown(self) -> None:
+        if not self.is_running():
+            return
+        try:
+            self.run(self.close_sessions())
+        finally:
+            self.loop.call_soon_threadsafe(self.loop.stop)
+            self.thread.join()
+
+
+background_loop: Optional[BackgroundLoop] = None
+background_loop_lock = threading.Lock()
+
+
+def get_background_loop() -> BackgroundLoop:
+    """Return the process wide BackgroundLoop, starting it if needed"""
+    global background_loop
+    with background_loop_lock:
+        # A forked child process inherits the object, but not the thread.
+        if background_loop is None or not background_loop.is_running():
+            background_loop = BackgroundLoop()
+            atexit.register(background_loop.shutdown)
+        return background_loop
+
+
+def in_background_loop() -> bool:
+    """Whether the caller runs on the BackgroundLoop"""
+    return background_loop is not None and background_loop.in_loop_thread()
+
+
+async def await_any(awaitable) -> Any:
+    return await awaitable
+
+
+class ClientSessionContext:
+    """Async context manager returned by client_session(). Unlike a generator
+    based one, it can be held open across the yields of an async generator,
+    e.g. a pushed stream, and exited while asyncio finalizes that generator."""
+
+    def __init__(self):
+        self.session: Optional[aiohttp.ClientSession] = None
+        self.owned = False
+
+    async def __aenter__(self) -> aiohttp.ClientSession:
+        if in_background_loop():
+            self.session = background_loop.get_session()
+        else:
+            self.session = aiohttp.ClientSession()
+            self.owned = True
+        return self.session
+
+    async def __aexit__(self, *exc) -> None:
+        if self.owned:
+            await self.session.close()
+
+
+def client_session() -> ClientSessionContext:
+    """aiohttp session for a request. On the BackgroundLoop, all requests share
+    the loop's session and its connections. On other loops, which may be closed
+    after the call, a new session is closed on exit."""
+    return ClientSessionContext()
+
+
+async def run_in_thread(func, *args):
+    """Run a blocking call, e.g. file or database I/O, in the default executor
+    so it doesn't block the event loop"""
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(None, functools.partial(func, *args))
+
+
+def close_session(session: aiohttp.ClientSession, loop) -> None:
+    """Close a session bound to loop from outside of it, e.g. when an object
+    holding the session is replaced after the running loop changed"""
+    if session.closed:
+        return
+    if loop.is_running():
+        try:
+            running_loop = asyncio.get_running_loop()
+        except RuntimeError:
+            running_loop = None
+        if running_loop is loop:
+            loop.create_task(session.close())
+        else:
+            asyncio.run_coroutine_threadsafe(session.close(), loop)
+    else:
+        # Connections can't be closed without their loop, they are released
+        # when the session is garbage collected.
+        logger.debug("Dropping a session whose event loop stopped")
+
 
 def sync(awaitable) -> Any:
     """Get result of calling function on the given args. If it is awaitable, will
-    block until it is finished. Runs in a new thread in such cases.
+    block until it is finished. Runs on the process wide BackgroundLoop, so
+    sessions created by the awaitable can be reused by later calls.
     Credit Piotr: https://github.com/truera/trulens/pull/793/files#diff-23a219ce07a4edb8892fe8ecf21aba06d5ebe012c80c3386f9a9e1fe80d23254
 
     Parameters
@@ -24,20 +179,11 @@ def sync(awaitable) -> Any:
         Result of the awaitable
     """
 
-    # Check if there is a running loop.
-    try:
-        asyncio.get_running_loop()
-        in_loop = True
-    except Exception:
-        in_loop = False
-
-    if not in_loop:
-        # If not, we can create one here and run it until completion.
-        loop = asyncio.new_event_loop()
-        return loop.run_until_complete(awaitable)
+    if not in_background_loop():
+        return get_background_loop().run(awaitable)
 
-    # Otherwise we cannot create a new one in this thread so we create a
-    # new thread to run the awaitable until completion.
+    # Blocking the background loop on its own work would deadlock, so we
+    # create a new thread to run the awaitable until completion.
 
     def run_in_new_loop() -> None:
         """Create a new asycn loop for the Callable function
@@ -78,3 +224,36 @@ def sync(awaitable) -> Any:
         raise thread.error
     else:
         return thread.ret
+
+
+def sync_iter(async_iterable: AsyncIterable) -> Iterator:
+    """Iterate over an async iterable from synchronous code. Every step runs on
+    the process wide BackgroundLoop.
+
+    Parameters
+    ----------
+    async_iterable: AsyncIterable
+        Async iterable to iterate over, e.g. GenerationPipeline.call()
+
+    Yields
+    -------
+    item: Any
+        Items of the async iterable
+    """
+
+    background_loop = get_background_loop()
+    assert not background_loop.in_loop_thread()
+    async_iterator = async_iterable.__aiter__()
+    finished = False
+    try:
+        while True:
+            try:
+                item = background_loop.run(async_iterator.__anext__())
+            except StopAsyncIteration:
+                finished = True
+                return
+            yield item
+    finally:
+        # Let an abandoned async generator run its cleanup.
+        if not finished and hasattr(async_iterator, "aclose"):
+            background_loop.run(async_iterator.aclose())
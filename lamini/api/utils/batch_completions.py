@@ -1,12 +1,55 @@
 import asyncio
+import collections
 import time
-from typing import Any, Dict, List, Optional, Union
+from typing import Any, Dict, List, Optional, Tuple, Union
 
 import aiohttp
 
 import lamini
 from lamini.api.lamini_config import get_config, get_configured_key, get_configured_url
 from lamini.api.rest_requests import make_async_web_request, make_web_request
+from lamini.api.synchronize import client_session
+from lamini.api.utils.job_registry import (
+    async_find_job,
+    async_finish_job,
+    async_record_job,
+    finish_job,
+    find_job,
+    job_failed,
+    record_job,
+)
+
+
+def result_finished(result: Optional[Dict[str, Any]], index: int) -> bool:
+    return bool(result) and result["finish_reason"][index] is not None
+
+
+def update_completed(stream) -> None:
+    """Queue the prompts of a streaming object which finished since the last
+    poll, in index order"""
+    if not stream.current_result:
+        return
+    finish_reason = stream.current_result["finish_reason"]
+    stream.available_results = len(finish_reason) - finish_reason.count(None)
+    for index, reason in enumerate(finish_reason):
+        if reason is not None and index not in stream.completed:
+            stream.completed.add(index)
+            stream.ready.append(index)
+
+
+def next_completed(stream) -> Tuple[int, Any, str]:
+    """Pop the next finished prompt, setting done_streaming after the last one,
+    the caller then finishes the job"""
+    index = stream.ready.popleft()
+    if not stream.ready and len(stream.completed) == len(
+        stream.current_result["finish_reason"]
+    ):
+        stream.done_streaming = True
+    return (
+        index,
+        stream.current_result["outputs"][index],
+        stream.current_result["finish_reason"][index],
+    )
 
 
 class BatchStreamingCompletionObject:
@@ -18,7 +61,9 @@ class BatchStreamingCompletionObject:
         id: str,
         polling_interval: int,
         max_errors: int = 5,
+        as_completed: bool = False,
     ):
+        self.id = id
         self.api_url = api_url + f"/{id}/result"
         self.api_key = api_key
         self.done_streaming = False
@@ -28,6 +73,11 @@ class BatchStreamingCompletionObject:
         self.max_errors = max_errors
         self.current_index = 0
         self.available_results = 0
+        # With as_completed, results are yielded as (index, output,
+        # finish_reason) in the order the prompts finish.
+        self.as_completed = as_completed
+        self.completed = set()
+        self.ready = collections.deque()
 
     def __iter__(self) -> object:
         """Iteration definition
@@ -68,11 +118,21 @@ class BatchStreamingCompletionObject:
         Returns
         -------
         self.current_result: str
-            Streamed result from the web request
+            Streamed result from the web request, the next one by index, or
+            with as_completed the next finished one as (index, output,
+            finish_reason)
         """
         if self.done_streaming:
             raise StopIteration()
 
+        if self.as_completed:
+            while not self.ready:
+                self.poll()
+            result = next_completed(self)
+            if self.done_streaming:
+                finish_job(self.id)
+            return result
+
         self.wait_for_results()
         result = {
             "output": self.current_result["outputs"][self.current_index],
@@ -81,29 +141,29 @@ class BatchStreamingCompletionObject:
         self.current_index += 1
         if self.current_index >= len(self.current_result["finish_reason"]):
             self.done_streaming = True
+            finish_job(self.id)
         return result
 
     def wait_for_results(self):
-        # Poll for results until more work is available
-        while self.available_results <= self.current_index:
-            time.sleep(self.polling_interval)
-            try:
-                self.current_result = make_web_request(
-                    self.api_key,
-                    self.api_url,
-                    "get",
-                )
-                if self.current_result == {}:
-                    continue
-                else:
-                    self.available_results = len(
-                        self.current_result["finish_reason"]
-                    ) - self.current_result["finish_reason"].count(None)
-
-            except Exception as e:
-                self.error_count += 1
-                if self.error_count > self.max_errors:
-                    raise e
+        # Poll for results until the next one by index is finished
+        while not result_finished(self.current_result, self.current_index):
+            self.poll()
+
+    def poll(self):
+        time.sleep(self.polling_interval)
+        try:
+            self.current_result = make_web_request(
+                self.api_key,
+                self.api_url,
+                "get",
+            )
+            update_completed(self)
+        except Exception as e:
+            self.error_count += 1
+            if self.error_count > self.max_errors:
+                # Given up on, a retry submits the request again.
+                finish_job(self.id)
+                raise e
 
 
 class AsyncBatchStreamingCompletionObject:
@@ -115,7 +175,9 @@ class AsyncBatchStreamingCompletionObject:
         id: str,
         polling_interval: int,
         max_errors: int = 5,
+        as_completed: bool = False,
     ):
+        self.id = id
         self.api_url = api_url + f"/{id}/result"
         self.api_key = api_key
         self.done_streaming = False
@@ -125,6 +187,11 @@ class AsyncBatchStreamingCompletionObject:
         self.max_errors = max_errors
         self.current_index = 0
         self.available_results = 0
+        # With as_completed, results are yielded as (index, output,
+        # finish_reason) in the order the prompts finish.
+        self.as_completed = as_completed
+        self.completed = set()
+        self.ready = collections.deque()
 
     def __aiter__(self) -> object:
         """Asychronous iteration definition
@@ -165,13 +232,22 @@ class AsyncBatchStreamingCompletionObject:
         Returns
         -------
         self.current_result: str
-            Streamed result from the web request
+            Streamed result from the web request, the next one by index, or
+            with as_completed the next finished one as (index, output,
+            finish_reason)
         """
         if self.done_streaming:
             raise StopAsyncIteration()
 
+        if self.as_completed:
+            while not self.ready:
+                await self.poll()
+            result = next_completed(self)
+            if self.done_streaming:
+                await async_finish_job(self.id)
+            return result
+
         await self.wait_for_results()
-        # print(self.current_result)
         result = {
             "output": self.current_result["outputs"][self.current_index],
             "finish_reason": self.current_result["finish_reason"][self.current_index],
@@ -179,32 +255,31 @@ class AsyncBatchStreamingCompletionObject:
         self.current_index += 1
         if self.current_index >= len(self.current_result["finish_reason"]):
             self.done_streaming = True
+            await async_finish_job(self.id)
         return result
 
     async def wait_for_results(self):
-        # Poll for results until more work is available
-        while self.available_results <= self.current_index:
-            await asyncio.sleep(self.polling_interval)
-            try:
-                async with aiohttp.ClientSession() as client:
-                    self.current_result = await make_async_web_request(
-                        client,
-                        self.api_key,
-                        self.api_url,
-                        "get",
-                    )
-                    # print(self.current_result)
-                if self.current_result == {}:
-                    continue
-                else:
-                    self.available_results = len(
-                        self.current_result["finish_reason"]
-                    ) - self.current_result["finish_reason"].count(None)
-
-            except Exception as e:
-                self.error_count += 1
-                if self.error_count > self.max_errors:
-                    raise e
+        # Poll for results until the next one by index is finished
+        while not result_finished(self.current_result, self.current_index):
+            await self.poll()
+
+    async def poll(self):
+        await asyncio.sleep(self.polling_interval)
+        try:
+            async with client_session() as client:
+                self.current_result = await make_async_web_request(
+                    client,
+                    self.api_key,
+                    self.api_url,
+                    "get",
+                )
+            update_completed(self)
+        except Exception as e:
+            self.error_count += 1
+            if self.error_count > self.max_errors:
+                # Given up on, a retry submits the request again.
+                await async_finish_job(self.id)
+                raise e
 
 
 class BatchCompletions:
@@ -236,12 +311,16 @@ class BatchCompletions:
             max_tokens=max_tokens,
             max_new_tokens=max_new_tokens,
         )
+        resp = find_job("batch_completions", self.api_url, req_data, self.check_result)
+        if resp is not None:
+            return resp
         resp = make_web_request(
             self.api_key,
             self.api_prefix + "batch_completions",
             "post",
             req_data,
         )
+        record_job("batch_completions", self.api_url, req_data, resp)
         return resp
 
     async def async_submit(
@@ -251,6 +330,7 @@ class BatchCompletions:
         output_type: Optional[dict] = None,
         max_tokens: Optional[int] = None,
         max_new_tokens: Optional[int] = None,
+        client: Optional[aiohttp.ClientSession] = None,
     ) -> Dict[str, Any]:
 
         req_data = self.make_llm_req_map(
@@ -260,7 +340,15 @@ class BatchCompletions:
             max_tokens=max_tokens,
             max_new_tokens=max_new_tokens,
         )
-        async with aiohttp.ClientSession() as client:
+        resp = await async_find_job(
+            "batch_completions",
+            self.api_url,
+            req_data,
+            lambda id: self.async_check_result(id, client),
+        )
+        if resp is not None:
+            return resp
+        if client is not None:
             resp = await make_async_web_request(
                 client,
                 self.api_key,
@@ -268,6 +356,16 @@ class BatchCompletions:
                 "post",
                 req_data,
             )
+        else:
+            async with client_session() as client:
+                resp = await make_async_web_request(
+                    client,
+                    self.api_key,
+                    self.api_prefix + "batch_completions",
+                    "post",
+                    req_data,
+                )
+        await async_record_job("batch_completions", self.api_url, req_data, resp)
         return resp
 
     def streaming_generate(
@@ -278,6 +376,7 @@ class BatchCompletions:
         max_tokens: Optional[int] = None,
         max_new_tokens: Optional[int] = None,
         polling_interval: Optional[float] = 1,
+        as_completed: bool = False,
     ) -> Dict[str, Any]:
 
         resp = self.submit(
@@ -292,6 +391,7 @@ class BatchCompletions:
             api_url=self.api_prefix + f"batch_completions",
             polling_interval=polling_interval,
             id=resp["id"],
+            as_completed=as_completed,
         )
 
     async def async_streaming_generate(
@@ -302,6 +402,7 @@ class BatchCompletions:
         max_tokens: Optional[int] = None,
         max_new_tokens: Optional[int] = None,
         polling_interval: Optional[float] = 1,
+        as_completed: bool = False,
     ) -> Dict[str, Any]:
 
         resp = await self.async_submit(
@@ -316,20 +417,33 @@ class BatchCompletions:
             api_url=self.api_prefix + f"batch_completions",
             polling_interval=polling_interval,
             id=resp["id"],
+            as_completed=as_completed,
         )
 
     async def async_check_result(
         self,
         id: str,
+        client: Optional[aiohttp.ClientSession] = None,
     ) -> Dict[str, Any]:
-        """Check for the result of a batch request with the appropriate batch id."""
-        async with aiohttp.ClientSession() as client:
+        """Check for the result of a batch request with the appropriate batch id.
+        A new session is used unless client is given."""
+        if client is not None:
             resp = await make_async_web_request(
                 client,
                 self.api_key,
                 self.api_prefix + f"batch_completions/{id}/result",
                 "get",
             )
+        else:
+            async with client_session() as client:
+                resp = await make_async_web_request(
+                    client,
+                    self.api_key,
+                    self.api_prefix + f"batch_completions/{id}/result",
+                    "get",
+                )
+        if job_failed(resp) or (resp and all(resp["finish_reason"])):
+            await async_finish_job(id)
         return resp
 
     def check_result(
@@ -342,6 +456,8 @@ class BatchCompletions:
             self.api_prefix + f"batch_completions/{id}/result",
             "get",
         )
+        if job_failed(resp) or (resp and all(resp["finish_reason"])):
+            finish_job(id)
         return resp
 
     def make_llm_req_map(
@@ -5,6 +5,15 @@ import aiohttp
 import lamini
 from lamini.api.lamini_config import get_config, get_configured_key, get_configured_url
 from lamini.api.rest_requests import make_async_web_request, make_web_request
+from lamini.api.synchronize import client_session
+from lamini.api.utils.job_registry import (
+    async_find_job,
+    async_finish_job,
+    async_record_job,
+    finish_job,
+    find_job,
+    record_job,
+)
 
 
 class BatchEmbeddings:
@@ -29,25 +38,37 @@ class BatchEmbeddings:
             prompt=prompt,
             model_name=model_name,
         )
+        resp = find_job("batch_embeddings", self.api_url, req_data, self.check_result)
+        if resp is not None:
+            return resp
         resp = make_web_request(
             self.api_key,
             self.api_prefix + "batch_embeddings",
             "post",
             req_data,
         )
+        record_job("batch_embeddings", self.api_url, req_data, resp)
         return resp
 
     async def async_submit(
         self,
         prompt: Union[str, List[str]],
         model_name: Optional[str] = None,
+        client: Optional[aiohttp.ClientSession] = None,
     ) -> Dict[str, Any]:
         req_data = self.make_llm_req_map(
             prompt=prompt,
             model_name=model_name,
         )
-        async with aiohttp.ClientSession() as client:
-
+        resp = await async_find_job(
+            "batch_embeddings",
+            self.api_url,
+            req_data,
+            lambda id: self.async_check_result(id, client),
+        )
+        if resp is not None:
+            return resp
+        if client is not None:
             resp = await make_async_web_request(
                 client,
                 self.api_key,
@@ -55,6 +76,16 @@ class BatchEmbeddings:
                 "post",
                 req_data,
             )
+        else:
+            async with client_session() as client:
+                resp = await make_async_web_request(
+                    client,
+                    self.api_key,
+                    self.api_prefix + "batch_embeddings",
+                    "post",
+                    req_data,
+                )
+        await async_record_job("batch_embeddings", self.api_url, req_data, resp)
         return resp
 
     def check_result(
@@ -67,20 +98,34 @@ class BatchEmbeddings:
             self.api_prefix + f"batch_embeddings/{id}/result",
             "get",
         )
+        if resp:
+            finish_job(id)
         return resp
 
     async def async_check_result(
         self,
         id: str,
+        client: Optional[aiohttp.ClientSession] = None,
     ) -> Dict[str, Any]:
-        """Check for the result of a batch request with the appropriate batch id."""
-        async with aiohttp.ClientSession() as client:
+        """Check for the result of a batch request with the appropriate batch id.
+        A new session is used unless client is given."""
+        if client is not None:
             resp = await make_async_web_request(
                 client,
                 self.api_key,
                 self.api_prefix + f"batch_embeddings/{id}/result",
                 "get",
             )
+        else:
+            async with client_session() as client:
+                resp = await make_async_web_request(
+                    client,
+                    self.api_key,
+                    self.api_prefix + f"batch_embeddings/{id}/result",
+                    "get",
+                )
+        if resp:
+            await async_finish_job(id)
         return resp
 
     def make_llm_req_map(
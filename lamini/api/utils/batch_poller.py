@@ -0,0 +1,222 @@
+import asyncio
+import heapq
+import itertools
+import logging
+import time
+import weakref
+from typing import Any, Awaitable, Callable, Dict, Optional
+
+import aiohttp
+import lamini
+from lamini.api.synchronize import client_session
+
+logger = logging.getLogger(__name__)
+
+# One poller per event loop, see get_batch_poller().
+batch_pollers: "weakref.WeakKeyDictionary[asyncio.AbstractEventLoop, BatchPoller]" = (
+    weakref.WeakKeyDictionary()
+)
+
+
+def get_batch_poller() -> "BatchPoller":
+    """Return the BatchPoller of the running event loop, creating it if needed"""
+    loop = asyncio.get_running_loop()
+    poller = batch_pollers.get(loop)
+    if poller is None:
+        poller = BatchPoller()
+        batch_pollers[loop] = poller
+    return poller
+
+
+class BatchJob:
+    """An outstanding batch job and the waiter for its result"""
+
+    def __init__(
+        self,
+        id: str,
+        check_result: Callable[[str, aiohttp.ClientSession], Awaitable[Dict]],
+        is_done: Callable[[Dict], bool],
+        future: asyncio.Future,
+        interval: float,
+    ):
+        self.id = id
+        self.check_result = check_result
+        self.is_done = is_done
+        self.future = future
+        self.interval = interval
+        self.error_count = 0
+        # Whether a poll of the job is running, a job is polled once at a time
+        self.in_flight = False
+
+
+class BatchPoller:
+    """Polls the results of every outstanding batch job of an event loop
+
+    A single task schedules the polls of all jobs registered with wait(),
+    sharing one aiohttp session. Every poll runs in its own task, so a slow
+    job doesn't hold back the others, and fails after poll_timeout seconds.
+    Each job is first polled after min_interval seconds; while it is not done,
+    its interval grows by backoff up to max_interval. A result carrying a
+    "retry_after" value in seconds overrides the next interval. A waiter is
+    woken up by the poll which finds its job done.
+
+    Parameters
+    ----------
+    min_interval: Optional[float] = None
+        First polling interval in seconds, defaults to
+        lamini.batch_poll_min_interval
+
+    max_interval: Optional[float] = None
+        Longest polling interval in seconds, defaults to
+        lamini.batch_poll_max_interval
+
+    backoff: float = 1.5
+        Factor the polling interval of a job grows by after each poll
+
+    max_errors: int = 5
+        Failed polls of a job tolerated before the error is raised to its waiter
+
+    poll_timeout: Optional[float] = None
+        Seconds after which a poll counts as failed, defaults to
+        lamini.batch_poll_timeout
+    """
+
+    def __init__(
+        self,
+        min_interval: Optional[float] = None,
+        max_interval: Optional[float] = None,
+        backoff: float = 1.5,
+        max_errors: int = 5,
+        poll_timeout: Optional[float] = None,
+    ):
+        self.min_interval = (
+            lamini.batch_poll_min_interval if min_interval is None else min_interval
+        )
+        self.max_interval = (
+            lamini.batch_poll_max_interval if max_interval is None else max_interval
+        )
+        self.backoff = backoff
+        self.max_errors = max_errors
+        self.poll_timeout = (
+            lamini.batch_poll_timeout if poll_timeout is None else poll_timeout
+        )
+        # (next poll time, tie breaker, job)
+        self.schedule = []
+        self.counter = itertools.count()
+        self.wakeup = asyncio.Event()
+        self.task: Optional[asyncio.Task] = None
+        # Tasks of the running polls
+        self.polls = set()
+
+    async def wait(
+        self,
+        id: str,
+        check_result: Callable[[str, aiohttp.ClientSession], Awaitable[Dict]],
+        is_done: Callable[[Dict], bool],
+    ) -> Dict[str, Any]:
+        """Wait for a batch job to finish and return its last result
+
+        Parameters
+        ----------
+        id: str
+            Batch job id
+
+        check_result: Callable[[str, aiohttp.ClientSession], Awaitable[Dict]]
+            Fetches the current result of a job, e.g.
+            BatchCompletions.async_check_result
+
+        is_done: Callable[[Dict], bool]
+            Whether a result is final
+
+        Returns
+        -------
+        Dict[str, Any]
+            The result for which is_done returned True
+        """
+
+        future = asyncio.get_running_loop().create_future()
+        job = BatchJob(id, check_result, is_done, future, self.min_interval)
+        self.schedule_poll(job, self.min_interval)
+        if self.task is None:
+            self.task = asyncio.create_task(self.run())
+        # A cancelled waiter is dropped from the schedule at its next poll.
+        return await future
+
+    def schedule_poll(self, job: BatchJob, delay: float):
+        heapq.heappush(
+            self.schedule, (time.monotonic() + delay, next(self.counter), job)
+        )
+        self.wakeup.set()
+
+    async def run(self):
+        try:
+            async with client_session() as client:
+                while self.schedule or self.polls:
+                    self.wakeup.clear()
+                    delay = (
+                        self.schedule[0][0] - time.monotonic()
+                        if self.schedule
+                        else None
+                    )
+                    if delay is None or delay > 0:
+                        # Wake up early if a job was added or a poll finished,
+                        # the next job may be due sooner.
+                        try:
+                            await asyncio.wait_for(self.wakeup.wait(), timeout=delay)
+                        except asyncio.TimeoutError:
+                            pass
+                        continue
+                    now = time.monotonic()
+                    while self.schedule and self.schedule[0][0] <= now:
+                        job = heapq.heappop(self.schedule)[2]
+                        if job.in_flight:
+                            continue
+                        job.in_flight = True
+                        task = asyncio.create_task(self.poll(client, job))
+                        self.polls.add(task)
+                        task.add_done_callback(self.poll_done)
+                # Cleared before closing the session, which may await, so that
+                # jobs added from now on start a new task.
+                self.task = None
+        finally:
+            if self.task is asyncio.current_task():
+                # Stopped before all jobs finished, e.g. cancelled
+                self.task = None
+                for task in list(self.polls):
+                    task.cancel()
+
+    def poll_done(self, task: asyncio.Task):
+        self.polls.discard(task)
+        self.wakeup.set()
+
+    async def poll(self, client: aiohttp.ClientSession, job: BatchJob):
+        try:
+            await self.poll_job(client, job)
+        finally:
+            job.in_flight = False
+
+    async def poll_job(self, client: aiohttp.ClientSession, job: BatchJob):
+        if job.future.done():
+            return
+        try:
+            result = await asyncio.wait_for(
+                job.check_result(job.id, client), timeout=self.poll_timeout
+            )
+        except Exception as e:
+            job.error_count += 1
+            logger.debug(f"Polling batch {job.id} failed: {e!r}")
+            if job.error_count > self.max_errors:
+                if not job.future.done():
+                    job.future.set_exception(e)
+                return
+        else:
+            if result and job.is_done(result):
+                if not job.future.done():
+                    job.future.set_result(result)
+                return
+            hint = result.get("retry_after") if isinstance(result, dict) else None
+            if hint is not None:
+                self.schedule_poll(job, float(hint))
+                return
+        job.interval = min(job.interval * self.backoff, self.max_interval)
+        self.schedule_poll(job, job.interval)
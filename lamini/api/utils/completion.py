@@ -4,6 +4,7 @@ import aiohttp
 import lamini
 from lamini.api.lamini_config import get_config, get_configured_key, get_configured_url
 from lamini.api.rest_requests import make_async_web_request, make_web_request
+from lamini.api.synchronize import client_session
 
 
 class Completion:
@@ -129,7 +130,7 @@ class Completion:
             )
             return resp
 
-        async with aiohttp.ClientSession() as client:
+        async with client_session() as client:
             resp = await make_async_web_request(
                 client, self.api_key, self.api_prefix + "completions", "post", params
             )
@@ -0,0 +1,385 @@
+import contextlib
+import hashlib
+import json
+import logging
+import os
+import threading
+from typing import Callable, Dict, List, Optional, Tuple
+
+import lamini
+import numpy as np
+from lamini.api.synchronize import run_in_thread
+
+try:
+    import fcntl
+except ImportError:
+    # Windows, the cache directory isn't locked.
+    fcntl = None
+
+logger = logging.getLogger(__name__)
+
+DIGEST_SIZE = 32
+
+
+class ModelEmbeddingCache:
+    """Cached embeddings of one model, see EmbeddingCache
+
+    Files in directory:
+        meta.json: model name and embedding dimension
+        embeddings.f32: float32 rows, appended to and read through np.memmap
+        hashes.bin: sha256 digest of the text of every row, in row order
+        lock: locked while the other files are read or written, so processes
+            sharing the directory keep the rows of the two files paired
+    """
+
+    def __init__(self, directory: str, model_name: Optional[str]):
+        self.directory = directory
+        self.model_name = model_name
+        self.embeddings_path = os.path.join(directory, "embeddings.f32")
+        self.hashes_path = os.path.join(directory, "hashes.bin")
+        self.meta_path = os.path.join(directory, "meta.json")
+        self.lock_path = os.path.join(directory, "lock")
+        self.dim: Optional[int] = None
+        # text digest -> row
+        self.rows: Dict[bytes, int] = {}
+        self.count = 0
+        # Rows are evicted least recently used first.
+        self.last_used: List[int] = []
+        self.clock = 0
+        self.matrix: Optional[np.ndarray] = None
+        self.embeddings_file = None
+        self.hashes_file = None
+        # Identifies the hashes file the rows were read from, it is replaced
+        # when a process compacts the cache.
+        self.files_id: Optional[Tuple[int, int]] = None
+        os.makedirs(directory, exist_ok=True)
+        self.load()
+
+    @contextlib.contextmanager
+    def locked(self):
+        """Hold the lock of the directory, shared by all processes"""
+        if fcntl is None:
+            yield
+            return
+        with open(self.lock_path, "a") as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+    def load(self):
+        with self.locked():
+            self.refresh()
+
+    def file_id(self) -> Optional[Tuple[int, int]]:
+        if not os.path.exists(self.hashes_path):
+            return None
+        stat = os.stat(self.hashes_path)
+        return stat.st_dev, stat.st_ino
+
+    def refresh(self):
+        """Read the rows appended since the last refresh, including the ones
+        of other processes, and all rows again if the files were rewritten.
+        Called with the lock held."""
+        if self.dim is None:
+            if not os.path.exists(self.meta_path):
+                return
+            with open(self.meta_path) as f:
+                self.dim = json.load(f)["dim"]
+        file_id = self.file_id()
+        if self.files_id is not None and file_id != self.files_id:
+            self.close()
+            self.rows = {}
+            self.count = 0
+            self.last_used = []
+        self.files_id = file_id
+        row_bytes = 4 * self.dim
+        hashes_size = self.size(self.hashes_path)
+        embeddings_size = self.size(self.embeddings_path)
+        count = hashes_size // DIGEST_SIZE
+        if hashes_size != count * DIGEST_SIZE or embeddings_size != count * row_bytes:
+            # A process died between the writes of a row to the two files.
+            count = min(count, embeddings_size // row_bytes)
+            logger.warning(
+                f"Embedding cache {self.directory} has a partial row, "
+                f"truncating it to {count} rows"
+            )
+            self.truncate(self.hashes_path, count * DIGEST_SIZE)
+            self.truncate(self.embeddings_path, count * row_bytes)
+        if count <= self.count:
+            return
+        with open(self.hashes_path, "rb") as f:
+            f.seek(self.count * DIGEST_SIZE)
+            digests = f.read((count - self.count) * DIGEST_SIZE)
+        for i in range(count - self.count):
+            self.rows[digests[i * DIGEST_SIZE : (i + 1) * DIGEST_SIZE]] = self.count + i
+            self.clock += 1
+            self.last_used.append(self.clock)
+        self.count = count
+
+    @staticmethod
+    def size(path: str) -> int:
+        return os.path.getsize(path) if os.path.exists(path) else 0
+
+    @staticmethod
+    def truncate(path: str, size: int):
+        if os.path.exists(path) and os.path.getsize(path) != size:
+            with open(path, "r+b") as f:
+                f.truncate(size)
+
+    def touch(self, row: int):
+        self.clock += 1
+        self.last_used[row] = self.clock
+
+    def get(self, digest: bytes) -> Optional[np.ndarray]:
+        row = self.rows.get(digest)
+        if row is None:
+            return None
+        if self.matrix is None or row >= len(self.matrix):
+            self.remap()
+            # The rows are read again if another process compacted the files.
+            row = self.rows.get(digest)
+            if row is None:
+                return None
+        self.touch(row)
+        return np.asarray(self.matrix[row])
+
+    def remap(self):
+        with self.locked():
+            self.refresh()
+            self.map()
+
+    def map(self):
+        self.flush()
+        if self.count == 0:
+            self.matrix = None
+            return
+        self.matrix = np.memmap(
+            self.embeddings_path,
+            dtype=np.float32,
+            mode="r",
+            shape=(self.count, self.dim),
+        )
+
+    def put(self, digest: bytes, embedding: np.ndarray):
+        if digest in self.rows:
+            return
+        embedding = np.asarray(embedding, dtype=np.float32).reshape(-1)
+        if self.dim is None:
+            self.dim = len(embedding)
+            with open(self.meta_path, "w") as f:
+                json.dump({"model_name": self.model_name, "dim": self.dim}, f)
+        if len(embedding) != self.dim:
+            raise ValueError(
+                f"Embedding of dimension {len(embedding)} for a cache of dimension {self.dim}"
+            )
+        if self.embeddings_file is None:
+            self.embeddings_file = open(self.embeddings_path, "ab")
+            self.hashes_file = open(self.hashes_path, "ab")
+            if self.files_id is None:
+                self.files_id = self.file_id()
+        self.embeddings_file.write(embedding.tobytes())
+        self.hashes_file.write(digest)
+        self.rows[digest] = self.count
+        self.last_used.append(0)
+        self.count += 1
+        self.touch(self.count - 1)
+
+    def flush(self):
+        if self.embeddings_file is not None:
+            self.embeddings_file.flush()
+            self.hashes_file.flush()
+
+    def close(self):
+        if self.embeddings_file is not None:
+            self.embeddings_file.close()
+            self.hashes_file.close()
+            self.embeddings_file = None
+            self.hashes_file = None
+        self.matrix = None
+
+    def compact(self, keep_rows: int) -> int:
+        """Rewrite the files with the keep_rows most recently used rows,
+        returning the number of evicted rows. Called with the lock held."""
+        if self.count <= keep_rows:
+            return 0
+        self.map()
+        kept = sorted(
+            sorted(range(self.count), key=self.last_used.__getitem__)[-keep_rows:]
+        )
+        digests = [None] * self.count
+        for digest, row in self.rows.items():
+            digests[row] = digest
+        tmp_embeddings = self.embeddings_path + ".tmp"
+        tmp_hashes = self.hashes_path + ".tmp"
+        with open(tmp_embeddings, "wb") as f:
+            f.write(np.ascontiguousarray(self.matrix[kept]).tobytes())
+        with open(tmp_hashes, "wb") as f:
+            f.write(b"".join(digests[row] for row in kept))
+        self.close()
+        os.replace(tmp_embeddings, self.embeddings_path)
+        os.replace(tmp_hashes, self.hashes_path)
+        self.files_id = self.file_id()
+        evicted = self.count - len(kept)
+        self.rows = {digests[row]: i for i, row in enumerate(kept)}
+        self.last_used = [self.last_used[row] for row in kept]
+        self.count = len(kept)
+        return evicted
+
+
+class EmbeddingCache:
+    """Persistent embedding cache, keyed by model name and text hash
+
+    Every model has its own directory under path, holding an append-only
+    float32 matrix which is read through a memory map, and the sha256 digests
+    of the texts of its rows. The digest to row index is kept in memory.
+
+    When a model has more than max_rows rows, the least recently used ones
+    are evicted by rewriting its files with the most recent three quarters.
+
+    Processes may share the cache, a lock file in every model directory is
+    held while its files are written.
+
+    Parameters
+    ----------
+    path: str
+        Directory to store the cache in
+
+    max_rows: Optional[int] = None
+        Rows kept per model, unbounded if None
+    """
+
+    def __init__(self, path: str, max_rows: Optional[int] = None):
+        self.path = os.path.expanduser(path)
+        self.max_rows = max_rows
+        self.models: Dict[Optional[str], ModelEmbeddingCache] = {}
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    @staticmethod
+    def digest(text: str) -> bytes:
+        return hashlib.sha256(text.encode("utf-8")).digest()
+
+    def model(self, model_name: Optional[str]) -> ModelEmbeddingCache:
+        cache = self.models.get(model_name)
+        if cache is None:
+            key = hashlib.sha256((model_name or "").encode("utf-8")).hexdigest()[:16]
+            cache = ModelEmbeddingCache(os.path.join(self.path, key), model_name)
+            self.models[model_name] = cache
+        return cache
+
+    def lookup(
+        self, model_name: Optional[str], texts: List[str]
+    ) -> List[Optional[np.ndarray]]:
+        """Cached embedding of every text, None for the ones not cached"""
+        with self.lock:
+            cache = self.model(model_name)
+            embeddings = [cache.get(self.digest(text)) for text in texts]
+            hits = sum(embedding is not None for embedding in embeddings)
+            self.hits += hits
+            self.misses += len(texts) - hits
+        return embeddings
+
+    def put(self, model_name: Optional[str], texts: List[str], embeddings):
+        """Add the embeddings of texts, one row each"""
+        with self.lock:
+            cache = self.model(model_name)
+            with cache.locked():
+                # Rows appended by other processes are read first, so the new
+                # rows are numbered after them.
+                cache.refresh()
+                for text, embedding in zip(texts, embeddings):
+                    cache.put(self.digest(text), embedding)
+                cache.flush()
+                if self.max_rows is not None and cache.count > self.max_rows:
+                    evicted = cache.compact(max(1, self.max_rows * 3 // 4))
+                    self.evictions += evicted
+                    logger.debug(f"Evicted {evicted} embeddings of {model_name}")
+
+    def split(
+        self, model_name: Optional[str], texts: List[str]
+    ) -> Tuple[List[Optional[np.ndarray]], List[int]]:
+        embeddings = self.lookup(model_name, texts)
+        missing = [i for i, embedding in enumerate(embeddings) if embedding is None]
+        return embeddings, missing
+
+    def fill(
+        self,
+        model_name: Optional[str],
+        texts: List[str],
+        embeddings: List[Optional[np.ndarray]],
+        missing: List[int],
+        computed: Optional[np.ndarray],
+    ) -> np.ndarray:
+        if missing:
+            self.put(model_name, [texts[i] for i in missing], computed)
+            for i, embedding in zip(missing, computed):
+                embeddings[i] = embedding
+        if not embeddings:
+            return np.empty((0, 0), dtype=np.float32)
+        return np.ascontiguousarray(np.stack(embeddings), dtype=np.float32)
+
+    def get_embeddings(
+        self,
+        model_name: Optional[str],
+        texts: List[str],
+        compute: Callable[[List[str]], np.ndarray],
+    ) -> np.ndarray:
+        """(n, d) float32 matrix of the embeddings of texts, calling compute for
+        the texts that aren't cached"""
+        embeddings, missing = self.split(model_name, texts)
+        computed = compute([texts[i] for i in missing]) if missing else None
+        return self.fill(model_name, texts, embeddings, missing, computed)
+
+    async def async_get_embeddings(
+        self, model_name: Optional[str], texts: List[str], compute
+    ) -> np.ndarray:
+        """Asynchronous version of get_embeddings, compute is a coroutine
+        function. The cache files are read and written off the event loop."""
+        embeddings, missing = await run_in_thread(self.split, model_name, texts)
+        computed = await compute([texts[i] for i in missing]) if missing else None
+        return await run_in_thread(
+            self.fill, model_name, texts, embeddings, missing, computed
+        )
+
+    def stats(self) -> dict:
+        with self.lock:
+            rows = {
+                model_name: cache.count for model_name, cache in self.models.items()
+            }
+            size = sum(
+                cache.count * 4 * (cache.dim or 0) for cache in self.models.values()
+            )
+            hits, misses, evictions = self.hits, self.misses, self.evictions
+        lookups = hits + misses
+        return {
+            "hits": hits,
+            "misses": misses,
+            "hit_rate": hits / lookups if lookups else None,
+            "evictions": evictions,
+            "rows": rows,
+            "bytes": size,
+        }
+
+    def close(self):
+        with self.lock:
+            for cache in self.models.values():
+                cache.close()
+
+
+embedding_caches: Dict[str, EmbeddingCache] = {}
+
+
+def get_embedding_cache() -> Optional[EmbeddingCache]:
+    """Return the cache at lamini.embedding_cache_path, None if it isn't set"""
+    path = lamini.embedding_cache_path
+    if not path:
+        return None
+    cache = embedding_caches.get(path)
+    if cache is None:
+        cache = EmbeddingCache(path, lamini.embedding_cache_max_rows)
+        embedding_caches[path] = cache
+    return cache
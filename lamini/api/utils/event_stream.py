@@ -0,0 +1,143 @@
+import importlib.metadata
+import json
+import logging
+from typing import Any, AsyncIterator, Dict, Iterator, Optional
+
+import aiohttp
+import requests
+from lamini.error.error import AuthenticationError, StreamingUnavailableError
+
+logger = logging.getLogger(__name__)
+
+# Server-sent events, and JSON lines sent with chunked transfer encoding.
+SSE_CONTENT_TYPE = "text/event-stream"
+NDJSON_CONTENT_TYPE = "application/x-ndjson"
+
+# Seconds without any data, including keep-alive comments, before a pushed
+# stream is given up on.
+stream_read_timeout = 60
+
+
+class EventStreamParser:
+    """Decodes the lines of a pushed stream into JSON results
+
+    Both server-sent events, whose data fields hold JSON, and JSON lines are
+    supported. A "[DONE]" event ends the stream.
+
+    Parameters
+    ----------
+    content_type: str
+        Content type of the response
+    """
+
+    def __init__(self, content_type: str):
+        self.is_sse = content_type.startswith(SSE_CONTENT_TYPE)
+        self.data = []
+        self.finished = False
+
+    def feed(self, line: str) -> Optional[Dict[str, Any]]:
+        """Consume one line without its line ending, returning the result
+        completed by it, if any"""
+        if not self.is_sse:
+            line = line.strip()
+            return json.loads(line) if line else None
+        if line == "":
+            if not self.data:
+                return None
+            payload = "\n".join(self.data)
+            self.data = []
+            if payload == "[DONE]":
+                self.finished = True
+                return None
+            return json.loads(payload)
+        if line.startswith(":"):
+            # Comment, e.g. a keep-alive
+            return None
+        field, _, value = line.partition(":")
+        if field == "data":
+            self.data.append(value[1:] if value.startswith(" ") else value)
+        return None
+
+
+def get_stream_headers(key: str) -> Dict[str, str]:
+    try:
+        headers = {
+            "Accept": f"{SSE_CONTENT_TYPE}, {NDJSON_CONTENT_TYPE}",
+            "Authorization": "Bearer " + key,
+        }
+    except:
+        raise AuthenticationError("Missing API Key")
+    try:
+        headers["Lamini-Version"] = importlib.metadata.version("lamini")
+    except:
+        pass
+    return headers
+
+
+def check_stream_response(status: int, content_type: str, url: str) -> None:
+    if status != 200:
+        raise StreamingUnavailableError(f"{url} returned status {status}")
+    if not (
+        content_type.startswith(SSE_CONTENT_TYPE)
+        or content_type.startswith(NDJSON_CONTENT_TYPE)
+    ):
+        raise StreamingUnavailableError(f"{url} returned content type {content_type}")
+
+
+def stream_results(key: str, url: str) -> Iterator[Dict[str, Any]]:
+    """Yield the results pushed by the server as soon as they arrive
+
+    Parameters
+    ----------
+    key: str
+        Lamini platform API key
+
+    url: str
+        URL of the stream endpoint
+
+    Raises
+    ------
+    StreamingUnavailableError
+        Raised if the endpoint doesn't push results
+
+    Yields
+    -------
+    Dict[str, Any]
+        Every result sent by the server
+    """
+
+    with requests.get(
+        url, headers=get_stream_headers(key), stream=True, timeout=stream_read_timeout
+    ) as resp:
+        content_type = resp.headers.get("Content-Type", "")
+        check_stream_response(resp.status_code, content_type, url)
+        parser = EventStreamParser(content_type)
+        resp.encoding = "utf-8"
+        # chunk_size=None hands over data as soon as it arrives.
+        for line in resp.iter_lines(chunk_size=None, decode_unicode=True):
+            result = parser.feed(line)
+            if parser.finished:
+                return
+            if result is not None:
+                yield result
+
+
+async def async_stream_results(
+    client: aiohttp.ClientSession, key: str, url: str
+) -> AsyncIterator[Dict[str, Any]]:
+    """Asynchronous version of stream_results"""
+
+    async with client.get(
+        url,
+        headers=get_stream_headers(key),
+        timeout=aiohttp.ClientTimeout(sock_read=stream_read_timeout),
+    ) as resp:
+        content_type = resp.headers.get("Content-Type", "")
+        check_stream_response(resp.status, content_type, url)
+        parser = EventStreamParser(content_type)
+        async for line in resp.content:
+            result = parser.feed(line.decode("utf-8").rstrip("\r\n"))
+            if parser.finished:
+                return
+            if result is not None:
+                yield result
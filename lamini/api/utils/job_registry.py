@@ -0,0 +1,232 @@
+import contextlib
+import hashlib
+import json
+import logging
+import os
+import sqlite3
+import time
+from typing import Any, Callable, Dict, Optional
+
+import lamini
+from lamini.api.synchronize import run_in_thread
+
+logger = logging.getLogger(__name__)
+
+# Statuses of a job result which mean the job won't produce a result
+FAILED_STATUSES = ("failed", "error", "cancelled", "canceled")
+
+
+def job_failed(result: Any) -> bool:
+    """Whether a job result reports that the job failed or was cancelled"""
+    if not isinstance(result, dict):
+        return False
+    status = result.get("status")
+    return bool(result.get("error")) or (
+        isinstance(status, str) and status.lower() in FAILED_STATUSES
+    )
+
+
+class JobRegistry:
+    """Durable record of the jobs submitted to the Lamini Platform
+
+    Submitting batch_completions, batch_embeddings and streaming_completions
+    jobs records their id under a fingerprint of the request. After a
+    restart, submitting the same request reattaches to the recorded job, as
+    long as its result can still be checked and doesn't report a failure,
+    instead of paying for it twice. An entry is removed once the result of its
+    job was seen finished, once the job failed or was given up on, or when it
+    is older than max_age.
+
+    Parameters
+    ----------
+    path: str
+        Path of the SQLite database file
+
+    max_age: float = 7 * 24 * 3600
+        Seconds after which an entry is dropped, finished or not
+    """
+
+    def __init__(self, path: str, max_age: float = 7 * 24 * 3600):
+        self.path = os.path.expanduser(path)
+        self.max_age = max_age
+        directory = os.path.dirname(self.path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        with self.connect() as conn:
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS jobs ("
+                "fingerprint TEXT PRIMARY KEY, kind TEXT, job_id TEXT, created REAL)"
+            )
+            conn.execute("CREATE INDEX IF NOT EXISTS jobs_job_id ON jobs (job_id)")
+        self.collect_garbage()
+
+    @contextlib.contextmanager
+    def connect(self):
+        # A connection per operation, so the registry can be used from any
+        # thread or process.
+        with contextlib.closing(sqlite3.connect(self.path, timeout=30)) as conn:
+            with conn:
+                yield conn
+
+    @staticmethod
+    def fingerprint(kind: str, api_url: str, request: Dict[str, Any]) -> str:
+        payload = json.dumps([kind, api_url, request], sort_keys=True, default=str)
+        return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+    def lookup(self, fingerprint: str) -> Optional[str]:
+        with self.connect() as conn:
+            row = conn.execute(
+                "SELECT job_id FROM jobs WHERE fingerprint = ?", (fingerprint,)
+            ).fetchone()
+        return None if row is None else row[0]
+
+    def record(self, fingerprint: str, kind: str, job_id: str) -> None:
+        with self.connect() as conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO jobs VALUES (?, ?, ?, ?)",
+                (fingerprint, kind, job_id, time.time()),
+            )
+
+    def forget(self, fingerprint: str) -> None:
+        with self.connect() as conn:
+            conn.execute("DELETE FROM jobs WHERE fingerprint = ?", (fingerprint,))
+
+    def finish(self, job_id: str) -> None:
+        """Remove the entry of a job whose result was seen finished"""
+        with self.connect() as conn:
+            conn.execute("DELETE FROM jobs WHERE job_id = ?", (job_id,))
+
+    def collect_garbage(self) -> None:
+        with self.connect() as conn:
+            conn.execute(
+                "DELETE FROM jobs WHERE created < ?", (time.time() - self.max_age,)
+            )
+
+    def reattach(
+        self, fingerprint: str, check_result: Callable[[str], Dict[str, Any]]
+    ) -> Optional[str]:
+        """Return the id of the recorded job for fingerprint if its result
+        can still be checked, forgetting it otherwise"""
+        job_id = self.lookup(fingerprint)
+        if job_id is None:
+            return None
+        try:
+            result = check_result(job_id)
+        except Exception as e:
+            logger.info(f"Not reattaching to job {job_id}, resubmitting: {e}")
+            self.forget(fingerprint)
+            return None
+        if job_failed(result):
+            logger.info(f"Not reattaching to failed job {job_id}, resubmitting")
+            self.forget(fingerprint)
+            return None
+        logger.info(f"Reattaching to job {job_id}")
+        return job_id
+
+    async def async_reattach(self, fingerprint: str, check_result) -> Optional[str]:
+        """Asynchronous version of reattach, check_result is a coroutine
+        function. The database is accessed off the event loop."""
+        job_id = await run_in_thread(self.lookup, fingerprint)
+        if job_id is None:
+            return None
+        try:
+            result = await check_result(job_id)
+        except Exception as e:
+            logger.info(f"Not reattaching to job {job_id}, resubmitting: {e}")
+            await run_in_thread(self.forget, fingerprint)
+            return None
+        if job_failed(result):
+            logger.info(f"Not reattaching to failed job {job_id}, resubmitting")
+            await run_in_thread(self.forget, fingerprint)
+            return None
+        logger.info(f"Reattaching to job {job_id}")
+        return job_id
+
+
+job_registries: Dict[str, JobRegistry] = {}
+
+
+def get_job_registry() -> Optional[JobRegistry]:
+    """Return the registry at lamini.job_registry_path, None if it isn't set"""
+    path = lamini.job_registry_path
+    if not path:
+        return None
+    registry = job_registries.get(path)
+    if registry is None:
+        registry = JobRegistry(path)
+        job_registries[path] = registry
+    return registry
+
+
+def finish_job(job_id: str) -> None:
+    """Forget a job once its result was seen finished, or once it failed or
+    was given up on, so that it is never reattached to"""
+    registry = get_job_registry()
+    if registry is not None:
+        registry.finish(job_id)
+
+
+async def async_finish_job(job_id: str) -> None:
+    """Asynchronous version of finish_job"""
+    if not lamini.job_registry_path:
+        return
+    registry = await run_in_thread(get_job_registry)
+    if registry is not None:
+        await run_in_thread(registry.finish, job_id)
+
+
+def find_job(
+    kind: str,
+    api_url: str,
+    request: Dict[str, Any],
+    check_result: Callable[[str], Dict[str, Any]],
+) -> Optional[Dict[str, Any]]:
+    """Submit response of a recorded job for request to reattach to, None if
+    there is none or the registry is disabled"""
+    registry = get_job_registry()
+    if registry is None:
+        return None
+    job_id = registry.reattach(
+        registry.fingerprint(kind, api_url, request), check_result
+    )
+    return None if job_id is None else {"id": job_id}
+
+
+async def async_find_job(
+    kind: str, api_url: str, request: Dict[str, Any], check_result
+) -> Optional[Dict[str, Any]]:
+    """Asynchronous version of find_job, check_result is a coroutine function"""
+    if not lamini.job_registry_path:
+        return None
+    registry = await run_in_thread(get_job_registry)
+    if registry is None:
+        return None
+    job_id = await registry.async_reattach(
+        registry.fingerprint(kind, api_url, request), check_result
+    )
+    return None if job_id is None else {"id": job_id}
+
+
+def record_job(
+    kind: str, api_url: str, request: Dict[str, Any], resp: Dict[str, Any]
+) -> None:
+    """Record the job submitted for request, if the registry is enabled"""
+    registry = get_job_registry()
+    if registry is not None:
+        registry.record(registry.fingerprint(kind, api_url, request), kind, resp["id"])
+
+
+async def async_record_job(
+    kind: str, api_url: str, request: Dict[str, Any], resp: Dict[str, Any]
+) -> None:
+    """Asynchronous version of record_job"""
+    if not lamini.job_registry_path:
+        return
+    registry = await run_in_thread(get_job_registry)
+    if registry is not None:
+        await run_in_thread(
+            registry.record,
+            registry.fingerprint(kind, api_url, request),
+            kind,
+            resp["id"],
+        )
@@ -86,12 +86,7 @@ class Reservations:
             but execution is continued.
         """
         if lamini.bypass_reservation:
-            self.current_reservation = None
-            self.capacity_remaining = 0
-            self.dynamic_max_batch_size = 0
-            self.capacity_needed = 0
-            self.model_name = model_name
-            self.max_tokens = None
+            self.clear_reservation(model_name)
             return
 
         try:
@@ -102,35 +97,86 @@ class Reservations:
                 self.api_key,
                 self.api_prefix,
                 "post",
-                {
-                    "capacity": max(capacity, batch_size),
-                    "model_name": model_name,
-                    "max_tokens": max_tokens,
-                    "batch_size": batch_size,
-                },
+                self.reservation_request(capacity, model_name, batch_size, max_tokens),
             )
-            logger.info("Made initial reservation " + str(reservation))
-            self.current_reservation = reservation
-            self.capacity_needed = capacity
-            self.model_name = model_name
-            self.max_tokens = max_tokens
-            self.capacity_remaining = reservation["capacity_remaining"]
-            self.dynamic_max_batch_size = min(
-                reservation["dynamic_max_batch_size"], reservation["capacity_remaining"]
+            self.set_reservation(
+                reservation, capacity, model_name, batch_size, max_tokens
             )
-            if self.variable_capacity:
-                self.capacity_needed = self.dynamic_max_batch_size * lamini.max_workers
-            self.is_working = True
-            self.batch_size = batch_size
+        except Exception as e:
+            logger.warning(f"Error making reservation, continuing without one. {e}")
+            self.clear_reservation(model_name)
+
+    async def async_initialize_reservation(
+        self,
+        client: aiohttp.ClientSession,
+        capacity: int,
+        model_name: str,
+        batch_size: int,
+        max_tokens: Optional[int],
+    ) -> None:
+        """Asynchronous version of initialize_reservation, over client"""
+        if lamini.bypass_reservation:
+            self.clear_reservation(model_name)
+            return
 
+        try:
+            logger.info(
+                f"Attempt reservation {capacity} {model_name} {batch_size} {max_tokens}"
+            )
+            reservation = await make_async_web_request(
+                client,
+                self.api_key,
+                self.api_prefix,
+                "post",
+                self.reservation_request(capacity, model_name, batch_size, max_tokens),
+            )
+            self.set_reservation(
+                reservation, capacity, model_name, batch_size, max_tokens
+            )
         except Exception as e:
             logger.warning(f"Error making reservation, continuing without one. {e}")
-            self.current_reservation = None
-            self.capacity_remaining = 0
-            self.dynamic_max_batch_size = 0
-            self.capacity_needed = 0
-            self.model_name = model_name
-            self.max_tokens = None
+            self.clear_reservation(model_name)
+
+    @staticmethod
+    def reservation_request(
+        capacity: int, model_name: str, batch_size: int, max_tokens: Optional[int]
+    ) -> dict:
+        return {
+            "capacity": max(capacity, batch_size),
+            "model_name": model_name,
+            "max_tokens": max_tokens,
+            "batch_size": batch_size,
+        }
+
+    def set_reservation(
+        self,
+        reservation: dict,
+        capacity: int,
+        model_name: str,
+        batch_size: int,
+        max_tokens: Optional[int],
+    ) -> None:
+        logger.info("Made initial reservation " + str(reservation))
+        self.current_reservation = reservation
+        self.capacity_needed = capacity
+        self.model_name = model_name
+        self.max_tokens = max_tokens
+        self.capacity_remaining = reservation["capacity_remaining"]
+        self.dynamic_max_batch_size = min(
+            reservation["dynamic_max_batch_size"], reservation["capacity_remaining"]
+        )
+        if self.variable_capacity:
+            self.capacity_needed = self.dynamic_max_batch_size * lamini.max_workers
+        self.is_working = True
+        self.batch_size = batch_size
+
+    def clear_reservation(self, model_name: str) -> None:
+        self.current_reservation = None
+        self.capacity_remaining = 0
+        self.dynamic_max_batch_size = 0
+        self.capacity_needed = 0
+        self.model_name = model_name
+        self.max_tokens = None
 
     def pause_for_reservation_start(self) -> None:
         """Barrier until specified start time for the reservation
@@ -221,7 +221,7 @@ class LaminiClassifier:
 
         embed = Embedding(self.config)
         embeddings = embed.generate(examples)
-        return [embedding[0] for embedding in embeddings]
+        return list(embeddings)
 
     def predict_proba(self, text):
         return self.logistic_regression.predict_proba(self.get_embeddings(text))
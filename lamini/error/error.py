@@ -48,3 +48,7 @@ class RequestTimeoutError(LaminiError):
 
 class OutdatedServerError(LaminiError):
     """Outdated Server Version"""
+
+
+class StreamingUnavailableError(LaminiError):
+    """The server does not push results for this request"""
@@ -9,6 +9,45 @@ from lamini.api.utils.reservations import Reservations
 logger = logging.getLogger(__name__)
 
 
+class BatchFillStats:
+    """Counts how full the chunks formed by chunks() and async_chunks() are
+
+    A chunk is flushed either because it is "full", because max_wait passed
+    since its first element arrived ("timeout"), or because the iterator
+    ended ("end").
+    """
+
+    def __init__(self):
+        self.batches = 0
+        self.items = 0
+        self.capacity = 0
+        self.flushes = {"full": 0, "timeout": 0, "end": 0}
+
+    def record(self, items: int, size: int, reason: str):
+        self.batches += 1
+        self.items += items
+        self.capacity += size
+        self.flushes[reason] += 1
+
+    @property
+    def mean_batch_size(self) -> float:
+        return self.items / self.batches if self.batches else 0.0
+
+    @property
+    def fill_ratio(self) -> float:
+        """Share of the maximum batch sizes that was filled."""
+        return self.items / self.capacity if self.capacity else 0.0
+
+    def as_dict(self) -> dict:
+        return {
+            "batches": self.batches,
+            "items": self.items,
+            "mean_batch_size": self.mean_batch_size,
+            "fill_ratio": self.fill_ratio,
+            "flushes": dict(self.flushes),
+        }
+
+
 class BaseGenerationQueue:
     def __init__(
         self,
@@ -55,9 +94,31 @@ class BaseGenerationQueue:
         """
         return int(lamini.batch_size)
 
+    def get_batch_max_wait(self):
+        """Return the longest time a batch waits to fill up
+
+        Parameters
+        ----------
+        None
+
+        Returns
+        -------
+        Optional[float]
+            lamini.batch_max_wait, None if batches wait until they are full
+        """
+        if lamini.batch_max_wait is None:
+            return None
+        return float(lamini.batch_max_wait)
+
     def get_retry_limit(self):
         return int(lamini.retry_limit)
 
+    def get_retry_base_delay(self):
+        return float(lamini.retry_base_delay)
+
+    def get_retry_max_delay(self):
+        return float(lamini.retry_max_delay)
+
     def get_dynamic_max_batch_size(self):
         if lamini.static_batching:
             return self.get_batch_size()
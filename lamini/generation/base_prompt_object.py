@@ -1,14 +1,53 @@
 class PromptObject:
-    def __init__(self, prompt: str, response: str = None, data: dict = {}) -> None:
+    # Millions of prompts can be in flight in a pipeline, so instances have no
+    # __dict__, and error and data are only allocated when first used.
+    __slots__ = (
+        "prompt",
+        "response",
+        "_error",
+        "_data",
+        "orig_prompt",
+        "finish_reason",
+        "sequence",
+    )
+
+    def __init__(self, prompt: str, response: str = None, data: dict = None) -> None:
         assert isinstance(prompt, str)
         #        assert isinstance(data, dict)
         self.prompt = prompt
         self.response = response
-        self.error = []
-        self.data = data
-        # Records the input prompt to the first node of the pipeline.
+        self._error = None
+        self._data = data
+        # Records the input prompt to the first node of the pipeline. It is
+        # shared by reference by every prompt derived from that input.
         self.orig_prompt: PromptObject = None
         self.finish_reason = None
+        # Position in the pipeline input, only set for ordered pipeline calls.
+        self.sequence = None
+
+    @property
+    def error(self) -> list:
+        if self._error is None:
+            self._error = []
+        return self._error
+
+    @error.setter
+    def error(self, error: list):
+        self._error = error
+
+    def has_error(self) -> bool:
+        """Whether an error was recorded, without allocating the error list."""
+        return bool(self._error)
+
+    @property
+    def data(self) -> dict:
+        if self._data is None:
+            self._data = {}
+        return self._data
+
+    @data.setter
+    def data(self, data: dict):
+        self._data = data
 
     def get_prompt(self) -> str:
         prompt = self.prompt
@@ -19,6 +58,23 @@ class PromptObject:
         assert isinstance(self.prompt, str)
         return f"PromptObject(prompt={self.prompt}, response={self.response}, data={self.data}, error={self.error}, id={id(self)})"
 
+    # __dict__ is overridden below, so pickle and copy need the attributes
+    # spelled out, e.g. to run node hooks in a process pool.
+    def __getstate__(self):
+        return {
+            "prompt": self.prompt,
+            "response": self.response,
+            "error": self._error,
+            "data": self._data,
+            "orig_prompt": self.orig_prompt,
+            "finish_reason": self.finish_reason,
+            "sequence": self.sequence,
+        }
+
+    def __setstate__(self, state):
+        for name, value in state.items():
+            setattr(self, name, value)
+
     def __dict__(self):
         return {
             "prompt": self.prompt,
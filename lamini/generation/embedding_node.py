@@ -1,6 +1,10 @@
+import asyncio
 import logging
 from typing import AsyncIterator, Iterator, Optional, Union
 
+import lamini
+from lamini.api.synchronize import run_in_thread
+from lamini.api.utils.embedding_cache import EmbeddingCache, get_embedding_cache
 from lamini.generation.base_prompt_object import PromptObject
 from lamini.generation.generation_node import GenerationNode
 
@@ -70,7 +74,74 @@ class EmbeddingNode(GenerationNode):
             prompt=prompt,
             model_name=model_name or self.model_name,
         )
-        return self.async_inference_queue.submit(req_data)
+        cache = get_embedding_cache()
+        if cache is not None:
+            return self.generate_with_cache(req_data, cache)
+        return self.async_inference_queue.submit(
+            req_data, profiler=self.profiler, batch_fill_stats=self.batch_fill_stats
+        )
+
+    async def generate_with_cache(self, req_data: dict, cache: EmbeddingCache):
+        """Answer prompts from the embedding cache, submitting only the misses
+        and caching their embeddings. Hits are yielded as soon as they are
+        found, interleaved with the results of the misses."""
+        model_name = req_data["model_name"]
+        prompts = req_data["prompt"]
+        # Hits and results of the misses, in the order they are ready, then
+        # done. Bounded, so that hits don't read ahead of the consumer.
+        results = asyncio.Queue(maxsize=int(lamini.batch_size))
+        done = object()
+
+        async def misses():
+            if isinstance(prompts, AsyncIterator):
+                iterator = prompts
+            else:
+                iterator = aiter_sync(prompts)
+            async for a in iterator:
+                if a is None:
+                    continue
+                # The cache files are read off the event loop.
+                embedding = (
+                    await run_in_thread(cache.lookup, model_name, [a.get_prompt()])
+                )[0]
+                if embedding is None:
+                    yield a
+                else:
+                    a.response = embedding
+                    await results.put(a)
+
+        async def submit_misses():
+            cancelled = False
+            try:
+                async for a in self.async_inference_queue.submit(
+                    dict(req_data, prompt=misses()),
+                    profiler=self.profiler,
+                    batch_fill_stats=self.batch_fill_stats,
+                ):
+                    if a is not None and not a.has_error() and a.response is not None:
+                        await run_in_thread(
+                            cache.put, model_name, [a.get_prompt()], [a.response]
+                        )
+                    await results.put(a)
+            except asyncio.CancelledError:
+                cancelled = True
+                raise
+            finally:
+                # Cancelled once the consumer stopped, nobody reads the queue.
+                if not cancelled:
+                    await results.put(done)
+
+        producer = asyncio.create_task(submit_misses())
+        try:
+            while True:
+                a = await results.get()
+                if a is done:
+                    break
+                yield a
+            # Raise errors of the submission
+            await producer
+        finally:
+            producer.cancel()
 
     def make_llm_req_map(
         self,
@@ -101,3 +172,8 @@ class EmbeddingNode(GenerationNode):
         req_data["prompt"] = prompt
         req_data["type"] = "embedding"
         return req_data
+
+
+async def aiter_sync(iterator: Iterator):
+    for item in iterator:
+        yield item
@@ -2,14 +2,23 @@ import logging
 from typing import AsyncIterator, Generator, Iterator, Optional, Union
 
 from lamini.api.utils.iterators import async_iter
+from lamini.generation.base_generation_queue import BatchFillStats
 from lamini.generation.base_node_object import BaseGenerationNode
 from lamini.generation.base_prompt_object import PromptObject
+from lamini.generation.hook_executor import HookExecutor
+from lamini.generation.pipeline_profiler import profile_iter, profile_span
+from lamini.generation.reorder_buffer import inherit_sequence, release_sequence
 from lamini.generation.token_optimizer import TokenOptimizer
 
 logger = logging.getLogger(__name__)
 
 
 class GenerationNode(BaseGenerationNode):
+    # Set to "thread" or "process" in a subclass to run CPU heavy preprocess
+    # and postprocess hooks in a pool of hook_max_workers, off the event loop.
+    hook_executor_type: Optional[str] = None
+    hook_max_workers: Optional[int] = None
+
     def __init__(
         self,
         model_name: str,
@@ -22,6 +31,9 @@ class GenerationNode(BaseGenerationNode):
         self.max_new_tokens = max_new_tokens
         self.failed_prompts = []
         self.async_inference_queue = None
+        self.profiler = None
+        self.hook_executor = None
+        self.batch_fill_stats = BatchFillStats()
 
     def __call__(self, prompt, *args, **kwargs):
         prompt = self.transform_prompt(prompt)
@@ -43,7 +55,12 @@ class GenerationNode(BaseGenerationNode):
             max_new_tokens=self.max_new_tokens,
         )
         assert self.async_inference_queue is not None
-        return self.async_inference_queue.submit(req_data, self.token_optimizer)
+        return self.async_inference_queue.submit(
+            req_data,
+            self.token_optimizer,
+            profiler=self.profiler,
+            batch_fill_stats=self.batch_fill_stats,
+        )
 
     def make_llm_req_map(
         self,
@@ -75,33 +92,31 @@ class GenerationNode(BaseGenerationNode):
         if isinstance(prompt_iterator, Iterator):
             prompt_iterator = async_iter(prompt_iterator)
 
-        async for a in prompt_iterator:
-            # For all the input PromptObject, keep a copy to the first prompt
-            # if it's not set yet.
-            def set_orig_prompt(
-                target_prompt: PromptObject, set_from_prompt: PromptObject
-            ):
-                if target_prompt.orig_prompt is None:
-                    target_prompt.orig_prompt = PromptObject(
-                        prompt=set_from_prompt.prompt, data=set_from_prompt.data
-                    )
-
-            set_orig_prompt(a, a)
-            if hasattr(self, "preprocess"):
-                mod_a = self.preprocess(a)
-                if isinstance(mod_a, Generator):
-                    for res in mod_a:
-                        if res is not None:
-                            assert isinstance(res, PromptObject)
-                            set_orig_prompt(res, a)
-                            yield res
-                    continue
-                if mod_a is not None:
-                    if a.orig_prompt is None:
-                        set_orig_prompt(mod_a, a)
-                    else:
-                        mod_a.orig_prompt = a.orig_prompt
-                    a = mod_a
+        # For all the input PromptObject, keep a copy to the first prompt
+        # if it's not set yet. The copy is shared by all derived prompts. The
+        # data dict of a prompt without data isn't allocated for the copy.
+        async def with_orig_prompt():
+            async for a in prompt_iterator:
+                if a.orig_prompt is None:
+                    a.orig_prompt = PromptObject(prompt=a.prompt, data=a._data)
+                yield a
+
+        async for a, mod_a in self.run_hook("preprocess", with_orig_prompt()):
+            if isinstance(mod_a, Generator):
+                mod_a = profile_iter(self.profiler, "preprocess", mod_a)
+                for position, res in enumerate(mod_a):
+                    if res is not None:
+                        assert isinstance(res, PromptObject)
+                        if res.orig_prompt is None:
+                            res.orig_prompt = a.orig_prompt
+                        inherit_sequence(res, a, position)
+                        yield res
+                release_sequence(a)
+                continue
+            if mod_a is not None:
+                mod_a.orig_prompt = a.orig_prompt
+                mod_a.sequence = a.sequence
+                a = mod_a
             assert isinstance(a, PromptObject)
             yield a
 
@@ -110,25 +125,87 @@ class GenerationNode(BaseGenerationNode):
 
         results: AsyncIterator returned from self.generate().
         """
-        async for a in prompt_async_iter:
-            assert a is not None
-            if a.response is None and len(a.error) > 0:
-                # Result from the generation call to remote LLM inference API
-                # failed, record the prompt.
-                self.failed_prompts.append(a)
-                continue
-            if hasattr(self, "postprocess"):
-                mod_a = self.postprocess(a)
-                if isinstance(mod_a, Generator):
-                    for res in mod_a:
-                        if res is not None:
-                            assert isinstance(res, PromptObject)
-                            # The original prompt was already recorded in the preprocess stage.
-                            res.orig_prompt = a.orig_prompt
-                            yield res
+
+        async def without_failed_prompts():
+            async for a in prompt_async_iter:
+                assert a is not None
+                if a.response is None and a.has_error():
+                    # Result from the generation call to remote LLM inference API
+                    # failed, record the prompt.
+                    self.failed_prompts.append(a)
+                    release_sequence(a)
                     continue
-                if mod_a is not None:
-                    mod_a.orig_prompt = a.orig_prompt
-                    a = mod_a
+                yield a
+
+        async for a, mod_a in self.run_hook("postprocess", without_failed_prompts()):
+            if isinstance(mod_a, Generator):
+                mod_a = profile_iter(self.profiler, "postprocess", mod_a)
+                for position, res in enumerate(mod_a):
+                    if res is not None:
+                        assert isinstance(res, PromptObject)
+                        # The original prompt was already recorded in the preprocess stage.
+                        res.orig_prompt = a.orig_prompt
+                        inherit_sequence(res, a, position)
+                        yield res
+                release_sequence(a)
+                continue
+            if mod_a is not None:
+                mod_a.orig_prompt = a.orig_prompt
+                mod_a.sequence = a.sequence
+                a = mod_a
             assert a is None or isinstance(a, PromptObject)
             yield a
+
+    async def run_hook(self, hook_name: str, prompts: AsyncIterator[PromptObject]):
+        """Yield every prompt with the result of calling the hook on it, or with
+        None if the node doesn't define the hook.
+
+        The hook runs on the event loop, unless the node sets hook_executor_type
+        to "thread" or "process". Then up to hook_max_workers calls run at once
+        in a thread or process pool, see HookExecutor. The pool is started on
+        the first call and kept until shutdown_hook_executor().
+        """
+        if not hasattr(self, hook_name):
+            async for a in prompts:
+                yield a, None
+            return
+
+        if self.hook_executor_type is None:
+            hook = getattr(self, hook_name)
+            async for a in prompts:
+                with profile_span(self.profiler, hook_name):
+                    mod_a = hook(a)
+                yield a, mod_a
+            return
+
+        if self.hook_executor is None:
+            self.hook_executor = HookExecutor(
+                self, self.hook_executor_type, self.hook_max_workers
+            )
+        async for a, mod_a in self.hook_executor.map(hook_name, prompts, self.profiler):
+            yield a, mod_a
+
+    def cancel_hook_calls(self):
+        """Cancel the hook calls left over by a pipeline call, keeping the
+        workers for the next one"""
+        if self.hook_executor is not None:
+            self.hook_executor.cancel()
+
+    def shutdown_hook_executor(self):
+        if self.hook_executor is not None:
+            self.hook_executor.shutdown()
+            self.hook_executor = None
+
+    def __del__(self):
+        # Set in __init__, which subclasses may not have called
+        if getattr(self, "hook_executor", None) is not None:
+            self.shutdown_hook_executor()
+
+    def __getstate__(self):
+        # Pickled to be sent to hook process pool workers, which only need the
+        # node's configuration and hooks.
+        state = self.__dict__.copy()
+        for name in ("async_inference_queue", "profiler", "hook_executor"):
+            state[name] = None
+        state["failed_prompts"] = []
+        return state
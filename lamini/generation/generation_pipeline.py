@@ -1,10 +1,16 @@
 import asyncio
 import logging
 import sys
-from typing import AsyncIterator, Iterator, Optional
+from typing import AsyncIterator, Iterator, Optional, Union
 
 import lamini
+from lamini.api.synchronize import in_background_loop, sync_iter
+from lamini.api.utils.iterators import async_iter
+from lamini.generation.base_generation_queue import BatchFillStats
 from lamini.generation.base_node_object import BaseGenerationNode
+from lamini.generation.generation_node import GenerationNode
+from lamini.generation.pipeline_profiler import PipelineProfiler
+from lamini.generation.reorder_buffer import ReorderBuffer
 
 logger = logging.getLogger(__name__)
 
@@ -34,6 +40,8 @@ class GenerationPipeline:
     async def __call(
         self,
         prompt: AsyncIterator,
+        reorder_buffer: Optional[ReorderBuffer] = None,
+        profiler: Optional[PipelineProfiler] = None,
     ) -> AsyncIterator:
         if sys.version_info >= (3, 10):
             logger.info("Using 3.10 InferenceQueue Interface")
@@ -50,9 +58,14 @@ class GenerationPipeline:
             raise Exception("Must use Python 3.10 or greater for this feature")
         model_names = []
         max_tokens = []
-        for _, val in vars(self).items():
+        self.profiler = profiler
+        for name, val in vars(self).items():
             if isinstance(val, BaseGenerationNode):
                 val.async_inference_queue = self.async_inference_queue
+                val.profiler = profiler.stage(name) if profiler is not None else None
+                # Fill stats cover the latest call, and stay readable after it
+                if isinstance(val, GenerationNode):
+                    val.batch_fill_stats = BatchFillStats()
                 try:
                     model_names.append(val.model_name)
                     max_tokens.append(val.max_tokens)
@@ -60,6 +73,8 @@ class GenerationPipeline:
                     continue
         assert len(model_names) > 0
         assert isinstance(prompt, Iterator) or isinstance(prompt, AsyncIterator)
+        if reorder_buffer is not None:
+            prompt = self.__number_prompts(prompt, reorder_buffer)
         iterator = self.forward(prompt)
         assert isinstance(iterator, AsyncIterator)
 
@@ -74,6 +89,8 @@ class GenerationPipeline:
             max_tokens=max_tokens,
         )
         self.reservation_api.pause_for_reservation_start()
+        if profiler is not None:
+            profiler.start()
 
         self.reservation_polling_task = asyncio.create_task(
             self.reservation_api.kickoff_reservation_polling(
@@ -82,48 +99,141 @@ class GenerationPipeline:
         )
         return iterator
 
+    async def __number_prompts(
+        self,
+        prompt: Union[Iterator, AsyncIterator],
+        reorder_buffer: ReorderBuffer,
+    ) -> AsyncIterator:
+        if isinstance(prompt, Iterator):
+            prompt = async_iter(prompt)
+        index = 0
+        async for p in prompt:
+            if p is None:
+                continue
+            # Backpressure, so the results held back stay within the window
+            if not reorder_buffer.has_room(index):
+                await reorder_buffer.wait_for_room(index)
+            reorder_buffer.admit(p, index)
+            index += 1
+            yield p
+
     async def __cleanup(self):
         self.reservation_api.is_working = False
         if self.reservation_polling_task is not None:
             self.reservation_polling_task.cancel()
         if self.reservation_api.polling_task is not None:
             self.reservation_api.polling_task.cancel()
-        await self.async_inference_queue.client.close()
+        # On the background loop of call_sync() the queue and its connections
+        # are reused by the next call, the loop closes them at exit.
+        if not in_background_loop():
+            await self.async_inference_queue.client.close()
+        # Hook workers are kept by their node for its next call
+        for val in vars(self).values():
+            if isinstance(val, GenerationNode):
+                val.cancel_hook_calls()
+        if self.profiler is not None:
+            self.profiler.stop()
+            self.profiler.report()
 
     async def call_with_result(
         self,
         prompt: AsyncIterator,
+        ordered: bool = False,
+        profiler: Optional[PipelineProfiler] = None,
     ):
-        iterator = await self.__call(prompt)
+        """Run the pipeline and return all of its results in a list.
+
+        If ordered is set, the results are sorted by the input prompt they were
+        derived from, prompts split from one input keep the order of the split.
+        If a profiler is given, it reports the time spent in each node when the
+        pipeline finishes.
+        """
+        reorder_buffer = ReorderBuffer(sys.maxsize) if ordered else None
+        iterator = await self.__call(prompt, reorder_buffer, profiler)
         finished = False
         results = []
-        while not finished:
-            try:
-                r = None
-                while r is None:
-                    r = await anext(iterator)
-            except StopAsyncIteration:
-                finished = True
-            else:
-                results.append(r)
-
-        await self.__cleanup()
+        try:
+            while not finished:
+                try:
+                    r = None
+                    while r is None:
+                        r = await anext(iterator)
+                except StopAsyncIteration:
+                    finished = True
+                else:
+                    if reorder_buffer is None:
+                        results.append(r)
+                    else:
+                        results.extend(reorder_buffer.push(r))
+
+            if reorder_buffer is not None:
+                results.extend(reorder_buffer.flush())
+        finally:
+            # Also stop the hook workers if a node raised.
+            if not finished and hasattr(iterator, "aclose"):
+                await iterator.aclose()
+            await self.__cleanup()
         return results
 
     async def call(
         self,
         prompt: AsyncIterator,
+        ordered: bool = False,
+        reorder_window: int = 1024,
+        profiler: Optional[PipelineProfiler] = None,
     ):
-        iterator = await self.__call(prompt)
+        """Run the pipeline and yield its results as they are completed.
+
+        If ordered is set, the results are yielded in the order of the input
+        prompts they were derived from instead. Input prompts are admitted up
+        to reorder_window past the oldest one whose results aren't yielded yet.
+        If a profiler is given, it reports the time spent in each node when the
+        pipeline finishes.
+        """
+        reorder_buffer = ReorderBuffer(reorder_window) if ordered else None
+        iterator = await self.__call(prompt, reorder_buffer, profiler)
         finished = False
-        while not finished:
-            try:
-                r = None
-                while r is None:
-                    r = await anext(iterator)
-            except StopAsyncIteration:
-                finished = True
-            else:
-                yield r
-
-        await self.__cleanup()
+        try:
+            while not finished:
+                try:
+                    r = None
+                    while r is None:
+                        r = await anext(iterator)
+                except StopAsyncIteration:
+                    finished = True
+                else:
+                    if reorder_buffer is None:
+                        yield r
+                    else:
+                        for ordered_r in reorder_buffer.push(r):
+                            yield ordered_r
+
+            if reorder_buffer is not None:
+                for ordered_r in reorder_buffer.flush():
+                    yield ordered_r
+        finally:
+            # Also clean up if the caller stops iterating early.
+            if not finished and hasattr(iterator, "aclose"):
+                await iterator.aclose()
+            await self.__cleanup()
+
+    def call_sync(
+        self,
+        prompt: Union[Iterator, AsyncIterator],
+        ordered: bool = False,
+        reorder_window: int = 1024,
+        profiler: Optional[PipelineProfiler] = None,
+    ) -> Iterator:
+        """Run the pipeline from synchronous code, yielding results like call().
+
+        The pipeline runs on the process wide background event loop, which keeps
+        the inference queue and its connections open for later calls.
+        """
+        return sync_iter(
+            self.call(
+                prompt,
+                ordered=ordered,
+                reorder_window=reorder_window,
+                profiler=profiler,
+            )
+        )
@@ -1,9 +1,26 @@
 import asyncio
 import functools
+import heapq
+import itertools
 import logging
+import math
+import random
+import time
 from typing import Any, AsyncIterator, Iterator, Optional, Tuple, TypeVar, Union
 
-from lamini.generation.base_generation_queue import BaseGenerationQueue
+from lamini.api.synchronize import (
+    close_session,
+    get_background_loop,
+    in_background_loop,
+)
+from lamini.error.error import (
+    APIUnprocessableContentError,
+    AuthenticationError,
+    ModelNotFound,
+    UserError,
+)
+from lamini.generation.base_generation_queue import BaseGenerationQueue, BatchFillStats
+from lamini.generation.pipeline_profiler import StageProfiler
 from lamini.generation.process_generation_batch import process_generation_batch
 from lamini.generation.token_optimizer import TokenOptimizer
 
@@ -13,37 +30,186 @@ logger = logging.getLogger(__name__)
 
 global_inference_queue = None
 
+# Errors that fail the same way on every retry, e.g. an invalid key or model.
+NON_RETRYABLE_ERRORS = (
+    AuthenticationError,
+    ModelNotFound,
+    UserError,
+    APIUnprocessableContentError,
+)
+
 
 def get_global_inference_queue(api_key, api_url):
     global global_inference_queue
-    if global_inference_queue is None or global_inference_queue.client.closed:
+    loop = asyncio.get_running_loop()
+    if (
+        global_inference_queue is None
+        or global_inference_queue.client.closed
+        or global_inference_queue.loop is not loop
+    ):
+        if global_inference_queue is not None:
+            # The queue of a previous loop, e.g. kept open by the BackgroundLoop
+            close_session(global_inference_queue.client, global_inference_queue.loop)
         global_inference_queue = GenerationQueue(api_key, api_url)
+        global_inference_queue.loop = loop
+        if in_background_loop():
+            # Kept open across calls on the background loop, see GenerationPipeline.
+            get_background_loop().register_session(global_inference_queue.client)
     return global_inference_queue
 
 
-class AppendableAsyncGenerator:
-    """Holds a async generator and a list, and prefer return elements in the list
+class RetryScheduler:
+    """Holds a async generator of batches and schedules failed batches for retry
+
+    Ready retries are returned before new batches from the generator, oldest first.
+    A failed batch is retried after an exponential backoff. A failed batch with
+    more than one prompt is split in half, so that a single bad prompt is isolated
+    after a few retries and the healthy prompts of the batch are not held back.
+    Every failed request counts as a retry of each of its prompts, and a single
+    prompt batch fails for good once its prompt reached the retry limit. A
+    failure of a larger batch can't be attributed to any one prompt, so it is
+    split instead, as long as the batch's request budget allows.
+
+    The retries of a batch and of the halves split from it share a budget of
+    retry_limit * (1 + ceil(log2(n))) requests for n prompts, enough to isolate
+    and retry a few bad prompts. Once the budget is used up the prompts of a
+    failing batch fail. Errors in NON_RETRYABLE_ERRORS fail the batch at once.
 
-    Always first returns elements from the list.
-    This allows different priorities between items.
-    E.g., failed item can be appended, so that they would be retried first.
+    The iteration only ends once the generator is exhausted and every batch
+    returned so far has been released with complete() or retry().
     """
 
-    def __init__(self, generator):
+    def __init__(
+        self, generator, base_delay: float, max_delay: float, retry_limit: int
+    ):
         self.generator = generator
-        self.appendlist = []
+        self.retry_limit = retry_limit
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        # Heap of (ready_time, sequence, batch), sequence keeps ties FIFO.
+        self.delayed = []
+        self.sequence = itertools.count()
+        self.in_flight = 0
+        self.generator_ended = False
+        self.next_batch = None
+        self.wakeup = asyncio.Event()
 
     def __aiter__(self):
         return self
 
     async def __anext__(self):
-        if len(self.appendlist):
-            return self.appendlist.pop()
-        next_val = await self.generator.__anext__()
-        return next_val
-
-    def append(self, item):
-        self.appendlist.append(item)
+        loop = asyncio.get_running_loop()
+        while True:
+            if self.delayed and self.delayed[0][0] <= loop.time():
+                return self._dispatch(heapq.heappop(self.delayed)[-1])
+
+            if self.next_batch is None and not self.generator_ended:
+                self.next_batch = asyncio.ensure_future(anext(self.generator))
+            if self.next_batch is None and not self.delayed and self.in_flight == 0:
+                raise StopAsyncIteration
+
+            # Wait for whichever comes first: a new batch from the generator,
+            # the earliest delayed retry, or a batch in flight being released.
+            timeout = None
+            if self.delayed:
+                timeout = max(0, self.delayed[0][0] - loop.time())
+            self.wakeup.clear()
+            wakeup = asyncio.ensure_future(self.wakeup.wait())
+            waiters = {wakeup}
+            if self.next_batch is not None:
+                waiters.add(self.next_batch)
+            try:
+                await asyncio.wait(
+                    waiters, timeout=timeout, return_when=asyncio.FIRST_COMPLETED
+                )
+            finally:
+                wakeup.cancel()
+
+            if self.next_batch is not None and self.next_batch.done():
+                next_batch, self.next_batch = self.next_batch, None
+                try:
+                    batch = next_batch.result()
+                except StopAsyncIteration:
+                    self.generator_ended = True
+                    continue
+                num_prompts = len(batch["batch"]["prompt"])
+                batch.setdefault("attempt", 0)
+                batch.setdefault("retries", [0] * num_prompts)
+                # Shared by the batch and the halves split from it
+                batch.setdefault(
+                    "budget",
+                    {
+                        "requests": self.retry_limit
+                        * (1 + math.ceil(math.log2(num_prompts)))
+                    },
+                )
+                return self._dispatch(batch)
+
+    def _dispatch(self, batch):
+        self.in_flight += 1
+        return batch
+
+    async def aclose(self):
+        """Cancel the pending read of the next batch, once the consumer
+        stopped"""
+        if self.next_batch is not None:
+            self.next_batch.cancel()
+            # Doesn't raise the CancelledError of next_batch
+            await asyncio.wait({self.next_batch})
+            self.next_batch = None
+
+    def complete(self, batch):
+        """Release a batch that succeeded."""
+        self.in_flight -= 1
+        self.wakeup.set()
+
+    def retry(self, batch, error: Optional[Exception] = None) -> list:
+        """Release a batch that failed with error and schedule its prompts for
+        retry.
+
+        Returns the prompts which won't be retried, because the error isn't
+        retryable, or they reached the retry limit, or the batch's request
+        budget is used up.
+        """
+        self.in_flight -= 1
+        self.wakeup.set()
+        prompts = batch["batch"]["prompt"]
+        if isinstance(error, NON_RETRYABLE_ERRORS):
+            logger.debug(f"Not retrying {len(prompts)} prompts after {error!r}")
+            return prompts
+        retries = [r + 1 for r in batch["retries"]]
+        budget = batch["budget"]
+        if len(prompts) == 1:
+            if retries[0] >= self.retry_limit or budget["requests"] < 1:
+                return prompts
+            budget["requests"] -= 1
+            self._schedule(batch, prompts, retries)
+            return []
+
+        if budget["requests"] < 2:
+            logger.debug(f"Retry budget used up, failing {len(prompts)} prompts")
+            return prompts
+        budget["requests"] -= 2
+        middle = len(prompts) // 2
+        self._schedule(batch, prompts[:middle], retries[:middle])
+        self._schedule(batch, prompts[middle:], retries[middle:])
+        return []
+
+    def _schedule(self, batch, prompts, retries):
+        attempt = batch["attempt"] + 1
+        delay = min(self.max_delay, self.base_delay * 2 ** (attempt - 1))
+        # Jitter keeps the halves of a split batch from retrying in lockstep.
+        delay *= random.uniform(0.5, 1.0)
+        retried = dict(batch)
+        retried["batch"] = dict(batch["batch"])
+        retried["batch"]["prompt"] = prompts
+        retried["retries"] = retries
+        retried["attempt"] = attempt
+        ready_time = asyncio.get_running_loop().time() + delay
+        heapq.heappush(self.delayed, (ready_time, next(self.sequence), retried))
+        logger.debug(
+            f"Retrying {len(prompts)} prompts in {delay:.2f}s, attempt {attempt}"
+        )
 
 
 class GenerationQueue(BaseGenerationQueue):
@@ -54,6 +220,8 @@ class GenerationQueue(BaseGenerationQueue):
         self,
         request: dict,
         token_optimizer: Optional[TokenOptimizer] = None,
+        profiler: Optional[StageProfiler] = None,
+        batch_fill_stats: Optional[BatchFillStats] = None,
     ):
         batches = self.form_batches(
             request,
@@ -61,26 +229,34 @@ class GenerationQueue(BaseGenerationQueue):
             self.api_key,
             self.api_prefix,
             token_optimizer,
+            profiler,
+            batch_fill_stats,
+        )
+        batches = RetryScheduler(
+            batches,
+            base_delay=self.get_retry_base_delay(),
+            max_delay=self.get_retry_max_delay(),
+            retry_limit=self.get_retry_limit(),
         )
-        batches = AppendableAsyncGenerator(batches)
         wrapped = return_args_and_exceptions(process_generation_batch)
         async_iterator = map_unordered(wrapped, batches, limit=self.get_max_workers())
 
-        async for result in async_iterator:
-            if isinstance(result[1], Exception):
-                logger.debug(f"exception: {result[1]}")
-                if len(result[0]["batch"]["prompt"][0].error) < self.get_retry_limit():
-                    logger.debug(
-                        f"Retrying up to {self.get_retry_limit()}, prompt: {result[0]}"
-                    )
-                    batches.append(result[0])
-                    # Retried prompt batch is not yielded.
-                    # They will eventually be yielded if 1) succeed within retry limit
-                    # or fail even after retry.
+        try:
+            async for result in async_iterator:
+                if isinstance(result[1], Exception):
+                    logger.debug(f"exception: {result[1]}")
+                    # Retried prompts are not yielded. They will eventually be yielded
+                    # if 1) succeed within retry limit or fail even after retry.
+                    for elem in batches.retry(result[0], result[1]):
+                        yield elem
                     continue
 
-            for elem in result[0]["batch"]["prompt"]:
-                yield elem
+                batches.complete(result[0])
+                for elem in result[0]["batch"]["prompt"]:
+                    yield elem
+        finally:
+            await async_iterator.aclose()
+            await batches.aclose()
 
     def combine_results(self, results):
         results = dict(sorted(results.items()))
@@ -97,9 +273,18 @@ class GenerationQueue(BaseGenerationQueue):
         key,
         api_prefix,
         token_optimizer: Optional[TokenOptimizer],
+        profiler: Optional[StageProfiler] = None,
+        batch_fill_stats: Optional[BatchFillStats] = None,
     ):
         batch_size_func = self.get_dynamic_max_batch_size
-        async for prompt in next_n_w_step_func(request["prompt"], batch_size_func):
+        prompts = next_n_w_step_func(
+            request["prompt"],
+            batch_size_func,
+            self.get_batch_max_wait(),
+            batch_fill_stats,
+            profiler,
+        )
+        async for prompt in prompts:
             batch = request.copy()
             batch["prompt"] = prompt
             if token_optimizer is not None and "max_new_tokens" in batch:
@@ -115,15 +300,22 @@ class GenerationQueue(BaseGenerationQueue):
                 "batch": batch,
                 "client": client,
                 "reservation_api": self.reservation_api,
+                "profiler": profiler,
             }
 
 
-async def next_n_w_step_func(iterator: Union[AsyncIterator, Iterator], step_func):
+async def next_n_w_step_func(
+    iterator: Union[AsyncIterator, Iterator],
+    step_func,
+    max_wait: Optional[float] = None,
+    stats: Optional[BatchFillStats] = None,
+    profiler: Optional[StageProfiler] = None,
+):
     if isinstance(iterator, AsyncIterator):
-        async for x in async_chunks(iterator, step_func):
+        async for x in async_chunks(iterator, step_func, max_wait, stats, profiler):
             yield x
     elif isinstance(iterator, Iterator):
-        for x in chunks(iterator, step_func):
+        for x in chunks(iterator, step_func, max_wait, stats, profiler):
             yield x
     else:
         raise TypeError("iterator must be an iterator or an async iterator")
@@ -139,7 +331,11 @@ async def map_unordered(func, iterable, *, limit):
 
 
 async def limit_concurrency(aws, limit):
-    """Yields up-to a number of limit items from aws."""
+    """Yields up-to a number of limit items from aws.
+
+    The next item of an async aws is awaited alongside the pending items, so
+    aws may block until one of the yielded items is handled, e.g. RetryScheduler.
+    """
     try:
         aws = aiter(aws)
         is_async = True
@@ -149,23 +345,45 @@ async def limit_concurrency(aws, limit):
 
     aws_ended = False
     pending = set()
+    next_aw = None
 
-    # TODO: there is a bug here, see https://github.com/lamini-ai/lamini-platform/issues/2899
-    while pending or not aws_ended:
-        while len(pending) < limit and not aws_ended:
-            try:
-                aw = await anext(aws) if is_async else next(aws)
-            except StopAsyncIteration if is_async else StopIteration:
-                aws_ended = True
-            else:
+    try:
+        while pending or not aws_ended:
+            while len(pending) < limit and not aws_ended:
+                if is_async:
+                    if next_aw is None:
+                        next_aw = asyncio.ensure_future(anext(aws))
+                    if not next_aw.done():
+                        break
+                    try:
+                        aw = next_aw.result()
+                    except StopAsyncIteration:
+                        aws_ended = True
+                        continue
+                    finally:
+                        next_aw = None
+                else:
+                    try:
+                        aw = next(aws)
+                    except StopIteration:
+                        aws_ended = True
+                        continue
                 pending.add(asyncio.ensure_future(aw))
 
-        if not pending:
-            return
+            waiters = set(pending)
+            if next_aw is not None:
+                waiters.add(next_aw)
+            if not waiters:
+                return
 
-        done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
-        while done:
-            yield done.pop()
+            done, _ = await asyncio.wait(waiters, return_when=asyncio.FIRST_COMPLETED)
+            done.discard(next_aw)
+            pending -= done
+            while done:
+                yield done.pop()
+    finally:
+        if next_aw is not None:
+            next_aw.cancel()
 
 
 def return_args_and_exceptions(func) -> Tuple[Any, Any]:
@@ -192,31 +410,63 @@ async def arange(start, stop=None, step=1):
 def chunks(
     iterator: Iterator[T],
     size_fn,
+    max_wait: Optional[float] = None,
+    stats: Optional[BatchFillStats] = None,
+    profiler: Optional[StageProfiler] = None,
 ) -> Iterator[list[T]]:
-    """Yield successive n-sized chunks from lst."""
+    """Yield successive n-sized chunks from lst.
+
+    If max_wait is set, a chunk is also yielded once max_wait seconds passed
+    since its first element. As next() can't be interrupted, this is only
+    checked between elements.
+
+    A profiler records the "batch_wait" of every chunk, from its first element
+    to the chunk being yielded.
+    """
     finished = False
 
     while not finished:
         results: list[T] = []
         size = size_fn()
+        deadline = None
+        first_time = None
+        reason = "full"
 
         for _ in range(size):
+            if deadline is not None and time.monotonic() >= deadline:
+                reason = "timeout"
+                break
             try:
                 result = None
                 while result is None:
                     result = next(iterator)
             except StopIteration:
                 finished = True
+                reason = "end"
+                break
             else:
                 results.append(result)
+                if first_time is None:
+                    first_time = time.perf_counter()
+                if deadline is None and max_wait is not None:
+                    deadline = time.monotonic() + max_wait
 
         if results:
+            if stats is not None:
+                stats.record(len(results), size, reason)
+            if profiler is not None:
+                profiler.record(
+                    "batch_wait", first_time, time.perf_counter(), len(results)
+                )
             yield results
 
 
 async def async_chunks(
     async_iterator: AsyncIterator[T],
     size_fn,
+    max_wait: Optional[float] = None,
+    stats: Optional[BatchFillStats] = None,
+    profiler: Optional[StageProfiler] = None,
 ) -> AsyncIterator[list[T]]:
     """Generate chunks from an asynchronous sequence.
 
@@ -224,22 +474,62 @@ async def async_chunks(
     The chunk can't contain more than ``size`` elements.
     The last chunk might contain less than ``size`` elements,
     but can't be empty.
+
+    If max_wait is set, a chunk is also yielded once max_wait seconds passed
+    since its first element arrived, even if it isn't full. The element being
+    awaited at that point is kept for the next chunk.
+
+    A profiler records the "batch_wait" of every chunk, from its first element
+    arriving to the chunk being yielded.
     """
+    loop = asyncio.get_running_loop()
     finished = False
+    # Pending anext() of async_iterator, carried over to the next chunk when
+    # a chunk times out, as cancelling it would close async_iterator.
+    next_result = None
 
     while not finished:
         results: list[T] = []
         size = size_fn()
         assert size != 0
-        for _ in range(size):
+        deadline = None
+        first_time = None
+        reason = "full"
+        while len(results) < size:
             try:
-                result = None
-                while result is None:
-                    result = await anext(async_iterator)
+                if deadline is None:
+                    if next_result is None:
+                        result = await anext(async_iterator)
+                    else:
+                        result = await next_result
+                        next_result = None
+                else:
+                    if next_result is None:
+                        next_result = asyncio.ensure_future(anext(async_iterator))
+                    timeout = max(0, deadline - loop.time())
+                    done, _ = await asyncio.wait({next_result}, timeout=timeout)
+                    if not done:
+                        reason = "timeout"
+                        break
+                    result = next_result.result()
+                    next_result = None
             except StopAsyncIteration:
                 finished = True
-            else:
-                results.append(result)
+                reason = "end"
+                break
+            if result is None:
+                continue
+            results.append(result)
+            if first_time is None:
+                first_time = time.perf_counter()
+            if deadline is None and max_wait is not None:
+                deadline = loop.time() + max_wait
 
         if results:
+            if stats is not None:
+                stats.record(len(results), size, reason)
+            if profiler is not None:
+                profiler.record(
+                    "batch_wait", first_time, time.perf_counter(), len(results)
+                )
             yield results
@@ -0,0 +1,168 @@
+import asyncio
+import collections
+import copy
+import logging
+import os
+import pickle
+import time
+from concurrent.futures import Executor, ProcessPoolExecutor, ThreadPoolExecutor
+from typing import AsyncIterator, Generator, Optional
+
+from lamini.generation.base_prompt_object import PromptObject
+from lamini.generation.pipeline_profiler import StageProfiler
+
+logger = logging.getLogger(__name__)
+
+# The node whose hooks a process pool worker runs, see init_process_worker().
+worker_node = None
+
+
+def init_process_worker(pickled_node: bytes):
+    global worker_node
+    worker_node = pickle.loads(pickled_node)
+
+
+def run_hook(node, hook_name: str, prompt: PromptObject):
+    """Call a hook in an executor worker. Generators returned by the hook are
+    exhausted in the worker, so none of the hook's work is left to the loop."""
+    result = getattr(node, hook_name)(prompt)
+    if isinstance(result, Generator):
+        return list(result), True, prompt
+    return result, False, prompt
+
+
+def run_hook_in_process(hook_name: str, prompt: PromptObject):
+    return run_hook(worker_node, hook_name, prompt)
+
+
+class HookExecutor:
+    """Runs the preprocess and postprocess hooks of a node off the event loop
+
+    Up to max_workers hook calls run concurrently, in a thread pool or in a
+    process pool. Results are returned in input order.
+
+    The pool is created once per node and reused by its calls. In a process
+    pool the hooks get a copy of the prompt and of the node, which is sent to
+    each worker once, when the pool starts. A hook returning None therefore hands back
+    the copy, including any in place changes. The copy is sent without
+    orig_prompt and sequence, the node restores them from the original prompt.
+
+    Parameters
+    ----------
+    node: GenerationNode
+        Node whose hooks to run
+
+    executor_type: str
+        "thread" or "process"
+
+    max_workers: Optional[int] = None
+        Number of workers, defaults to the number of CPUs
+    """
+
+    def __init__(self, node, executor_type: str, max_workers: Optional[int] = None):
+        max_workers = max_workers or os.cpu_count() or 1
+        if executor_type == "thread":
+            self.executor: Executor = ThreadPoolExecutor(max_workers=max_workers)
+        elif executor_type == "process":
+            self.executor = ProcessPoolExecutor(
+                max_workers=max_workers,
+                initializer=init_process_worker,
+                # Pickled, as the worker processes keep their arguments, which
+                # would keep the node, and its pool, alive
+                initargs=(pickle.dumps(node),),
+            )
+        else:
+            raise ValueError(
+                f"hook_executor_type must be 'thread' or 'process', got {executor_type}"
+            )
+        self.node = node
+        self.executor_type = executor_type
+        # Keep every worker busy while finished results wait to be consumed.
+        self.max_in_flight = 2 * max_workers
+        # Hook calls submitted and not finished yet, cancelled on shutdown.
+        self.futures = set()
+
+    def submit(self, hook_name: str, prompt: PromptObject) -> asyncio.Future:
+        loop = asyncio.get_running_loop()
+        if self.executor_type == "thread":
+            future = loop.run_in_executor(
+                self.executor, run_hook, self.node, hook_name, prompt
+            )
+        else:
+            prompt = copy.copy(prompt)
+            prompt.orig_prompt = None
+            prompt.sequence = None
+            future = loop.run_in_executor(
+                self.executor, run_hook_in_process, hook_name, prompt
+            )
+        self.futures.add(future)
+        future.add_done_callback(self.futures.discard)
+        return future
+
+    async def map(
+        self,
+        hook_name: str,
+        prompts: AsyncIterator[PromptObject],
+        profiler: Optional[StageProfiler] = None,
+    ):
+        """Yield every prompt with the result of its hook call, in input order."""
+        pending = collections.deque()
+        next_prompt = None
+        prompts_ended = False
+        try:
+            while True:
+                if (
+                    next_prompt is None
+                    and not prompts_ended
+                    and len(pending) < self.max_in_flight
+                ):
+                    next_prompt = asyncio.ensure_future(anext(prompts))
+                waiters = set()
+                if next_prompt is not None:
+                    waiters.add(next_prompt)
+                if pending:
+                    waiters.add(pending[0][1])
+                if not waiters:
+                    return
+                await asyncio.wait(waiters, return_when=asyncio.FIRST_COMPLETED)
+
+                if next_prompt is not None and next_prompt.done():
+                    try:
+                        a = next_prompt.result()
+                    except StopAsyncIteration:
+                        prompts_ended = True
+                    else:
+                        pending.append(
+                            (a, self.submit(hook_name, a), time.perf_counter())
+                        )
+                    next_prompt = None
+
+                while pending and pending[0][1].done():
+                    a, future, start = pending.popleft()
+                    result, is_generator, hook_prompt = future.result()
+                    if profiler is not None:
+                        profiler.record(hook_name, start, time.perf_counter(), 1)
+                    if is_generator:
+                        result = (res for res in result)
+                    elif result is None and hook_prompt is not a:
+                        # The hook changed the copy of the prompt in a worker process.
+                        result = hook_prompt
+                    yield a, result
+        finally:
+            # The consumer stopped early, nobody reads the outstanding results.
+            for _, future, _ in pending:
+                future.cancel()
+            if next_prompt is not None:
+                next_prompt.cancel()
+                # Doesn't raise the CancelledError of next_prompt
+                await asyncio.wait({next_prompt})
+
+    def cancel(self):
+        """Cancel the hook calls that haven't started"""
+        for future in list(self.futures):
+            future.cancel()
+
+    def shutdown(self):
+        """Cancel the hook calls that haven't started and stop the workers"""
+        self.cancel()
+        self.executor.shutdown(wait=False, cancel_futures=True)
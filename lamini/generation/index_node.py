@@ -1,9 +1,14 @@
 import logging
-from typing import AsyncIterator, Generator, Optional
+import json
+from typing import Any, AsyncIterator, Callable, Dict, Generator, List, Optional, Union
 
+import lamini
+import numpy as np
 from lamini.generation.base_prompt_object import PromptObject
 from lamini.generation.embedding_node import EmbeddingNode
+from lamini.generation.reorder_buffer import inherit_sequence, release_sequence
 from lamini.index.lamini_index import LaminiIndex
+from lamini.index.sharded_index import ShardedLaminiIndex
 
 logger = logging.getLogger(__name__)
 
@@ -11,15 +16,24 @@ logger = logging.getLogger(__name__)
 class IndexNode(EmbeddingNode):
     def __init__(
         self,
-        index: LaminiIndex,
+        index: Union[LaminiIndex, ShardedLaminiIndex],
         index_top_k: int = 1,
         model_name: Optional[str] = None,
         max_tokens: Optional[int] = None,
+        index_batch_size: Optional[int] = None,
+        index_filter: Union[
+            None, Dict[str, Any], Callable[[PromptObject], Optional[Dict[str, Any]]]
+        ] = None,
     ):
         super(IndexNode, self).__init__(model_name=model_name)
         self.max_tokens = max_tokens
         self.index = index
         self.index_top_k = index_top_k
+        # Prompts searched in one index call, see query_index
+        self.index_batch_size = index_batch_size or lamini.batch_size
+        # Metadata filter of the search, or a function of the prompt
+        # returning it, e.g. lambda prompt: {"tenant": prompt.data["tenant"]}
+        self.index_filter = index_filter
 
     def __call__(self, prompt, *args, **kwargs):
         prompt = self.transform_prompt(prompt)
@@ -28,26 +42,83 @@ class IndexNode(EmbeddingNode):
         results = self.process_results(results)
         return results
 
+    async def batch(self, results: AsyncIterator[PromptObject]):
+        """Batches of up to index_batch_size prompts with an embedding. Like
+        the batches of the inference queue, a batch is searched partially full
+        once it waited lamini.batch_max_wait seconds to fill up."""
+        # Needs Python 3.10, as does the pipeline running the node
+        from lamini.generation.generation_queue_3_10 import async_chunks
+
+        async for batch in async_chunks(
+            self.with_embedding(results),
+            lambda: self.index_batch_size,
+            self.async_inference_queue.get_batch_max_wait(),
+        ):
+            yield batch
+
+    async def with_embedding(self, results: AsyncIterator[PromptObject]):
+        async for a in results:
+            if a is None or a.response is None:
+                release_sequence(a)
+                continue
+            yield a
+
     async def query_index(self, results: AsyncIterator[PromptObject]):
+        # Subclasses overriding query_index_impl are queried one prompt at a time
+        if type(self).query_index_impl is not IndexNode.query_index_impl:
+            async for a in self.query_index_each(results):
+                yield a
+            return
+        async for batch in self.batch(results):
+            for a in self.query_index_batch_impl(batch):
+                yield a
+
+    async def query_index_each(self, results: AsyncIterator[PromptObject]):
         async for a in results:
             if a is None or a.response is None:
+                release_sequence(a)
                 continue
             if hasattr(self, "query_index_impl"):
                 mod_a = self.query_index_impl(a)
                 if isinstance(mod_a, Generator):
-                    for a in mod_a:
-                        if a is not None:
-                            assert isinstance(a, PromptObject)
-                            yield a
+                    for position, res in enumerate(mod_a):
+                        if res is not None:
+                            assert isinstance(res, PromptObject)
+                            inherit_sequence(res, a, position)
+                            yield res
+                    release_sequence(a)
                     continue
                 if mod_a is not None:
+                    mod_a.sequence = a.sequence
                     a = mod_a
             assert a is None or isinstance(a, PromptObject)
             yield a
 
+    def get_index_filter(self, prompt: PromptObject) -> Optional[Dict[str, Any]]:
+        if callable(self.index_filter):
+            return self.index_filter(prompt)
+        return self.index_filter
+
+    def query_index_batch_impl(self, prompts: List[PromptObject]):
+        # Prompts with the same filter are searched in one call
+        groups = {}
+        for prompt in prompts:
+            index_filter = self.get_index_filter(prompt)
+            key = json.dumps(index_filter, sort_keys=True, default=str)
+            groups.setdefault(key, (index_filter, []))[1].append(prompt)
+        for index_filter, group in groups.values():
+            index_results = self.index.query_batch(
+                np.stack([prompt.response for prompt in group]),
+                k=self.index_top_k,
+                filter=index_filter,
+            )
+            for prompt, index_result in zip(group, index_results):
+                prompt.response = index_result
+        return prompts
+
     def query_index_impl(self, prompt: PromptObject):
         index_result = self.index.query_with_embedding(
-            prompt.response, k=self.index_top_k
+            prompt.response, k=self.index_top_k, filter=self.get_index_filter(prompt)
         )
         prompt.response = index_result
         return prompt
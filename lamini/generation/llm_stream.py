@@ -1,31 +1,61 @@
+import asyncio
+import collections
+import inspect
 import time
-from typing import Any, Dict, Iterator, List, Optional, TypeVar, Union
+from typing import Any, AsyncIterator, Dict, Iterator, List, Optional, TypeVar, Union
 
 
+import aiohttp
 import lamini
 from lamini.api.lamini_config import get_config, get_configured_key, get_configured_url
-from lamini.api.rest_requests import make_web_request
+from lamini.api.rest_requests import make_async_web_request, make_web_request
+from lamini.api.synchronize import client_session
+from lamini.api.utils.job_registry import (
+    async_find_job,
+    async_finish_job,
+    async_record_job,
+    finish_job,
+    find_job,
+    record_job,
+)
+from lamini.api.utils.reservations import Reservations
 
 T = TypeVar("T")
 
 
 class LLMStream:
-    """Handler for formatting and POST request for the batch submission API"""
+    """Handler for formatting and POST request for the batch submission API
+
+    Up to max_in_flight minibatches are submitted ahead, so the server works
+    on the next minibatches while the results of the first one are streamed
+    back. Results are yielded in prompt order. Every minibatch reserves its
+    own capacity before it is formed, and is sized by its reservation.
+
+    Parameters
+    ----------
+    api_key: Optional[str] = None
+        Lamini platform API key
+
+    api_url: Optional[str] = None
+        Lamini platform api url
+
+    max_in_flight: Optional[int] = None
+        Number of minibatches submitted at a time, defaults to lamini.max_workers
+    """
 
     def __init__(
         self,
         api_key: Optional[str] = None,
         api_url: Optional[str] = None,
+        max_in_flight: Optional[int] = None,
     ) -> None:
         self.config = get_config()
         self.api_key = api_key or lamini.api_key or get_configured_key(self.config)
         self.api_url = api_url or lamini.api_url or get_configured_url(self.config)
         self.api_prefix = self.api_url + "/v1/"
-        self.current_minibatch_result = None
-        self.current_minibatch_index = 0
         self.polling_interval = 1
-        self.error_count = 0
         self.max_errors = 3
+        self.max_in_flight = max_in_flight or lamini.max_workers
 
     def generate(
         self,
@@ -36,67 +66,288 @@ class LLMStream:
     ):
         if isinstance(prompts, list):
             prompts = iter(prompts)
-        minibatch_stream = self.minibatch(prompts, lambda: lamini.batch_size)
-        for minibatch in minibatch_stream:
-            # print("MINIBATCH", minibatch)
-            assert isinstance(minibatch, list)
-            req_data = self.make_llm_req_map(
-                prompt=minibatch,
-                model_name=model_name,
-                output_type=output_type,
-                max_new_tokens=max_new_tokens,
+        minibatch_stream = self.minibatch(
+            prompts, lambda: self.reserve_minibatch(model_name)
+        )
+        # Ids of the submitted minibatches, oldest first
+        in_flight = collections.deque()
+        while True:
+            while len(in_flight) < self.max_in_flight:
+                minibatch = next(minibatch_stream, None)
+                if minibatch is None:
+                    break
+                in_flight.append(
+                    self.submit_minibatch(
+                        minibatch, model_name, output_type, max_new_tokens
+                    )
+                )
+            if not in_flight:
+                return
+            for result in self.get_minibatch_result_stream(in_flight.popleft()):
+                yield result
+
+    async def async_generate(
+        self,
+        prompts: Union[AsyncIterator, Iterator, List],
+        model_name: str,
+        output_type: Optional[dict] = None,
+        max_new_tokens: Optional[int] = None,
+    ) -> AsyncIterator[Dict[str, Any]]:
+        """Asynchronous version of generate, taking an iterator or async
+        iterator of prompts. Minibatches are submitted concurrently over a
+        shared session, up to max_in_flight at a time, while the results of
+        the oldest one are streamed back in order."""
+
+        if isinstance(prompts, list):
+            prompts = iter(prompts)
+        async with client_session() as client:
+            slots = asyncio.Semaphore(self.max_in_flight)
+            # Tasks submitting the minibatches, in prompt order, then None
+            submissions = asyncio.Queue()
+            producer = asyncio.create_task(
+                self.async_submit_minibatches(
+                    client,
+                    prompts,
+                    slots,
+                    submissions,
+                    model_name,
+                    output_type,
+                    max_new_tokens,
+                )
             )
-            resp = make_web_request(
+            pending = []
+            try:
+                while True:
+                    submission = await submissions.get()
+                    if submission is None:
+                        break
+                    pending.append(submission)
+                    id = await submission
+                    async for result in self.async_get_minibatch_result_stream(
+                        client, id
+                    ):
+                        yield result
+                    pending.remove(submission)
+                    slots.release()
+                # Raise errors of the prompt iterator
+                await producer
+            finally:
+                producer.cancel()
+                while not submissions.empty():
+                    pending.append(submissions.get_nowait())
+                for submission in pending:
+                    if submission is not None:
+                        submission.cancel()
+
+    async def async_submit_minibatches(
+        self,
+        client: aiohttp.ClientSession,
+        prompts: Union[AsyncIterator, Iterator],
+        slots: asyncio.Semaphore,
+        submissions: asyncio.Queue,
+        model_name: str,
+        output_type: Optional[dict] = None,
+        max_new_tokens: Optional[int] = None,
+    ):
+        try:
+            async for minibatch in self.async_minibatch(
+                prompts, lambda: self.async_reserve_minibatch(client, model_name)
+            ):
+                await slots.acquire()
+                submissions.put_nowait(
+                    asyncio.create_task(
+                        self.async_submit_minibatch(
+                            client, minibatch, model_name, output_type, max_new_tokens
+                        )
+                    )
+                )
+        finally:
+            submissions.put_nowait(None)
+
+    async def async_submit_minibatch(
+        self,
+        client: aiohttp.ClientSession,
+        minibatch: List[str],
+        model_name: str,
+        output_type: Optional[dict] = None,
+        max_new_tokens: Optional[int] = None,
+    ) -> str:
+        req_data = self.make_llm_req_map(
+            prompt=minibatch,
+            model_name=model_name,
+            output_type=output_type,
+            max_new_tokens=max_new_tokens,
+        )
+        resp = await async_find_job(
+            "batch_completions",
+            self.api_url,
+            req_data,
+            lambda id: make_async_web_request(
+                client,
                 self.api_key,
-                self.api_prefix + "batch_completions",
-                "post",
-                req_data,
-            )
-            # print("rrrrrr", resp)
-            result_stream = self.get_minibatch_result_stream(resp["id"])
-            # print("streammmm", result_stream)
-            for result in result_stream:
-                yield result
+                self.api_prefix + f"batch_completions/{id}/result",
+                "get",
+            ),
+        )
+        if resp is not None:
+            return resp["id"]
+        resp = await make_async_web_request(
+            client,
+            self.api_key,
+            self.api_prefix + "batch_completions",
+            "post",
+            req_data,
+        )
+        await async_record_job("batch_completions", self.api_url, req_data, resp)
+        return resp["id"]
 
-            self.current_minibatch_result = None
-            self.current_minibatch_index = 0
+    def reserve_minibatch(self, model_name: str) -> int:
+        """Reserve capacity for the next minibatch, waiting for the start of
+        the reservation, and return the size of the minibatch"""
+        reservation = Reservations(api_key=self.api_key, api_url=self.api_url)
+        reservation.initialize_reservation(
+            capacity=lamini.batch_size,
+            model_name=model_name,
+            batch_size=lamini.batch_size,
+            max_tokens=None,
+        )
+        reservation.pause_for_reservation_start()
+        return self.get_minibatch_size(reservation)
+
+    async def async_reserve_minibatch(
+        self, client: aiohttp.ClientSession, model_name: str
+    ) -> int:
+        """Asynchronous version of reserve_minibatch"""
+        reservation = Reservations(api_key=self.api_key, api_url=self.api_url)
+        await reservation.async_initialize_reservation(
+            client,
+            capacity=lamini.batch_size,
+            model_name=model_name,
+            batch_size=lamini.batch_size,
+            max_tokens=None,
+        )
+        await reservation.async_pause_for_reservation_start()
+        return self.get_minibatch_size(reservation)
+
+    def get_minibatch_size(self, reservation: Reservations) -> int:
+        """Batch size recommended by the reservation, lamini.batch_size if there
+        is none or static batching is enabled"""
+        if lamini.static_batching or reservation.dynamic_max_batch_size <= 0:
+            return int(lamini.batch_size)
+        return int(reservation.dynamic_max_batch_size)
+
+    def submit_minibatch(
+        self,
+        minibatch: List[str],
+        model_name: str,
+        output_type: Optional[dict] = None,
+        max_new_tokens: Optional[int] = None,
+    ) -> str:
+        assert isinstance(minibatch, list)
+        req_data = self.make_llm_req_map(
+            prompt=minibatch,
+            model_name=model_name,
+            output_type=output_type,
+            max_new_tokens=max_new_tokens,
+        )
+        resp = find_job("batch_completions", self.api_url, req_data, self.check_result)
+        if resp is not None:
+            return resp["id"]
+        resp = make_web_request(
+            self.api_key,
+            self.api_prefix + "batch_completions",
+            "post",
+            req_data,
+        )
+        record_job("batch_completions", self.api_url, req_data, resp)
+        return resp["id"]
 
     def get_minibatch_result_stream(self, id: str):
+        minibatch_result = None
+        minibatch_index = 0
+        # Failed polls of this minibatch
+        error_count = 0
         # Keep polling until results are yielded
         while (
-            self.current_minibatch_result is None
-            or self.current_minibatch_result == {}
-            or not all(self.current_minibatch_result["finish_reason"])
+            minibatch_result is None
+            or minibatch_result == {}
+            or not all(minibatch_result["finish_reason"])
         ):
             time.sleep(self.polling_interval)
             try:
-                self.current_minibatch_result = make_web_request(
+                minibatch_result = make_web_request(
                     self.api_key,
                     self.api_prefix + f"batch_completions/{id}/result",
                     "get",
                 )
-                if self.current_minibatch_result == {}:
+                if minibatch_result == {}:
                     continue
 
-                # Yield all most recently available results
-                available_results = len(
-                    self.current_minibatch_result["finish_reason"]
-                ) - self.current_minibatch_result["finish_reason"].count(None)
-                for i in range(self.current_minibatch_index, available_results):
-                    result = {
-                        "output": self.current_minibatch_result["outputs"][i],
-                        "finish_reason": self.current_minibatch_result["finish_reason"][
-                            i
-                        ],
-                    }
+                results = self.finished_results(minibatch_result, minibatch_index)
+                minibatch_index += len(results)
+                for result in results:
                     yield result
 
-                self.current_minibatch_index = available_results
+            except Exception as e:
+                error_count += 1
+                if error_count > self.max_errors:
+                    # Given up on, a retry submits the request again.
+                    finish_job(id)
+                    raise e
+        finish_job(id)
+
+    async def async_get_minibatch_result_stream(
+        self, client: aiohttp.ClientSession, id: str
+    ):
+        minibatch_result = None
+        minibatch_index = 0
+        # Failed polls of this minibatch
+        error_count = 0
+        while (
+            minibatch_result is None
+            or minibatch_result == {}
+            or not all(minibatch_result["finish_reason"])
+        ):
+            await asyncio.sleep(self.polling_interval)
+            try:
+                minibatch_result = await make_async_web_request(
+                    client,
+                    self.api_key,
+                    self.api_prefix + f"batch_completions/{id}/result",
+                    "get",
+                )
+                if minibatch_result == {}:
+                    continue
+
+                results = self.finished_results(minibatch_result, minibatch_index)
+                minibatch_index += len(results)
+                for result in results:
+                    yield result
 
             except Exception as e:
-                self.error_count += 1
-                if self.error_count > self.max_errors:
+                error_count += 1
+                if error_count > self.max_errors:
+                    # Given up on, a retry submits the request again.
+                    await async_finish_job(id)
                     raise e
+        await async_finish_job(id)
+
+    def finished_results(
+        self, minibatch_result: Dict[str, Any], index: int
+    ) -> List[Dict[str, Any]]:
+        """The finished results following index, up to the first unfinished
+        one. Prompts may finish out of order, results are returned in order."""
+        finish_reason = minibatch_result["finish_reason"]
+        results = []
+        while index < len(finish_reason) and finish_reason[index] is not None:
+            results.append(
+                {
+                    "output": minibatch_result["outputs"][index],
+                    "finish_reason": finish_reason[index],
+                }
+            )
+            index += 1
+        return results
 
     def check_result(
         self,
@@ -131,22 +382,50 @@ class LLMStream:
         iterator: Iterator[T],
         size_fn,
     ) -> Iterator[list[T]]:
-        """Yield successive n-sized chunks from lst."""
-        finished = False
-
-        while not finished:
-            results: list[T] = []
+        """Yield successive chunks of iterator, skipping None. size_fn is
+        called once the first element of a chunk arrived, so no capacity is
+        reserved past the end of iterator."""
+        for first in iterator:
+            if first is None:
+                continue
+            results: list[T] = [first]
             size = size_fn()
+            if len(results) < size:
+                for result in iterator:
+                    if result is None:
+                        continue
+                    results.append(result)
+                    if len(results) == size:
+                        break
+            yield results
+
+    async def async_minibatch(
+        self,
+        iterator: Union[AsyncIterator[T], Iterator[T]],
+        size_fn,
+    ) -> AsyncIterator[list[T]]:
+        """Asynchronous version of minibatch, also taking a sync iterator.
+        size_fn may return an awaitable."""
+        if not isinstance(iterator, AsyncIterator):
+            iterator = aiter_sync(iterator)
 
-            for _ in range(size):
-                try:
-                    result = None
-                    while result is None:
-                        result = next(iterator)
-                except StopIteration:
-                    finished = True
-                else:
+        async for first in iterator:
+            if first is None:
+                continue
+            results: list[T] = [first]
+            size = size_fn()
+            if inspect.isawaitable(size):
+                size = await size
+            if len(results) < size:
+                async for result in iterator:
+                    if result is None:
+                        continue
                     results.append(result)
+                    if len(results) == size:
+                        break
+            yield results
+
 
-            if results:
-                yield results
+async def aiter_sync(iterator: Iterator[T]) -> AsyncIterator[T]:
+    for item in iterator:
+        yield item
@@ -3,6 +3,7 @@ from typing import AsyncIterator, Callable, Iterator, Optional, Union
 
 from lamini.generation.base_node_object import BaseGenerationNode
 from lamini.generation.base_prompt_object import PromptObject
+from lamini.generation.reorder_buffer import release_sequence
 
 logger = logging.getLogger(__name__)
 
@@ -21,6 +22,7 @@ class ModifyNode(BaseGenerationNode):
     ):
         async for a in prompt:
             if a is None or a.response is None:
+                release_sequence(a)
                 continue
             if self.prompt_lambda:
                 self.prompt_lambda(a)
@@ -0,0 +1,231 @@
+import contextlib
+import json
+import logging
+import time
+from collections import defaultdict
+from typing import Dict, Iterator, List, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+
+class PipelineProfiler:
+    """Opt-in profiler attributing the wall time of a GenerationPipeline to its
+    nodes and their phases.
+
+    Pass it to GenerationPipeline.call() or call_with_result(). Recorded phases:
+        preprocess, postprocess: the node's user hooks
+        batch_wait: a batch filling up, from its first prompt arriving until
+            it is sent, which excludes waiting on the upstream nodes for it
+        reservation_wait: waiting for reservation capacity before a query
+        query: the round trip to the inference API
+
+    When the call finishes, a summary table is logged and, if trace_path is set,
+    a Chrome trace JSON file is written, which can be opened in chrome://tracing
+    or https://ui.perfetto.dev.
+
+    Parameters
+    ----------
+    trace_path: Optional[str] = None
+        Path to write the Chrome trace JSON file to
+
+    max_trace_events: int = 100000
+        Spans recorded for the trace file beyond this are only counted in the
+        summary
+    """
+
+    def __init__(
+        self, trace_path: Optional[str] = None, max_trace_events: int = 100000
+    ):
+        self.trace_path = trace_path
+        self.max_trace_events = max_trace_events
+        self.start_time = None
+        self.end_time = None
+        # (node, phase) -> [spans, items, total seconds, max seconds, first start, last end]
+        self.stats: Dict[Tuple[str, str], list] = {}
+        # (node, phase, start, end, items)
+        self.events: List[Tuple[str, str, float, float, int]] = []
+
+    def start(self):
+        self.start_time = time.perf_counter()
+        self.end_time = None
+
+    def stop(self):
+        self.end_time = time.perf_counter()
+
+    def stage(self, name: str) -> "StageProfiler":
+        return StageProfiler(self, name)
+
+    def record(self, node: str, phase: str, start: float, end: float, items: int):
+        duration = end - start
+        stat = self.stats.get((node, phase))
+        if stat is None:
+            self.stats[(node, phase)] = [1, items, duration, duration, start, end]
+        else:
+            stat[0] += 1
+            stat[1] += items
+            stat[2] += duration
+            stat[3] = max(stat[3], duration)
+            stat[4] = min(stat[4], start)
+            stat[5] = max(stat[5], end)
+        if len(self.events) < self.max_trace_events:
+            self.events.append((node, phase, start, end, items))
+
+    def summary(self) -> List[dict]:
+        """Per node and phase totals. Time is summed over spans, so it may exceed
+        the wall time for phases running concurrently, e.g. query. Throughput
+        is the number of items over the wall time the phase was active in."""
+        rows = []
+        for (node, phase), stat in self.stats.items():
+            spans, items, total, longest, first, last = stat
+            active = last - first
+            rows.append(
+                {
+                    "node": node,
+                    "phase": phase,
+                    "spans": spans,
+                    "items": items,
+                    "total_time": total,
+                    "mean_time": total / spans,
+                    "max_time": longest,
+                    "items_per_second": items / active if active > 0 else None,
+                }
+            )
+        return rows
+
+    def format_summary(self) -> str:
+        header = [
+            "node",
+            "phase",
+            "spans",
+            "items",
+            "total s",
+            "mean ms",
+            "max ms",
+            "items/s",
+        ]
+        lines = []
+        for row in self.summary():
+            throughput = row["items_per_second"]
+            lines.append(
+                [
+                    row["node"],
+                    row["phase"],
+                    str(row["spans"]),
+                    str(row["items"]),
+                    f"{row['total_time']:.3f}",
+                    f"{row['mean_time'] * 1000:.2f}",
+                    f"{row['max_time'] * 1000:.2f}",
+                    "-" if throughput is None else f"{throughput:.1f}",
+                ]
+            )
+        widths = [
+            max(len(line[i]) for line in [header] + lines) for i in range(len(header))
+        ]
+        table = [
+            "  ".join(cell.ljust(width) for cell, width in zip(line, widths))
+            for line in [header] + lines
+        ]
+        if self.start_time is not None and self.end_time is not None:
+            table.append(f"wall time: {self.end_time - self.start_time:.3f}s")
+        return "\n".join(table)
+
+    def chrome_trace(self) -> dict:
+        """Recorded spans in the Chrome trace event format. Each (node, phase) is
+        shown as a process with as many threads as it had concurrent spans."""
+        origin = self.start_time
+        if origin is None:
+            origin = min((event[2] for event in self.events), default=0)
+        trace_events = []
+        pids = {}
+        # (node, phase) -> end time of the last span on each thread
+        lanes = defaultdict(list)
+        for node, phase, start, end, items in sorted(self.events, key=lambda e: e[2]):
+            key = (node, phase)
+            if key not in pids:
+                pids[key] = len(pids) + 1
+                trace_events.append(
+                    {
+                        "name": "process_name",
+                        "ph": "M",
+                        "pid": pids[key],
+                        "args": {"name": f"{node}: {phase}"},
+                    }
+                )
+            lane_ends = lanes[key]
+            for tid, lane_end in enumerate(lane_ends):
+                if lane_end <= start:
+                    lane_ends[tid] = end
+                    break
+            else:
+                tid = len(lane_ends)
+                lane_ends.append(end)
+            trace_events.append(
+                {
+                    "name": phase,
+                    "cat": node,
+                    "ph": "X",
+                    "ts": (start - origin) * 1e6,
+                    "dur": (end - start) * 1e6,
+                    "pid": pids[key],
+                    "tid": tid,
+                    "args": {"items": items},
+                }
+            )
+        return {"traceEvents": trace_events, "displayTimeUnit": "ms"}
+
+    def write_chrome_trace(self, path: str):
+        with open(path, "w") as f:
+            json.dump(self.chrome_trace(), f)
+
+    def report(self) -> str:
+        """Log the summary table and write the trace file, if configured.
+        Returns the summary table."""
+        summary = self.format_summary()
+        logger.info(f"Pipeline profile:\n{summary}")
+        if self.trace_path is not None:
+            logger.info(f"Writing pipeline trace to {self.trace_path}")
+            self.write_chrome_trace(self.trace_path)
+        return summary
+
+
+class StageProfiler:
+    """PipelineProfiler bound to a single pipeline node."""
+
+    def __init__(self, profiler: PipelineProfiler, name: str):
+        self.profiler = profiler
+        self.name = name
+
+    def record(self, phase: str, start: float, end: float, items: int):
+        self.profiler.record(self.name, phase, start, end, items)
+
+    @contextlib.contextmanager
+    def span(self, phase: str, items: int = 1):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record(phase, start, time.perf_counter(), items)
+
+    def iterate(self, phase: str, iterator: Iterator) -> Iterator:
+        """Time every step of iterator, e.g. of a preprocess generator. The steps
+        don't count as items, the call returning the generator already did."""
+        while True:
+            start = time.perf_counter()
+            try:
+                item = next(iterator)
+            except StopIteration:
+                return
+            self.record(phase, start, time.perf_counter(), 0)
+            yield item
+
+
+def profile_span(profiler: Optional[StageProfiler], phase: str, items: int = 1):
+    if profiler is None:
+        return contextlib.nullcontext()
+    return profiler.span(phase, items)
+
+
+def profile_iter(profiler: Optional[StageProfiler], phase: str, iterator: Iterator):
+    if profiler is None:
+        return iterator
+    return profiler.iterate(phase, iterator)
@@ -1,7 +1,9 @@
 import logging
 
 import lamini
+import numpy as np
 from lamini.api.pipeline_client import PipelineClient
+from lamini.generation.pipeline_profiler import profile_span
 
 logger = logging.getLogger(__name__)
 
@@ -11,10 +13,9 @@ async def process_generation_batch(args: dict):
     key = args["key"]
     batch = args["batch"]
     reservation_api = args["reservation_api"]
+    profiler = args.get("profiler")
 
     url = get_url_from_args(args)
-    # this will block until there is space in capacity
-    await reservation_api.async_pause_for_reservation_start()
 
     def can_submit_query():
         if reservation_api.current_reservation is None:
@@ -29,9 +30,12 @@ async def process_generation_batch(args: dict):
         )
         return True
 
-    if not can_submit_query():
-        async with reservation_api.condition:
-            await reservation_api.condition.wait_for(can_submit_query)
+    with profile_span(profiler, "reservation_wait", len(batch["prompt"])):
+        # this will block until there is space in capacity
+        await reservation_api.async_pause_for_reservation_start()
+        if not can_submit_query():
+            async with reservation_api.condition:
+                await reservation_api.condition.wait_for(can_submit_query)
     # Separate thread updates existing reservations
     try:
         reservation_id = None
@@ -39,7 +43,8 @@ async def process_generation_batch(args: dict):
             reservation_id = reservation_api.current_reservation["reservation_id"]
         json = get_body_from_args(batch, reservation_id)
         logger.info(f"Sending batch with {len(batch['prompt'])}")
-        result = await query_api(client, key, url, json, batch["type"])
+        with profile_span(profiler, "query", len(batch["prompt"])):
+            result = await query_api(client, key, url, json, batch["type"])
     except Exception as e:
         logger.error(
             f"Error in process_generation_batch, type: {type(e)}, message: {e}",
@@ -60,8 +65,12 @@ async def process_generation_batch(args: dict):
             )
             reservation_api.poll_for_reservation.set()
     if batch["type"] == "embedding":
+        # One contiguous float32 matrix per batch, every response is a row view.
+        embeddings = np.asarray(result, dtype=np.float32).reshape(
+            len(batch["prompt"]), -1
+        )
         for i, prompt_obj in enumerate(batch["prompt"]):
-            prompt_obj.response = result[i]
+            prompt_obj.response = embeddings[i]
     else:
         for i, prompt_obj in enumerate(batch["prompt"]):
             if lamini.gate_pipeline_batch_completions:
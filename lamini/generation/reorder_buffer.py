@@ -0,0 +1,134 @@
+import asyncio
+import logging
+from typing import Dict, Iterator, List, Optional
+
+from lamini.generation.base_prompt_object import PromptObject
+
+logger = logging.getLogger(__name__)
+
+
+class SequenceNumber:
+    """Position of a prompt in the pipeline input, carried through every node.
+
+    Prompts fanned out from one input prompt share its root, which counts how
+    many of them are still inside the pipeline. The path orders them within
+    the input prompt, e.g. (3, 1) is the second prompt split from input 3.
+    """
+
+    __slots__ = ("root", "path", "pending")
+
+    def __init__(self, index: int, root: "SequenceNumber" = None, path: tuple = None):
+        self.root = root or self
+        self.path = path or (index,)
+        self.pending = 1
+
+    @property
+    def index(self) -> int:
+        return self.path[0]
+
+    @property
+    def done(self) -> bool:
+        return self.root.pending == 0
+
+    def child(self, position: int) -> "SequenceNumber":
+        self.root.pending += 1
+        return SequenceNumber(self.index, self.root, self.path + (position,))
+
+    def release(self):
+        self.root.pending -= 1
+
+
+def inherit_sequence(child: PromptObject, parent: PromptObject, position: int):
+    """Record child as the position-th prompt fanned out from parent.
+
+    The parent must be released with release_sequence() once all of its
+    children are created.
+    """
+    if parent.sequence is not None:
+        child.sequence = parent.sequence.child(position)
+
+
+def release_sequence(prompt: Optional[PromptObject]):
+    """Record that prompt left the pipeline, i.e. it was dropped or replaced
+    by the prompts fanned out from it."""
+    if prompt is not None and prompt.sequence is not None:
+        prompt.sequence.release()
+
+
+class ReorderBuffer:
+    """Restores input order of the prompts returned from a pipeline
+
+    Every input prompt is registered with admit(). Results are handed to push(),
+    which returns the results that can be emitted in input order: an input is
+    emitted once all prompts derived from it left the pipeline.
+
+    Inputs are only admitted up to window inputs past the oldest one not yet
+    emitted, see wait_for_room(), which bounds the results held back. An input
+    is only passed over once every prompt derived from it was released, so a
+    node dropping a prompt must release it with release_sequence().
+    """
+
+    def __init__(self, window: int):
+        assert window > 0
+        self.window = window
+        self.next_index = 0
+        self.admitted: Dict[int, SequenceNumber] = {}
+        self.held: Dict[int, List[PromptObject]] = {}
+        self.held_count = 0
+        # Set when next_index advances
+        self.room = asyncio.Event()
+
+    def admit(self, prompt: PromptObject, index: int):
+        prompt.sequence = SequenceNumber(index)
+        self.admitted[index] = prompt.sequence
+
+    def has_room(self, index: int) -> bool:
+        return index < self.next_index + self.window
+
+    async def wait_for_room(self, index: int, warn_after: float = 60):
+        """Wait until input index can be admitted, warning every warn_after
+        seconds that the oldest input is still in the pipeline"""
+        while not self.has_room(index):
+            self.room.clear()
+            try:
+                await asyncio.wait_for(self.room.wait(), timeout=warn_after)
+            except asyncio.TimeoutError:
+                logger.warning(
+                    f"Input {self.next_index} is still in the pipeline after "
+                    f"{warn_after}s, holding back the next inputs. Prompts dropped "
+                    f"in forward() must be released with release_sequence()."
+                )
+
+    def push(self, prompt: PromptObject) -> Iterator[PromptObject]:
+        sequence = prompt.sequence
+        if sequence is None:
+            # Not derived from a pipeline input, so there is no order to keep.
+            yield prompt
+            return
+        sequence.release()
+        if sequence.index < self.next_index:
+            # Only if a prompt of the input was released more than once
+            logger.debug(f"Emitting result of input {sequence.index} out of order")
+            yield prompt
+            return
+        self.held.setdefault(sequence.index, []).append(prompt)
+        self.held_count += 1
+        yield from self.emit_ready()
+
+    def emit_ready(self) -> Iterator[PromptObject]:
+        while self.next_index in self.admitted and self.admitted[self.next_index].done:
+            yield from self.emit(self.next_index)
+
+    def emit(self, index: int) -> Iterator[PromptObject]:
+        self.admitted.pop(index, None)
+        held = self.held.pop(index, [])
+        self.held_count -= len(held)
+        self.next_index = index + 1
+        self.room.set()
+        yield from sorted(held, key=lambda p: p.sequence.path)
+
+    def flush(self) -> Iterator[PromptObject]:
+        """Emit every held result, in input order."""
+        for index in sorted(self.held):
+            yield from self.emit(index)
+        self.admitted.clear()
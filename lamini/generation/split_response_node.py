@@ -3,6 +3,7 @@ from typing import AsyncIterator, Callable, Iterator, Optional, Union
 
 from lamini.generation.base_node_object import BaseGenerationNode
 from lamini.generation.base_prompt_object import PromptObject
+from lamini.generation.reorder_buffer import inherit_sequence, release_sequence
 
 logger = logging.getLogger(__name__)
 
@@ -20,15 +21,19 @@ class SplitResponseNode(BaseGenerationNode):
     ):
         async for a in prompt:
             if a is None or a.response is None:
+                release_sequence(a)
                 continue
             new_prompt_objs = self.split_response(a)
             for new_prompt in new_prompt_objs:
                 yield new_prompt
+            release_sequence(a)
 
     def split_response(self, prompt_obj: PromptObject):
         if isinstance(prompt_obj.response, dict):
-            for key, val in prompt_obj.response.items():
+            for position, (key, val) in enumerate(prompt_obj.response.items()):
                 new_prompt_obj = PromptObject("", val, prompt_obj.data)
+                new_prompt_obj.orig_prompt = prompt_obj.orig_prompt
+                inherit_sequence(new_prompt_obj, prompt_obj, position)
                 if self.prompt_lambda:
                     self.prompt_lambda(new_prompt_obj)
                 yield new_prompt_obj
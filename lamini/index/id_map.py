@@ -0,0 +1,52 @@
+from typing import List, Optional, Tuple
+
+import numpy as np
+
+
+class IdMap:
+    """Split id -> row of a LaminiIndex, without a python object per split
+
+    The ids are kept in sorted runs, each with the rows of its ids, and looked
+    up with np.searchsorted. Added ids form a new run, which is merged with the
+    previous one while that is at most twice as large, so adding m ids costs
+    O(m log n) amortized instead of rebuilding the map, and there are at most
+    O(log n) runs.
+
+    An id may be added again after its row was deleted. Lookups return its
+    latest row, the caller checks whether that row was deleted.
+    """
+
+    def __init__(self):
+        # (sorted ids, their rows), the rows of equal ids in increasing order
+        self.runs: List[Tuple[np.ndarray, np.ndarray]] = []
+
+    def add(self, ids: np.ndarray, first_row: int, order: Optional[np.ndarray] = None):
+        """Add ids of the rows from first_row on, order is np.argsort(ids) if
+        it is known, e.g. saved with the index"""
+        ids = np.asarray(ids, dtype=np.int64)
+        if len(ids) == 0:
+            return
+        if order is None:
+            order = np.argsort(ids, kind="stable")
+        order = np.asarray(order, dtype=np.int64)
+        self.runs.append((ids[order], order + first_row))
+        while len(self.runs) > 1 and len(self.runs[-2][0]) <= 2 * len(self.runs[-1][0]):
+            self.merge_last()
+
+    def merge_last(self):
+        (ids_a, rows_a), (ids_b, rows_b) = self.runs[-2:]
+        ids = np.concatenate([ids_a, ids_b])
+        rows = np.concatenate([rows_a, rows_b])
+        order = np.lexsort((rows, ids))
+        self.runs[-2:] = [(ids[order], rows[order])]
+
+    def lookup(self, ids: np.ndarray) -> np.ndarray:
+        """Latest row of every id, -1 for ids that were never added"""
+        ids = np.asarray(ids, dtype=np.int64)
+        rows = np.full(len(ids), -1, dtype=np.int64)
+        for run_ids, run_rows in self.runs:
+            # The last of equal ids has the latest row
+            positions = np.searchsorted(run_ids, ids, side="right") - 1
+            found = (positions >= 0) & (run_ids[np.maximum(positions, 0)] == ids)
+            rows[found] = np.maximum(rows[found], run_rows[positions[found]])
+        return rows
@@ -0,0 +1,116 @@
+import json
+import logging
+import os
+from typing import Any, Dict, Iterator, List
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+
+class IndexDelta:
+    """Append-only log of the changes made to a saved LaminiIndex
+
+    Files in directory:
+        delta.log: one json record per line, either
+            {"op": "add", "ids": [...], "texts": [...], "metadata": [...],
+                "offset": o, "dim": d}
+            {"op": "delete", "ids": [...]}
+        delta.f32: float32 rows of the added embeddings, an add record's rows
+            start at byte offset o
+
+    The rows of a record are written before its line, so a write interrupted
+    by a crash leaves at most an incomplete last line, which is ignored.
+    Loading an index replays its delta on top of the saved index, and
+    compacting the index folds the delta into it.
+
+    Parameters
+    ----------
+    directory: str
+        Directory of the saved index
+    """
+
+    def __init__(self, directory: str, suffix: str = ""):
+        self.log_path = os.path.join(directory, "delta.log" + suffix)
+        self.embeddings_path = os.path.join(directory, "delta.f32" + suffix)
+
+    def exists(self) -> bool:
+        return os.path.exists(self.log_path)
+
+    def size(self) -> int:
+        """Position in the log, see truncate"""
+        return os.path.getsize(self.log_path) if self.exists() else 0
+
+    def append(self, records: List[Dict[str, Any]]):
+        """Append records, add records carrying their rows under "embeddings" """
+        if not records:
+            return
+        lines = []
+        with open(self.embeddings_path, "ab") as f:
+            for record in records:
+                record = dict(record)
+                if record["op"] == "add":
+                    embeddings = np.ascontiguousarray(
+                        record.pop("embeddings"), dtype=np.float32
+                    )
+                    record["offset"] = f.tell()
+                    record["dim"] = embeddings.shape[1]
+                    f.write(embeddings.tobytes())
+                lines.append(json.dumps(record) + "\n")
+            f.flush()
+            os.fsync(f.fileno())
+        self.drop_incomplete_record()
+        with open(self.log_path, "a") as f:
+            f.write("".join(lines))
+            f.flush()
+            os.fsync(f.fileno())
+
+    def drop_incomplete_record(self):
+        if not self.exists():
+            return
+        with open(self.log_path, "r+b") as f:
+            if f.seek(0, os.SEEK_END) == 0:
+                return
+            f.seek(-1, os.SEEK_END)
+            if f.read(1) == b"\n":
+                return
+            f.seek(0)
+            f.truncate(f.read().rfind(b"\n") + 1)
+
+    def read(self, start: int = 0) -> Iterator[Dict[str, Any]]:
+        """Records from position start on, add records with their rows"""
+        if not self.exists():
+            return
+        with open(self.log_path, "rb") as f:
+            f.seek(start)
+            for line in f:
+                if not line.endswith(b"\n"):
+                    logger.warning(f"Ignoring incomplete record in {self.log_path}")
+                    return
+                record = json.loads(line)
+                if record["op"] == "add":
+                    shape = (len(record["ids"]), record["dim"])
+                    record["embeddings"] = np.fromfile(
+                        self.embeddings_path,
+                        dtype=np.float32,
+                        count=shape[0] * shape[1],
+                        offset=record["offset"],
+                    ).reshape(shape)
+                yield record
+
+    def truncate(self, start: int):
+        """Drop the records before position start, keeping the later ones"""
+        directory = os.path.dirname(self.log_path)
+        rest = IndexDelta(directory, suffix=".tmp")
+        rest.clear()
+        rest.append(list(self.read(start)))
+        if not rest.exists():
+            self.clear()
+            return
+        os.replace(rest.embeddings_path, self.embeddings_path)
+        os.replace(rest.log_path, self.log_path)
+
+    def clear(self):
+        for path in (self.log_path, self.embeddings_path):
+            if os.path.exists(path):
+                os.remove(path)
@@ -1,105 +1,1042 @@
+import collections
+import glob
+import itertools
 import json
 import logging
 import os
-from typing import Iterable, List, Union
+import re
+import shutil
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Any, Dict, Iterable, List, Optional, Union
 
 import faiss
+import lamini
 import numpy as np
 from lamini.api.embedding import Embedding
+from lamini.index.id_map import IdMap
+from lamini.index.index_delta import IndexDelta
+from lamini.index.metadata_store import MetadataStore
+from lamini.index.splits_store import SplitsStore
 from tqdm import tqdm
 
 logger = logging.getLogger(__name__)
 
 
+INDEX_TYPES = ("flat", "ivf_flat", "ivf_pq", "hnsw")
+# Rows reconstructed at a time when an HNSW index is rebuilt
+RECONSTRUCT_CHUNK_SIZE = 65536
+METRICS = ("l2", "ip", "cosine")
+ENCODINGS = ("flat", "fp16", "sq8", "pq")
+# Files of indexes saved before they were written to generation directories
+LEGACY_FILES = (
+    "index.faiss",
+    "ids.npy",
+    "params.json",
+    "splits.json",
+    "splits.idx",
+    "splits.bin",
+    "metadata.json",
+    "metadata-*.npy",
+)
+
+
 class LaminiIndex:
-    def __init__(self):
+    """Vector index over text splits
+
+    Every split has a stable id, given when it is added or assigned from a
+    counter. Splits are removed with delete(), which excludes them from
+    searches until the index is compacted, and replaced with upsert().
+
+    Splits may carry metadata, e.g. {"tenant": "acme"}, which searches can be
+    filtered on, see MetadataStore. The filter is applied inside the FAISS
+    search, so it returns the k nearest matching splits.
+
+    save_index() writes the whole index. Changes made after that are appended
+    to its on-disk delta by save_delta(), in time proportional to the change,
+    and folded into the saved index by compact(), which may run in the
+    background. The index files are written to a new generation directory,
+    which manifest.json is then switched to, so a crash leaves the previous
+    generation in place.
+
+    Parameters
+    ----------
+    index_type: str = "flat"
+        One of INDEX_TYPES:
+            flat: exact brute-force search
+            ivf_flat: inverted lists of full vectors, searching nprobe lists
+            ivf_pq: inverted lists of product-quantized vectors
+            hnsw: HNSW graph, no training needed
+
+    nlist: Optional[int] = None
+        Inverted lists of IVF indexes, by default 4 * sqrt(n) of the n
+        training vectors, at most n / 39
+
+    pq_m: int = 16
+        Sub-quantizers of IVF-PQ, must divide the embedding dimension
+
+    pq_nbits: int = 8
+        Bits per sub-quantizer code of IVF-PQ
+
+    hnsw_m: int = 32
+        Neighbors per HNSW graph node
+
+    ef_construction: int = 40
+        HNSW candidate list size while adding
+
+    train_size: int = 100000
+        Vectors buffered to train IVF indexes on before they are built
+
+    nprobe: int = 16
+        Inverted lists searched per query by IVF indexes
+
+    ef_search: int = 64
+        HNSW candidate list size while searching
+
+    metric: str = "l2"
+        One of METRICS: l2 distance, inner product, or cosine similarity,
+        i.e. inner product of embeddings normalized when added and searched
+
+    encoding: str = "flat"
+        One of ENCODINGS, how vectors are stored:
+            flat: float32, 4 bytes per dimension
+            fp16: float16, 2 bytes per dimension
+            sq8: 8-bit scalar quantization, 1 byte per dimension
+            pq: product quantization, pq_m * pq_nbits bits per vector
+        ivf_pq indexes always use pq
+
+    rerank: bool = False
+        Keep float32 copies of the vectors next to the encoded ones, and
+        re-rank rerank_factor * k candidates of every search exactly
+
+    rerank_factor: int = 4
+        Candidates re-ranked per result
+    """
+
+    def __init__(
+        self,
+        index_type: str = "flat",
+        nlist: Optional[int] = None,
+        pq_m: int = 16,
+        pq_nbits: int = 8,
+        hnsw_m: int = 32,
+        ef_construction: int = 40,
+        train_size: int = 100000,
+        nprobe: int = 16,
+        ef_search: int = 64,
+        metric: str = "l2",
+        encoding: str = "flat",
+        rerank: bool = False,
+        rerank_factor: int = 4,
+    ):
+        if index_type not in INDEX_TYPES:
+            raise ValueError(
+                f"Unknown index_type {index_type}, expected one of {INDEX_TYPES}"
+            )
+        if metric not in METRICS:
+            raise ValueError(f"Unknown metric {metric}, expected one of {METRICS}")
+        if encoding not in ENCODINGS:
+            raise ValueError(
+                f"Unknown encoding {encoding}, expected one of {ENCODINGS}"
+            )
+        if index_type == "ivf_pq" and encoding not in ("flat", "pq"):
+            raise ValueError(f"ivf_pq indexes can't use the {encoding} encoding")
+        configure_faiss_threads()
         self.embedding_api = Embedding()
         self.index = None
         self.splits = []
+        self.metadata = MetadataStore()
+        self.index_type = index_type
+        self.nlist = nlist
+        self.pq_m = pq_m
+        self.pq_nbits = pq_nbits
+        self.hnsw_m = hnsw_m
+        self.ef_construction = ef_construction
+        self.train_size = train_size
+        self.nprobe = nprobe
+        self.ef_search = ef_search
+        self.metric = metric
+        self.encoding = "pq" if index_type == "ivf_pq" else encoding
+        self.rerank = rerank
+        self.rerank_factor = rerank_factor
+        # Embeddings waiting for the index to be trained
+        self.pending = []
+        # Set for memory mapped indexes, see load_index
+        self.read_only = False
+        # Split ids in row order, as a list of arrays
+        self.id_chunks = []
+        self.next_id = 0
+        # Split id -> row, built when first needed
+        self.id_map = None
+        # np.argsort of the saved ids, if they were saved with it
+        self.id_order = None
+        # Rows of deleted splits, kept until the index is compacted
+        self.deleted = set()
+        self.deleted_selector = None
+        # (filter, version, mask, bitmap, selector) of the last filter searched
+        self.filter_cache = None
+        # Directory the index was saved to, and the changes since then
+        self.path = None
+        self.journal = []
+        # Counts changes, so that compact() can tell if there were any
+        self.version = 0
+        self.lock = threading.RLock()
+
+    def get_params(self) -> dict:
+        return {
+            "index_type": self.index_type,
+            "nlist": self.nlist,
+            "pq_m": self.pq_m,
+            "pq_nbits": self.pq_nbits,
+            "hnsw_m": self.hnsw_m,
+            "ef_construction": self.ef_construction,
+            "train_size": self.train_size,
+            "nprobe": self.nprobe,
+            "ef_search": self.ef_search,
+            "metric": self.metric,
+            "encoding": self.encoding,
+            "rerank": self.rerank,
+            "rerank_factor": self.rerank_factor,
+        }
 
     @staticmethod
-    def load_index(path):
-        lamini_index = LaminiIndex()
-        faiss_path = os.path.join(path, "index.faiss")
-        splits_path = os.path.join(path, "splits.json")
+    def load_index(path, mmap: bool = False):
+        """Load an index saved with save_index
+
+        Parameters
+        ----------
+        path: str
+            Directory the index was saved to
+
+        mmap: bool = False
+            Memory map the FAISS index instead of reading it into memory, so
+            that processes loading the same index share its pages. The loaded
+            index is read-only.
+        """
+        data_path = get_data_path(path)
+        faiss_path = os.path.join(data_path, "index.faiss")
+        splits_path = os.path.join(data_path, "splits.json")
+        params_path = os.path.join(data_path, "params.json")
+
+        # Indexes saved before params.json existed are flat
+        params = {}
+        if os.path.exists(params_path):
+            with open(params_path, "r") as f:
+                params = json.load(f)
+        lamini_index = LaminiIndex(**params)
 
         # Load the index from a file
-        lamini_index.index = faiss.read_index(faiss_path)
+        if mmap:
+            lamini_index.index = faiss.read_index(
+                faiss_path, get_mmap_flags(lamini_index.index_type)
+            )
+            lamini_index.read_only = True
+        else:
+            lamini_index.index = faiss.read_index(faiss_path)
+
+        # Load the splits from a file, indexes saved before splits.idx
+        # existed have them in splits.json
+        if SplitsStore.exists(data_path):
+            lamini_index.splits = SplitsStore(data_path)
+        else:
+            with open(splits_path, "r") as f:
+                lamini_index.splits = json.load(f)
+
+        # Indexes saved before ids.npy existed have the row numbers as ids
+        ids_path = os.path.join(data_path, "ids.npy")
+        if os.path.exists(ids_path):
+            ids = np.load(ids_path, mmap_mode="r")
+        else:
+            ids = np.arange(len(lamini_index.splits), dtype=np.int64)
+            lamini_index.id_order = ids
+        lamini_index.id_chunks = [ids]
+        lamini_index.id_order = load_id_order(data_path, lamini_index.id_order)
+        lamini_index.next_id = int(ids.max()) + 1 if len(ids) else 0
+        lamini_index.metadata = MetadataStore(data_path, num_rows=len(ids))
 
-        # Load the splits from a file
-        with open(splits_path, "r") as f:
-            lamini_index.splits = json.load(f)
+        for record in IndexDelta(path).read():
+            if mmap and record["op"] == "add":
+                raise ValueError(
+                    f"Index at {path} has splits added since it was compacted, compact it before loading it with mmap=True"
+                )
+            lamini_index.apply(record)
+        lamini_index.path = path
 
+        lamini_index.check_consistency()
         return lamini_index
 
     def init_index(self):
         self.splits = []
         self.index = None
+        self.pending = []
+        self.metadata = MetadataStore()
+        self.id_chunks = []
+        self.next_id = 0
+        self.id_map = None
+        self.id_order = None
+        self.deleted = set()
+        self.deleted_selector = None
+        self.journal = []
+
+    def create_index(self, dim: int, num_train: int = 0):
+        if self.encoding == "pq":
+            if dim % self.pq_m != 0:
+                raise ValueError(
+                    f"pq_m={self.pq_m} does not divide the embedding dimension {dim}"
+                )
+            if num_train < 2**self.pq_nbits:
+                raise ValueError(
+                    f"pq with pq_nbits={self.pq_nbits} needs at least {2**self.pq_nbits} training vectors, got {num_train}"
+                )
+        index = self.create_base_index(dim, num_train)
+        if self.rerank:
+            index = faiss.IndexRefineFlat(index)
+        return index
+
+    def create_base_index(self, dim: int, num_train: int):
+        metric = faiss.METRIC_L2 if self.metric == "l2" else faiss.METRIC_INNER_PRODUCT
+        qtype = (
+            faiss.ScalarQuantizer.QT_fp16
+            if self.encoding == "fp16"
+            else faiss.ScalarQuantizer.QT_8bit
+        )
+        if self.index_type == "flat":
+            if self.encoding == "flat":
+                return faiss.IndexFlat(dim, metric)
+            if self.encoding == "pq":
+                return faiss.IndexPQ(dim, self.pq_m, self.pq_nbits, metric)
+            return faiss.IndexScalarQuantizer(dim, qtype, metric)
+        if self.index_type == "hnsw":
+            if self.encoding == "flat":
+                index = faiss.IndexHNSWFlat(dim, self.hnsw_m, metric)
+            elif self.encoding == "pq":
+                index = faiss.IndexHNSWPQ(
+                    dim, self.pq_m, self.hnsw_m, self.pq_nbits, metric
+                )
+            else:
+                index = faiss.IndexHNSWSQ(dim, qtype, self.hnsw_m, metric)
+            index.hnsw.efConstruction = self.ef_construction
+            return index
+        # faiss wants about 39 training vectors per list
+        nlist = self.nlist or min(int(4 * np.sqrt(num_train)), num_train // 39)
+        # k-means needs at least one training vector per list
+        nlist = max(1, min(nlist, num_train))
+        if self.nlist is not None and nlist < self.nlist:
+            logger.warning(
+                f"Only {num_train} training vectors, using nlist={nlist} instead of {self.nlist}"
+            )
+        quantizer = faiss.IndexFlat(dim, metric)
+        if self.encoding == "flat":
+            return faiss.IndexIVFFlat(quantizer, dim, nlist, metric)
+        if self.encoding == "pq":
+            return faiss.IndexIVFPQ(
+                quantizer, dim, nlist, self.pq_m, self.pq_nbits, metric
+            )
+        return faiss.IndexIVFScalarQuantizer(quantizer, dim, nlist, qtype, metric)
+
+    def needs_training(self) -> bool:
+        return self.index_type in ("ivf_flat", "ivf_pq") or self.encoding in (
+            "sq8",
+            "pq",
+        )
+
+    def prepare(self, embeddings: np.ndarray) -> np.ndarray:
+        """Embeddings as a contiguous float32 matrix, normalized for cosine"""
+        embeddings = np.ascontiguousarray(embeddings, dtype=np.float32)
+        if self.metric == "cosine":
+            embeddings = embeddings.copy()
+            faiss.normalize_L2(embeddings)
+        return embeddings
+
+    def pending_rows(self) -> int:
+        return sum(len(embeddings) for embeddings in self.pending)
 
-    def add_stream(self, stream: Iterable[str]):
-        for item in stream:
-            embeddings = self.get_embeddings(item)
-            assert len(embeddings.shape) == 2, "stream must be a iterable of prompts"
-            self.add_embeddings(embeddings, item)
-            self.splits.append(item)
+    def train(self, sample: Optional[np.ndarray] = None):
+        """Build and train the index on sample, by default the buffered
+        embeddings, then add the buffered embeddings to it"""
+        if self.index is not None:
+            return
+        if sample is None:
+            if not self.pending:
+                return
+            sample = np.concatenate(self.pending)
+        else:
+            sample = self.prepare(sample)
+        if len(sample) > self.train_size:
+            rows = np.random.default_rng(0).choice(
+                len(sample), self.train_size, replace=False
+            )
+            sample = sample[np.sort(rows)]
+        index = self.create_index(sample.shape[1], len(sample))
+        logger.debug(f"Training {self.index_type} index on {len(sample)} vectors")
+        index.train(sample)
+        self.index = index
+        pending, self.pending = self.pending, []
+        for embeddings in pending:
+            self.index.add(embeddings)
 
-    def add_embeddings(self, embedding: np.ndarray, prompt: str):
+    def add_vectors(self, embeddings: np.ndarray):
+        if self.read_only:
+            raise ValueError(
+                "Index was loaded with mmap=True and is read-only, load it without mmap to add to it"
+            )
+        embeddings = self.prepare(embeddings)
         if self.index is None:
-            self.index = faiss.IndexFlatL2(len(embedding[0]))
+            if not self.needs_training():
+                self.index = self.create_index(embeddings.shape[1])
+            else:
+                self.pending.append(embeddings)
+                if self.pending_rows() >= self.train_size:
+                    self.train()
+                return
+        self.index.add(embeddings)
+
+    def get_search_params(
+        self,
+        nprobe: Optional[int] = None,
+        ef_search: Optional[int] = None,
+        selector=None,
+    ):
+        """faiss SearchParameters of the index type, None if there are none.
+        The selector must be kept alive during the search."""
+        if self.index_type == "hnsw":
+            params = faiss.SearchParametersHNSW(efSearch=ef_search or self.ef_search)
+        elif self.index_type in ("ivf_flat", "ivf_pq"):
+            params = faiss.SearchParametersIVF(nprobe=nprobe or self.nprobe)
+        elif selector is not None:
+            params = faiss.SearchParameters()
+        else:
+            params = None
+        if selector is not None:
+            params.sel = selector
+        if self.rerank:
+            refine_params = faiss.IndexRefineSearchParameters(
+                k_factor=self.rerank_factor
+            )
+            if params is not None:
+                refine_params.base_index_params = params
+                # Keeps the base parameters alive with the refine parameters
+                refine_params.base_params = params
+            return refine_params
+        return params
+
+    def supports_selector(self) -> bool:
+        # IndexPQ takes no search parameters
+        return not (self.index_type == "flat" and self.encoding == "pq")
+
+    def add_stream(
+        self,
+        stream: Iterable[str],
+        batch_size: Optional[int] = None,
+        max_in_flight: Optional[int] = None,
+    ):
+        """Embed and add the prompts of stream to the index
+
+        Prompts are embedded in batches of batch_size, up to max_in_flight
+        batches at a time, while the finished batches are added to the index
+        in stream order.
+
+        Parameters
+        ----------
+        stream: Iterable[str]
+            Prompts to add
+
+        batch_size: Optional[int] = None
+            Prompts per embedding request, defaults to lamini.embedding_batch_size
+
+        max_in_flight: Optional[int] = None
+            Batches being embedded at a time, defaults to lamini.max_workers
+        """
+        batch_size = batch_size or int(lamini.embedding_batch_size)
+        max_in_flight = max_in_flight or int(lamini.max_workers)
+        iterator = iter(stream)
+        with ThreadPoolExecutor(max_workers=max_in_flight) as executor:
+            # (batch, future of its embeddings), oldest first
+            in_flight = collections.deque()
+            while True:
+                while len(in_flight) < max_in_flight:
+                    batch = list(itertools.islice(iterator, batch_size))
+                    if not batch:
+                        break
+                    assert all(
+                        isinstance(item, str) for item in batch
+                    ), "stream must be a iterable of prompts"
+                    in_flight.append(
+                        (batch, executor.submit(self.get_embeddings, batch))
+                    )
+                if not in_flight:
+                    break
+                batch, future = in_flight.popleft()
+                self.add_embeddings(future.result(), batch)
+        self.check_consistency()
+
+    def add_embeddings(
+        self,
+        embedding: np.ndarray,
+        prompt: Union[str, List[str]],
+        ids: Optional[Iterable[int]] = None,
+        metadata: Union[None, Dict[str, Any], List[Optional[Dict[str, Any]]]] = None,
+    ) -> np.ndarray:
+        """Add embeddings with one row per prompt, prompt may be a single one.
+        metadata is a dict per prompt, or one dict for all of them.
+        Returns the ids of the added splits, assigned from a counter if ids
+        is None."""
         assert len(embedding.shape) == 2, "stream must be a iterable of prompts"
-        self.index.add(embedding)
-        self.splits.append(prompt)
+        prompts = [prompt] if isinstance(prompt, str) else list(prompt)
+        assert len(prompts) == embedding.shape[0], "one embedding per prompt expected"
+        if metadata is None or isinstance(metadata, dict):
+            metadata = [metadata] * len(prompts)
+        metadata = list(metadata)
+        assert len(metadata) == len(prompts), "one metadata per prompt expected"
+        with self.lock:
+            if ids is None:
+                ids = np.arange(self.next_id, self.next_id + len(prompts))
+            ids = np.asarray(list(ids), dtype=np.int64)
+            assert len(ids) == len(prompts), "one id per prompt expected"
+            duplicates = ids[self.lookup_rows(ids) >= 0].tolist()
+            if duplicates or len(np.unique(ids)) != len(ids):
+                raise ValueError(
+                    f"Split ids {duplicates or ids.tolist()} are not unique, use upsert to replace splits"
+                )
+            start = len(self.splits)
+            self.add_vectors(embedding)
+            self.splits.extend(prompts)
+            self.metadata.extend(metadata)
+            self.id_chunks.append(ids)
+            self.id_map.add(ids, start)
+            if len(ids):
+                self.next_id = max(self.next_id, int(ids.max()) + 1)
+            self.record(
+                {
+                    "op": "add",
+                    "ids": ids.tolist(),
+                    "texts": prompts,
+                    "metadata": metadata,
+                    "embeddings": embedding,
+                }
+            )
+            return ids
+
+    def delete(self, ids: Iterable[int]) -> int:
+        """Delete the splits with the given ids, returning how many existed"""
+        with self.lock:
+            ids = [int(id) for id in ids]
+            rows = self.lookup_rows(np.unique(np.asarray(ids, dtype=np.int64)))
+            deleted = rows[rows >= 0].tolist()
+            self.deleted.update(deleted)
+            self.deleted_selector = None
+            self.record({"op": "delete", "ids": ids})
+            return len(deleted)
+
+    def upsert(
+        self,
+        ids: Iterable[int],
+        embedding: np.ndarray,
+        prompt: Union[str, List[str]],
+        metadata: Union[None, Dict[str, Any], List[Optional[Dict[str, Any]]]] = None,
+    ) -> np.ndarray:
+        """Add splits, replacing the existing ones with the same ids"""
+        ids = [int(id) for id in ids]
+        with self.lock:
+            self.delete(ids)
+            return self.add_embeddings(embedding, prompt, ids, metadata)
+
+    def apply(self, record: dict):
+        """Apply a record of an IndexDelta"""
+        if record["op"] == "add":
+            self.upsert(
+                record["ids"],
+                record["embeddings"],
+                record["texts"],
+                record.get("metadata"),
+            )
+        elif record["op"] == "delete":
+            self.delete(record["ids"])
+        else:
+            raise ValueError(f"Unknown delta record {record['op']}")
+
+    def record(self, record: dict):
+        self.version += 1
+        # Changes are only journaled for an index that was saved
+        if self.path is not None:
+            self.journal.append(record)
+
+    def get_ids(self) -> np.ndarray:
+        """Split ids in row order"""
+        with self.lock:
+            if len(self.id_chunks) != 1:
+                self.id_chunks = [
+                    (
+                        np.concatenate(self.id_chunks)
+                        if self.id_chunks
+                        else np.zeros(0, dtype=np.int64)
+                    )
+                ]
+            return self.id_chunks[0]
+
+    def get_id_map(self) -> IdMap:
+        """Map of split ids to rows, built from the ids when first needed"""
+        with self.lock:
+            if self.id_map is None:
+                ids = self.get_ids()
+                self.id_map = IdMap()
+                # The saved ids are sorted by their saved order
+                saved = 0 if self.id_order is None else len(self.id_order)
+                self.id_map.add(ids[:saved], 0, self.id_order)
+                self.id_map.add(ids[saved:], saved)
+            return self.id_map
+
+    def lookup_rows(self, ids: np.ndarray) -> np.ndarray:
+        """Rows of the splits with the given ids, -1 for ids that don't exist
+        or were deleted"""
+        with self.lock:
+            rows = self.get_id_map().lookup(ids)
+            if self.deleted:
+                deleted = np.fromiter(self.deleted, np.int64, len(self.deleted))
+                rows[np.isin(rows, deleted)] = -1
+            return rows
+
+    def get_deleted_selector(self):
+        """faiss IDSelector excluding deleted rows, None if there are none"""
+        with self.lock:
+            if not self.deleted:
+                return None
+            if self.deleted_selector is None:
+                batch = faiss.IDSelectorBatch(
+                    np.fromiter(self.deleted, dtype=np.int64, count=len(self.deleted))
+                )
+                # The python objects own the C++ ones, so both are kept
+                self.deleted_selector = (faiss.IDSelectorNot(batch), batch)
+            return self.deleted_selector[0]
+
+    def get_filter_selector(self, filter: Dict[str, Any]):
+        """faiss IDSelector of the rows matching filter that were not deleted,
+        and their boolean mask"""
+        with self.lock:
+            key = json.dumps(filter, sort_keys=True, default=str)
+            if self.filter_cache is None or self.filter_cache[:2] != (
+                key,
+                self.version,
+            ):
+                mask = self.metadata.match(filter)
+                mask[list(self.deleted)] = False
+                bitmap = np.packbits(mask, bitorder="little")
+                # The bitmap is referenced, not copied, by the selector
+                selector = faiss.IDSelectorBitmap(len(mask), faiss.swig_ptr(bitmap))
+                self.filter_cache = (key, self.version, mask, bitmap, selector)
+            return self.filter_cache[4], self.filter_cache[2]
+
+    def get_metadata(self, id: int) -> Dict[str, Any]:
+        """Metadata of the split with the given id"""
+        with self.lock:
+            row = int(self.lookup_rows(np.asarray([id], dtype=np.int64))[0])
+            if row < 0:
+                raise KeyError(id)
+            return self.metadata.get(row)
+
+    def get_vectors(self, max_rows: Optional[int] = None, seed: int = 0) -> np.ndarray:
+        """Vectors of the splits that were not deleted, a random sample of
+        max_rows of them if given. They are decoded, so they are only exact
+        for the flat encoding or with rerank."""
+        with self.lock:
+            self.train()
+            rows = np.flatnonzero(
+                ~np.isin(np.arange(self.index.ntotal), list(self.deleted))
+            )
+            if max_rows is not None and len(rows) > max_rows:
+                rows = np.sort(
+                    np.random.default_rng(seed).choice(rows, max_rows, replace=False)
+                )
+            return reconstruct_rows(self.index, rows)
+
+    def check_consistency(self):
+        """Check that every vector in the index has its split and id"""
+        ntotal = 0 if self.index is None else self.index.ntotal
+        ntotal += self.pending_rows()
+        num_ids = sum(len(ids) for ids in self.id_chunks)
+        if not ntotal == len(self.splits) == num_ids == len(self.metadata):
+            raise ValueError(
+                f"Index has {ntotal} vectors but {len(self.splits)} splits, {num_ids} ids and {len(self.metadata)} metadata rows"
+            )
 
     def add_batch(self, batch: List[str]):
         try:
             embeddings = self.get_embeddings(batch)
-            assert len(embeddings.shape) == 3, "batch must be a list of prompts"
-            if self.index is None:
-                self.index = faiss.IndexFlatL2(len(embeddings[0][0]))
-            for emb in embeddings:
-                self.index.add(emb)
-
-            # save the splits
-            self.splits.extend(batch)
+            assert len(embeddings.shape) == 2, "batch must be a list of prompts"
+            self.add_embeddings(embeddings, batch)
         except:
             print("Error in adding embeddings to index.")
 
-    def query_with_embedding(self, embedding: np.ndarray, k=5):
-        embedding_array = np.array([embedding])
+    def query_with_embedding(
+        self,
+        embedding: np.ndarray,
+        k=5,
+        nprobe: Optional[int] = None,
+        ef_search: Optional[int] = None,
+        filter: Optional[Dict[str, Any]] = None,
+    ):
+        embedding_array = np.asarray(embedding, dtype=np.float32).reshape(1, -1)
+        return self.query_batch(embedding_array, k, nprobe, ef_search, filter)[0]
+
+    def search_rows(
+        self,
+        embeddings: np.ndarray,
+        k=5,
+        nprobe: Optional[int] = None,
+        ef_search: Optional[int] = None,
+        filter: Optional[Dict[str, Any]] = None,
+    ):
+        """search, returning rows instead of ids"""
+        assert len(embeddings.shape) == 2, "embeddings must be a (m, d) matrix"
+        embeddings = self.prepare(embeddings)
+        self.train()
+        allowed = None
+        if filter is not None:
+            selector, allowed = self.get_filter_selector(filter)
+        else:
+            selector = self.get_deleted_selector()
+        if selector is None or self.supports_selector():
+            return self.index.search(
+                embeddings,
+                k,
+                params=self.get_search_params(nprobe, ef_search, selector),
+            )
+        # The search is exhaustive, so searching as many more neighbors as
+        # there are excluded rows finds k that were not excluded
+        if allowed is None:
+            allowed = np.ones(self.index.ntotal, dtype=bool)
+            allowed[list(self.deleted)] = False
+        excluded = len(allowed) - int(allowed.sum())
+        distances, rows = self.index.search(
+            embeddings,
+            max(k, min(self.index.ntotal, k + excluded)),
+            params=self.get_search_params(nprobe, ef_search),
+        )
+        rows = np.where((rows >= 0) & allowed[np.maximum(rows, 0)], rows, -1)
+        order = np.argsort(rows < 0, axis=1, kind="stable")[:, :k]
+        return (
+            np.take_along_axis(distances, order, axis=1),
+            np.take_along_axis(rows, order, axis=1),
+        )
+
+    def search(
+        self,
+        embeddings: np.ndarray,
+        k=5,
+        nprobe: Optional[int] = None,
+        ef_search: Optional[int] = None,
+        filter: Optional[Dict[str, Any]] = None,
+    ):
+        """Search the k nearest neighbors of every row of an (m, d) matrix in
+        one call, returning the (m, k) distances and split ids, -1 for missing
+        ones. With a filter, only splits whose metadata matches it are
+        searched, see MetadataStore."""
+        distances, rows = self.search_rows(embeddings, k, nprobe, ef_search, filter)
+        ids = np.where(rows >= 0, self.get_ids()[np.maximum(rows, 0)], -1)
+        return distances, ids
 
-        # get the k nearest neighbors
-        _, indices = self.index.search(embedding_array, k)
+    def query_batch(
+        self,
+        embeddings: np.ndarray,
+        k=5,
+        nprobe: Optional[int] = None,
+        ef_search: Optional[int] = None,
+        filter: Optional[Dict[str, Any]] = None,
+    ) -> List[List[str]]:
+        """Splits of the k nearest neighbors of every row of an (m, d) matrix"""
+        _, indices = self.search_rows(embeddings, k, nprobe, ef_search, filter)
 
-        return [self.splits[i] for i in indices[0]]
+        # Approximate indexes return -1 when they find less than k neighbors
+        return [[self.splits[i] for i in row if i >= 0] for row in indices]
 
     @staticmethod
-    def build_index(loader: List[List[str]]) -> "LaminiIndex":
-        lamini_index = LaminiIndex()
+    def build_index(
+        loader: List[List[str]], first_id: int = 0, **kwargs
+    ) -> "LaminiIndex":
+        """Build an index from batches of splits, numbering them from
+        first_id, kwargs are passed to LaminiIndex"""
+        lamini_index = LaminiIndex(**kwargs)
         lamini_index.init_index()
+        lamini_index.next_id = first_id
         total_batches = len(loader)
         print(f"Building index with {total_batches} batches")
 
         # load a batch of splits from a generator
         for split_batch in tqdm(loader):
             lamini_index.add_batch(split_batch)
+        lamini_index.train()
         return lamini_index
 
     def get_embeddings(self, examples: Union[str, List[str]]):
-        embeddings = self.embedding_api.generate(examples)
-        return np.array(embeddings)
+        return self.embedding_api.generate(examples)
 
     def save_index(self, path: str):
-        faiss_path = os.path.join(path, "index.faiss")
-        splits_path = os.path.join(path, "splits.json")
+        """Write the whole index to path, without its deleted splits, and
+        save changes made from now on as a delta of it"""
+        with self.lock:
+            self.train()
+            os.makedirs(path, exist_ok=True)
+            index, ids, data_path = self.write_compacted(
+                path, self.snapshot(clone=bool(self.deleted))
+            )
+            IndexDelta(path).clear()
+            self.use_compacted(data_path, index, ids)
+            self.path = path
+            self.journal = []
+
+    def save_delta(self):
+        """Append the changes since the index was saved or loaded to the delta
+        of its directory"""
+        with self.lock:
+            if self.path is None:
+                raise ValueError("The index was never saved, use save_index")
+            IndexDelta(self.path).append(self.journal)
+            self.journal = []
+
+    def compact(self, background: bool = False) -> Optional[Future]:
+        """Fold the delta into the saved index and drop deleted splits
 
-        logger.debug("Saving index to %s", faiss_path)
-        logger.debug("Saving splits to %s", splits_path)
+        The index is copied while holding the lock, and then written without
+        blocking other changes, which are kept in the delta. With background,
+        compaction runs in a thread and a Future of it is returned.
+        """
+        if background:
+            executor = ThreadPoolExecutor(max_workers=1)
+            future = executor.submit(self.compact)
+            executor.shutdown(wait=False)
+            return future
+        with self.lock:
+            if self.path is None:
+                raise ValueError("The index was never saved, use save_index")
+            self.train()
+            self.save_delta()
+            path = self.path
+            delta = IndexDelta(path)
+            position = delta.size()
+            snapshot = self.snapshot(clone=True)
+            version = self.version
+        index, ids, data_path = self.write_compacted(path, snapshot)
+        with self.lock:
+            delta.truncate(position)
+            if self.version == version:
+                # Nothing changed meanwhile, so the compacted index can be used
+                self.use_compacted(data_path, index, ids)
 
-        logger.debug("Index size: %d", self.index.ntotal)
+    def use_compacted(self, data_path: str, index, ids: np.ndarray):
+        if not self.read_only:
+            self.index = index
+        self.splits = SplitsStore(data_path)
+        self.metadata = MetadataStore(data_path)
+        self.id_chunks = [ids]
+        self.id_map = None
+        self.id_order = load_id_order(data_path)
+        self.deleted = set()
+        self.deleted_selector = None
+
+    def snapshot(self, clone):
+        if self.read_only and self.deleted:
+            raise ValueError(
+                "Index was loaded with mmap=True and is read-only, load it without mmap to compact it"
+            )
+        index = self.index
+        if clone and index is not None and not self.read_only:
+            index = faiss.clone_index(index)
+        return (
+            index,
+            len(self.splits),
+            self.get_ids(),
+            sorted(self.deleted),
+            self.metadata.snapshot(),
+        )
+
+    def write_compacted(self, path: str, snapshot):
+        """Write a snapshot without its deleted rows to the next generation
+        directory of path and switch the manifest to it, returning its index,
+        ids and directory"""
+        index, num_rows, ids, deleted, metadata = snapshot
+        keep = np.ones(num_rows, dtype=bool)
+        keep[deleted] = False
+        if deleted:
+            index = self.remove_rows(index, deleted, keep)
+        ids = np.ascontiguousarray(ids[:num_rows][keep])
+
+        generation = get_generation(path) + 1
+        data_path = os.path.join(path, f"generation-{generation}")
+        # Left over by a compaction that didn't finish
+        shutil.rmtree(data_path, ignore_errors=True)
+        os.makedirs(data_path)
+
+        logger.debug("Saving index to %s", data_path)
+        logger.debug("Index size: %d", 0 if index is None else index.ntotal)
 
         # Save the index to a file
-        faiss.write_index(self.index, faiss_path)
+        faiss.write_index(index, os.path.join(data_path, "index.faiss"))
+        np.save(os.path.join(data_path, "ids.npy"), ids)
+        np.save(os.path.join(data_path, "id_order.npy"), np.argsort(ids, kind="stable"))
 
         # Save the splits to a file
-        with open(splits_path, "w") as f:
-            json.dump(self.splits, f)
+        SplitsStore.write(
+            data_path, (self.splits[row] for row in range(num_rows) if keep[row])
+        )
+        metadata.write(data_path, keep)
+
+        # Save the index parameters to a file
+        with open(os.path.join(data_path, "params.json"), "w") as f:
+            json.dump(self.get_params(), f)
+
+        write_manifest(path, generation)
+        remove_generations(path, generation)
+        return index, ids, data_path
+
+    def remove_rows(self, index, deleted: List[int], keep: np.ndarray):
+        """Remove rows from an index the caller owns, renumbering the rest in
+        order"""
+        if self.index_type == "hnsw":
+            # HNSW graphs can't remove nodes, so the index is rebuilt from the
+            # reconstructed vectors, exact with flat encoding or rerank. Only
+            # the kept rows are reconstructed, a chunk at a time.
+            kept = np.flatnonzero(keep)
+            sample = kept
+            if len(sample) > self.train_size:
+                sample = np.sort(
+                    np.random.default_rng(0).choice(
+                        sample, self.train_size, replace=False
+                    )
+                )
+            rebuilt = self.create_index(index.d, len(sample))
+            if not rebuilt.is_trained:
+                rebuilt.train(reconstruct_rows(index, sample))
+            for start in range(0, len(kept), RECONSTRUCT_CHUNK_SIZE):
+                rebuilt.add(
+                    reconstruct_rows(
+                        index, kept[start : start + RECONSTRUCT_CHUNK_SIZE]
+                    )
+                )
+            return rebuilt
+        selector = faiss.IDSelectorBatch(np.asarray(deleted, np.int64))
+        base = index
+        if isinstance(index, faiss.IndexRefine):
+            base = faiss.downcast_index(index.base_index)
+            faiss.downcast_index(index.refine_index).remove_ids(selector)
+        if self.index_type == "flat":
+            base.remove_ids(selector)
+        else:
+            self.remove_ivf_rows(base, keep)
+        index.ntotal = int(keep.sum())
+        return index
+
+    def remove_ivf_rows(self, index, keep: np.ndarray):
+        # IVF entries are copied to emptied lists under their new row number
+        new_rows = np.cumsum(keep) - 1
+        ivf = faiss.extract_index_ivf(index)
+        # The direct map, if reconstruct_rows made one, is rebuilt once the
+        # entries are renumbered.
+        direct_map = ivf.direct_map.type != faiss.DirectMap.NoMap
+        ivf.make_direct_map(False)
+        invlists = ivf.invlists
+        lists = []
+        for list_no in range(ivf.nlist):
+            size = invlists.list_size(list_no)
+            if size == 0:
+                continue
+            ids_ptr = invlists.get_ids(list_no)
+            codes_ptr = invlists.get_codes(list_no)
+            rows = faiss.rev_swig_ptr(ids_ptr, size).copy()
+            codes = faiss.rev_swig_ptr(codes_ptr, size * invlists.code_size).copy()
+            invlists.release_ids(list_no, ids_ptr)
+            invlists.release_codes(list_no, codes_ptr)
+            kept = keep[rows]
+            lists.append(
+                (
+                    list_no,
+                    np.ascontiguousarray(new_rows[rows[kept]], dtype=np.int64),
+                    np.ascontiguousarray(codes.reshape(size, -1)[kept]),
+                )
+            )
+        ivf.reset()
+        for list_no, rows, codes in lists:
+            invlists.add_entries(
+                list_no, len(rows), faiss.swig_ptr(rows), faiss.swig_ptr(codes)
+            )
+        ivf.ntotal = int(keep.sum())
+        if direct_map:
+            ivf.make_direct_map(True)
+
+
+def reconstruct_rows(index, rows: np.ndarray) -> np.ndarray:
+    """Decoded vectors of the given rows of index, without decoding the
+    others"""
+    rows = np.ascontiguousarray(rows, dtype=np.int64)
+    if len(rows) == 0:
+        return np.zeros((0, index.d), dtype=np.float32)
+    # Re-ranked indexes reconstruct from their flat refine index, IVF indexes
+    # need a direct map from rows to their inverted list entries.
+    if not isinstance(index, faiss.IndexRefine):
+        ivf = faiss.try_extract_index_ivf(index)
+        if ivf is not None and ivf.direct_map.type == faiss.DirectMap.NoMap:
+            ivf.make_direct_map()
+    return index.reconstruct_batch(rows)
+
+
+def get_generation(path: str) -> int:
+    """Generation manifest.json of path points to, 0 for indexes saved
+    before there were generations"""
+    manifest_path = os.path.join(path, "manifest.json")
+    if not os.path.exists(manifest_path):
+        return 0
+    with open(manifest_path, "r") as f:
+        return json.load(f)["generation"]
+
+
+def get_data_path(path: str) -> str:
+    """Directory of the files of the index saved to path"""
+    generation = get_generation(path)
+    if generation == 0:
+        return path
+    return os.path.join(path, f"generation-{generation}")
+
+
+def write_manifest(path: str, generation: int):
+    """Switch the index saved to path to generation, atomically"""
+    manifest_path = os.path.join(path, "manifest.json")
+    with open(manifest_path + ".tmp", "w") as f:
+        json.dump({"generation": generation}, f)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(manifest_path + ".tmp", manifest_path)
+
+
+def remove_generations(path: str, generation: int):
+    """Remove the generations of path before the previous one, which readers
+    of the last manifest may still be loading"""
+    for name in os.listdir(path):
+        match = re.fullmatch(r"generation-(\d+)", name)
+        if match and int(match.group(1)) < generation - 1:
+            shutil.rmtree(os.path.join(path, name), ignore_errors=True)
+    if generation >= 2:
+        for pattern in LEGACY_FILES:
+            for legacy_path in glob.glob(os.path.join(path, pattern)):
+                os.remove(legacy_path)
+
+
+def load_id_order(data_path: str, default: Optional[np.ndarray] = None):
+    """np.argsort of the ids saved to data_path, default if it wasn't saved"""
+    order_path = os.path.join(data_path, "id_order.npy")
+    if not os.path.exists(order_path):
+        return default
+    return np.load(order_path, mmap_mode="r")
+
+
+def get_mmap_flags(index_type: str) -> int:
+    flags = faiss.IO_FLAG_MMAP | faiss.IO_FLAG_READ_ONLY
+    if index_type in ("ivf_flat", "ivf_pq"):
+        # Inverted lists are mapped from the file by IO_FLAG_MMAP
+        return flags
+    # Flat codes are only mapped by faiss >= 1.8, older versions read them
+    return flags | getattr(faiss, "IO_FLAG_MMAP_IFC", 0)
+
+
+def configure_faiss_threads():
+    """Limit FAISS to lamini.faiss_num_threads OpenMP threads, if it is set"""
+    if lamini.faiss_num_threads is not None:
+        faiss.omp_set_num_threads(int(lamini.faiss_num_threads))
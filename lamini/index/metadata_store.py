@@ -0,0 +1,143 @@
+import json
+import logging
+import os
+from typing import Any, Dict, Iterable, List, Optional
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+
+class MetadataStore:
+    """Metadata of the splits of a LaminiIndex, e.g. {"tenant": "acme"}
+
+    Every field is a column of int32 codes, one per row, -1 for rows without
+    the field, and the list of its distinct values. Values must be json
+    serializable scalars.
+
+    Files in directory:
+        metadata.json: number of rows and the values of every field
+        metadata-<i>.npy: codes of the i-th field, memory mapped on load
+
+    A filter maps fields to a value or a list of values, and matches the rows
+    that have one of the values for every field, e.g.
+    {"tenant": "acme", "doc_type": ["pdf", "html"]}.
+
+    Parameters
+    ----------
+    directory: Optional[str] = None
+        Directory to load the store from, empty if None
+
+    num_rows: int = 0
+        Rows of a store without metadata, for indexes saved before
+        metadata.json existed
+    """
+
+    def __init__(self, directory: Optional[str] = None, num_rows: int = 0):
+        self.num_rows = num_rows
+        # field -> list of code arrays, concatenated when needed
+        self.columns: Dict[str, List[np.ndarray]] = {}
+        self.values: Dict[str, List[Any]] = {}
+        # field -> value -> code
+        self.codes: Dict[str, Dict[Any, int]] = {}
+        if directory is not None and os.path.exists(
+            os.path.join(directory, "metadata.json")
+        ):
+            self.load(directory)
+
+    def load(self, directory: str):
+        with open(os.path.join(directory, "metadata.json"), "r") as f:
+            meta = json.load(f)
+        self.num_rows = meta["num_rows"]
+        for i, (field, values) in enumerate(meta["fields"]):
+            self.columns[field] = [
+                np.load(os.path.join(directory, f"metadata-{i}.npy"), mmap_mode="r")
+            ]
+            self.values[field] = values
+            self.codes[field] = {value: code for code, value in enumerate(values)}
+
+    def write(self, directory: str, keep: Optional[np.ndarray] = None):
+        """Write the rows selected by the boolean mask keep, all if None"""
+        fields = []
+        for i, field in enumerate(self.columns):
+            column = self.column(field)
+            if keep is not None:
+                column = column[keep[: len(column)]]
+            path = os.path.join(directory, f"metadata-{i}.npy")
+            with open(path + ".tmp", "wb") as f:
+                np.save(f, np.ascontiguousarray(column))
+            os.replace(path + ".tmp", path)
+            fields.append([field, self.values[field]])
+        num_rows = self.num_rows if keep is None else int(keep[: self.num_rows].sum())
+        path = os.path.join(directory, "metadata.json")
+        with open(path + ".tmp", "w") as f:
+            json.dump({"num_rows": num_rows, "fields": fields}, f)
+        os.replace(path + ".tmp", path)
+
+    def snapshot(self) -> "MetadataStore":
+        """Copy of the store that isn't changed by later extend calls"""
+        store = MetadataStore(num_rows=self.num_rows)
+        for field in self.columns:
+            store.columns[field] = [self.column(field)]
+            store.values[field] = list(self.values[field])
+        return store
+
+    def __len__(self) -> int:
+        return self.num_rows
+
+    def encode(self, field: str, value: Any) -> int:
+        if value is None:
+            return -1
+        codes = self.codes[field]
+        code = codes.get(value)
+        if code is None:
+            code = len(self.values[field])
+            codes[value] = code
+            self.values[field].append(value)
+        return code
+
+    def extend(self, metadata: Iterable[Optional[Dict[str, Any]]]):
+        """Add the metadata of new rows, None for rows without any"""
+        metadata = [m or {} for m in metadata]
+        for m in metadata:
+            for field in m:
+                if field not in self.columns:
+                    self.columns[field] = [np.full(self.num_rows, -1, dtype=np.int32)]
+                    self.values[field] = []
+                    self.codes[field] = {}
+        for field, chunks in self.columns.items():
+            chunks.append(
+                np.fromiter(
+                    (self.encode(field, m.get(field)) for m in metadata),
+                    dtype=np.int32,
+                    count=len(metadata),
+                )
+            )
+        self.num_rows += len(metadata)
+
+    def column(self, field: str) -> np.ndarray:
+        chunks = self.columns[field]
+        if len(chunks) != 1:
+            self.columns[field] = chunks = [np.concatenate(chunks)]
+        return chunks[0]
+
+    def get(self, row: int) -> Dict[str, Any]:
+        """Metadata of a row"""
+        metadata = {}
+        for field in self.columns:
+            code = int(self.column(field)[row])
+            if code >= 0:
+                metadata[field] = self.values[field][code]
+        return metadata
+
+    def match(self, filter: Dict[str, Any]) -> np.ndarray:
+        """Boolean mask of the rows matching filter"""
+        mask = np.ones(self.num_rows, dtype=bool)
+        for field, values in filter.items():
+            if field not in self.columns:
+                return np.zeros(self.num_rows, dtype=bool)
+            if not isinstance(values, (list, tuple, set)):
+                values = [values]
+            codes = [self.codes[field][v] for v in values if v in self.codes[field]]
+            mask &= np.isin(self.column(field), codes)
+        return mask
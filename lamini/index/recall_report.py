@@ -0,0 +1,92 @@
+import logging
+from typing import Any, Dict, List
+
+import faiss
+import numpy as np
+from lamini.index.lamini_index import ENCODINGS, LaminiIndex
+
+logger = logging.getLogger(__name__)
+
+
+def get_default_configurations(lamini_index: LaminiIndex) -> List[Dict[str, Any]]:
+    """Every encoding of the index type and metric of lamini_index, with and
+    without rerank"""
+    params = lamini_index.get_params()
+    index_type = (
+        "ivf_flat" if params["index_type"] == "ivf_pq" else params["index_type"]
+    )
+    return [
+        dict(params, index_type=index_type, encoding=encoding, rerank=rerank)
+        for encoding in ENCODINGS
+        for rerank in ((False,) if encoding == "flat" else (False, True))
+    ]
+
+
+def recall_report(
+    embeddings: np.ndarray,
+    configurations: List[Dict[str, Any]],
+    k: int = 10,
+    num_queries: int = 1000,
+    seed: int = 0,
+) -> List[Dict[str, Any]]:
+    """Recall and memory of index configurations on a sample of indexed data
+
+    Every configuration is built on embeddings and searched with num_queries
+    of its rows. The results are compared to an exact search with the same
+    metric.
+
+    Parameters
+    ----------
+    embeddings: np.ndarray
+        (n, d) embeddings to build the indexes from, e.g. a sample of
+        LaminiIndex.get_vectors()
+
+    configurations: List[Dict[str, Any]]
+        LaminiIndex parameters of every index to compare, see
+        get_default_configurations
+
+    k: int = 10
+        Neighbors searched per query
+
+    num_queries: int = 1000
+        Rows of embeddings used as queries
+
+    seed: int = 0
+        Seed of the query sample
+
+    Returns
+    -------
+    List[Dict[str, Any]]
+        The configurations with their "recall" at k, and the "bytes" and
+        "bytes_per_vector" of their serialized index
+    """
+    embeddings = np.ascontiguousarray(embeddings, dtype=np.float32)
+    rng = np.random.default_rng(seed)
+    rows = rng.choice(len(embeddings), min(num_queries, len(embeddings)), replace=False)
+    queries = embeddings[rows]
+    exact: Dict[str, np.ndarray] = {}
+    report = []
+    for configuration in configurations:
+        metric = configuration.get("metric", "l2")
+        if metric not in exact:
+            exact_index = LaminiIndex(metric=metric)
+            exact_index.add_vectors(embeddings)
+            exact[metric] = exact_index.search_rows(queries, k)[1]
+        lamini_index = LaminiIndex(**configuration)
+        lamini_index.add_vectors(embeddings)
+        lamini_index.train()
+        _, found = lamini_index.search_rows(queries, k)
+        hits = sum(
+            len(set(a[a >= 0].tolist()) & set(b.tolist()))
+            for a, b in zip(found, exact[metric])
+        )
+        size = len(faiss.serialize_index(lamini_index.index))
+        result = dict(
+            configuration,
+            recall=hits / (len(queries) * k),
+            bytes=size,
+            bytes_per_vector=size / len(embeddings),
+        )
+        logger.info(f"Recall report: {result}")
+        report.append(result)
+    return report
@@ -0,0 +1,280 @@
+import json
+import logging
+import os
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from typing import Any, Dict, Iterable, List, Optional, Union
+
+import numpy as np
+from lamini.index.lamini_index import LaminiIndex, configure_faiss_threads
+
+logger = logging.getLogger(__name__)
+
+# Ids of the splits of shard i built by ShardedLaminiIndex.build start at
+# i * SHARD_ID_STRIDE
+SHARD_ID_STRIDE = 1 << 40
+
+
+class ShardedLaminiIndex:
+    """LaminiIndex split into shards, searched concurrently
+
+    Every shard is a LaminiIndex saved in its own directory, so shards can be
+    built independently, e.g. in parallel processes with build(). A query is
+    searched in all shards on a thread pool, FAISS releasing the GIL while it
+    searches, and the top k of the shards are merged.
+
+    FAISS also parallelizes every search with OpenMP, set
+    lamini.faiss_num_threads so that the shards and the asyncio pipeline
+    don't oversubscribe the cores.
+
+    Split ids must be unique across shards, build() numbers the splits of
+    shard i from i * SHARD_ID_STRIDE. New splits are added to the shard whose
+    range their id is in, id // SHARD_ID_STRIDE.
+
+    close() stops the threads searching the shards.
+
+    Parameters
+    ----------
+    shards: List[LaminiIndex]
+        Shards of the index
+
+    max_workers: Optional[int] = None
+        Threads searching shards, one per shard by default
+    """
+
+    def __init__(self, shards: List[LaminiIndex], max_workers: Optional[int] = None):
+        assert len(shards) > 0, "an index needs at least one shard"
+        configure_faiss_threads()
+        self.shards = shards
+        self.max_workers = max_workers or len(shards)
+        self.executor = ThreadPoolExecutor(
+            max_workers=self.max_workers, thread_name_prefix="lamini-index-shard"
+        )
+
+    @staticmethod
+    def get_shard_path(path: str, shard: int) -> str:
+        return os.path.join(path, f"shard-{shard:05d}")
+
+    @staticmethod
+    def load_index(
+        path: str, mmap: bool = False, max_workers: Optional[int] = None
+    ) -> "ShardedLaminiIndex":
+        """Load an index saved with save_index or build, shards are loaded
+        concurrently"""
+        with open(os.path.join(path, "shards.json"), "r") as f:
+            shard_paths = json.load(f)["shards"]
+        with ThreadPoolExecutor(max_workers=max_workers or len(shard_paths)) as pool:
+            shards = list(
+                pool.map(
+                    lambda shard_path: LaminiIndex.load_index(
+                        os.path.join(path, shard_path), mmap=mmap
+                    ),
+                    shard_paths,
+                )
+            )
+        return ShardedLaminiIndex(shards, max_workers=max_workers)
+
+    def save_index(self, path: str):
+        """Save every shard to its own directory under path"""
+        shard_paths = []
+        for i, shard in enumerate(self.shards):
+            shard_path = self.get_shard_path(path, i)
+            os.makedirs(shard_path, exist_ok=True)
+            shard.save_index(shard_path)
+            shard_paths.append(os.path.basename(shard_path))
+        write_shards(path, shard_paths)
+
+    @staticmethod
+    def build(
+        path: str,
+        loaders: List[List[List[str]]],
+        max_workers: Optional[int] = None,
+        **kwargs,
+    ) -> "ShardedLaminiIndex":
+        """Build a shard from every loader, each in its own process, and save
+        them under path
+
+        Parameters
+        ----------
+        path: str
+            Directory to save the index to
+
+        loaders: List[List[List[str]]]
+            Batches of splits of every shard, see LaminiIndex.build_index
+
+        max_workers: Optional[int] = None
+            Processes building shards, one per shard by default
+
+        kwargs:
+            Passed to LaminiIndex, e.g. index_type
+        """
+        shard_paths = [
+            ShardedLaminiIndex.get_shard_path(path, i) for i in range(len(loaders))
+        ]
+        with ProcessPoolExecutor(max_workers=max_workers or len(loaders)) as pool:
+            futures = [
+                pool.submit(
+                    build_shard, shard_path, loader, i * SHARD_ID_STRIDE, kwargs
+                )
+                for i, (shard_path, loader) in enumerate(zip(shard_paths, loaders))
+            ]
+            for future in futures:
+                future.result()
+        write_shards(path, [os.path.basename(p) for p in shard_paths])
+        return ShardedLaminiIndex.load_index(path)
+
+    def map_shards(self, func) -> list:
+        """Call func on every shard concurrently, returning the results in
+        shard order"""
+        return list(self.executor.map(func, self.shards))
+
+    def search_rows(
+        self,
+        embeddings: np.ndarray,
+        k=5,
+        nprobe: Optional[int] = None,
+        ef_search: Optional[int] = None,
+        filter: Optional[Dict[str, Any]] = None,
+    ):
+        """Search all shards and merge their top k, returning the (m, k)
+        distances, shards and rows, -1 for missing ones"""
+        embeddings = np.ascontiguousarray(embeddings, dtype=np.float32)
+        results = self.map_shards(
+            lambda shard: shard.search_rows(embeddings, k, nprobe, ef_search, filter)
+        )
+        distances = np.concatenate([d for d, _ in results], axis=1)
+        rows = np.concatenate([r for _, r in results], axis=1)
+        shards = np.repeat(
+            np.arange(len(self.shards)), [r.shape[1] for _, r in results]
+        )
+        shards = np.broadcast_to(shards, rows.shape)
+        # Inner product and cosine are similarities, larger ones rank first
+        keys = distances if self.shards[0].metric == "l2" else -distances
+        # Missing neighbors sort last
+        keys = np.where(rows >= 0, keys, np.inf)
+        order = np.argsort(keys, axis=1, kind="stable")[:, :k]
+        rows = np.take_along_axis(rows, order, axis=1)
+        shards = np.where(rows >= 0, np.take_along_axis(shards, order, axis=1), -1)
+        return np.take_along_axis(distances, order, axis=1), shards, rows
+
+    def search(
+        self,
+        embeddings: np.ndarray,
+        k=5,
+        nprobe: Optional[int] = None,
+        ef_search: Optional[int] = None,
+        filter: Optional[Dict[str, Any]] = None,
+    ):
+        """Search the k nearest neighbors of every row of an (m, d) matrix in
+        all shards, returning the (m, k) distances and split ids"""
+        distances, shards, rows = self.search_rows(
+            embeddings, k, nprobe, ef_search, filter
+        )
+        ids = np.full(rows.shape, -1, dtype=np.int64)
+        for i, shard in enumerate(self.shards):
+            hits = shards == i
+            ids[hits] = shard.get_ids()[rows[hits]]
+        return distances, ids
+
+    def query_batch(
+        self,
+        embeddings: np.ndarray,
+        k=5,
+        nprobe: Optional[int] = None,
+        ef_search: Optional[int] = None,
+        filter: Optional[Dict[str, Any]] = None,
+    ) -> List[List[str]]:
+        """Splits of the k nearest neighbors of every row of an (m, d) matrix"""
+        _, shards, rows = self.search_rows(embeddings, k, nprobe, ef_search, filter)
+        return [
+            [self.shards[s].splits[r] for s, r in zip(shard_row, row) if r >= 0]
+            for shard_row, row in zip(shards.tolist(), rows.tolist())
+        ]
+
+    def query_with_embedding(
+        self,
+        embedding: np.ndarray,
+        k=5,
+        nprobe: Optional[int] = None,
+        ef_search: Optional[int] = None,
+        filter: Optional[Dict[str, Any]] = None,
+    ):
+        embedding_array = np.asarray(embedding, dtype=np.float32).reshape(1, -1)
+        return self.query_batch(embedding_array, k, nprobe, ef_search, filter)[0]
+
+    def add_embeddings(
+        self,
+        embedding: np.ndarray,
+        prompt: Union[str, List[str]],
+        ids: Iterable[int],
+        metadata: Union[None, Dict[str, Any], List[Optional[Dict[str, Any]]]] = None,
+    ) -> np.ndarray:
+        """Add embeddings with one row per prompt to the shards of their ids"""
+        prompts = [prompt] if isinstance(prompt, str) else list(prompt)
+        ids = np.asarray(list(ids), dtype=np.int64)
+        assert len(ids) == len(prompts), "one id per prompt expected"
+        if metadata is None or isinstance(metadata, dict):
+            metadata = [metadata] * len(prompts)
+        shard_numbers = ids // SHARD_ID_STRIDE
+        outside = (shard_numbers < 0) | (shard_numbers >= len(self.shards))
+        if outside.any():
+            raise ValueError(
+                f"Split ids {ids[outside].tolist()} are outside the ids of the {len(self.shards)} shards, shard i has ids from i * SHARD_ID_STRIDE"
+            )
+        for i, shard in enumerate(self.shards):
+            rows = np.flatnonzero(shard_numbers == i)
+            if len(rows):
+                shard.add_embeddings(
+                    embedding[rows],
+                    [prompts[row] for row in rows],
+                    ids[rows],
+                    [metadata[row] for row in rows],
+                )
+        return ids
+
+    def delete(self, ids: Iterable[int]) -> int:
+        ids = list(ids)
+        return sum(self.map_shards(lambda shard: shard.delete(ids)))
+
+    def upsert(
+        self,
+        ids: Iterable[int],
+        embedding: np.ndarray,
+        prompt: Union[str, List[str]],
+        metadata: Union[None, Dict[str, Any], List[Optional[Dict[str, Any]]]] = None,
+    ) -> np.ndarray:
+        """Add splits, replacing the existing ones with the same ids in any
+        shard"""
+        ids = list(ids)
+        self.delete(ids)
+        return self.add_embeddings(embedding, prompt, ids, metadata)
+
+    def save_delta(self):
+        self.map_shards(lambda shard: shard.save_delta())
+
+    def compact(self):
+        self.map_shards(lambda shard: shard.compact())
+
+    def check_consistency(self):
+        self.map_shards(lambda shard: shard.check_consistency())
+
+    def close(self):
+        """Stop the threads searching the shards"""
+        self.executor.shutdown(wait=False)
+
+    def __del__(self):
+        # Set in __init__, unless it failed
+        if hasattr(self, "executor"):
+            self.close()
+
+
+def build_shard(path: str, loader: List[List[str]], first_id: int, kwargs: dict):
+    """Build a LaminiIndex and save it to path, run in a worker process by
+    ShardedLaminiIndex.build"""
+    os.makedirs(path, exist_ok=True)
+    LaminiIndex.build_index(loader, first_id=first_id, **kwargs).save_index(path)
+
+
+def write_shards(path: str, shard_paths: List[str]):
+    os.makedirs(path, exist_ok=True)
+    with open(os.path.join(path, "shards.json"), "w") as f:
+        json.dump({"shards": shard_paths}, f)
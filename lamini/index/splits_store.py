@@ -0,0 +1,98 @@
+import logging
+import os
+from typing import Iterable, Iterator, List, Optional, Union
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+
+class SplitsStore:
+    """Split texts of a LaminiIndex, stored in an offset-indexed binary file
+
+    Files in directory:
+        splits.bin: utf-8 encoded texts, one after the other
+        splits.idx: n + 1 little-endian uint64 offsets of the texts in splits.bin
+
+    Both files are memory mapped, so processes loading the same index share
+    their pages, and a text is only decoded when it is looked up. Texts added
+    after loading are kept in memory until the store is written again.
+
+    Parameters
+    ----------
+    directory: Optional[str] = None
+        Directory to load the store from, empty if None
+    """
+
+    def __init__(self, directory: Optional[str] = None):
+        self.offsets = np.zeros(1, dtype="<u8")
+        self.data = np.zeros(0, dtype=np.uint8)
+        self.appended: List[str] = []
+        if directory is not None:
+            self.load(directory)
+
+    @staticmethod
+    def exists(directory: str) -> bool:
+        return os.path.exists(os.path.join(directory, "splits.idx"))
+
+    def load(self, directory: str):
+        index_path = os.path.join(directory, "splits.idx")
+        data_path = os.path.join(directory, "splits.bin")
+        # np.memmap can't map empty files
+        if os.path.getsize(index_path) > 8:
+            self.offsets = np.memmap(index_path, dtype="<u8", mode="r")
+        if os.path.getsize(data_path) > 0:
+            self.data = np.memmap(data_path, dtype=np.uint8, mode="r")
+        if int(self.offsets[-1]) != len(self.data):
+            raise ValueError(
+                f"{data_path} has {len(self.data)} bytes, {index_path} expects {int(self.offsets[-1])}"
+            )
+        self.appended = []
+
+    @staticmethod
+    def write(directory: str, splits: Iterable[str]):
+        """Write splits to directory, replacing the files of any previous store"""
+        index_path = os.path.join(directory, "splits.idx")
+        data_path = os.path.join(directory, "splits.bin")
+        offsets = [0]
+        with open(data_path + ".tmp", "wb") as f:
+            for split in splits:
+                encoded = split.encode("utf-8")
+                f.write(encoded)
+                offsets.append(offsets[-1] + len(encoded))
+        np.asarray(offsets, dtype="<u8").tofile(index_path + ".tmp")
+        # Readers which mapped the old files keep reading them until reloaded.
+        os.replace(data_path + ".tmp", data_path)
+        os.replace(index_path + ".tmp", index_path)
+
+    def stored(self) -> int:
+        return len(self.offsets) - 1
+
+    def __len__(self) -> int:
+        return self.stored() + len(self.appended)
+
+    def get(self, i: int) -> str:
+        stored = self.stored()
+        if i < 0:
+            i += len(self)
+        if not 0 <= i < len(self):
+            raise IndexError(f"split {i} out of range")
+        if i >= stored:
+            return self.appended[i - stored]
+        start, end = int(self.offsets[i]), int(self.offsets[i + 1])
+        return self.data[start:end].tobytes().decode("utf-8")
+
+    def __getitem__(self, i: Union[int, slice]) -> Union[str, List[str]]:
+        if isinstance(i, slice):
+            return [self.get(j) for j in range(*i.indices(len(self)))]
+        return self.get(int(i))
+
+    def __iter__(self) -> Iterator[str]:
+        for i in range(len(self)):
+            yield self.get(i)
+
+    def append(self, split: str):
+        self.appended.append(split)
+
+    def extend(self, splits: Iterable[str]):
+        self.appended.extend(splits)
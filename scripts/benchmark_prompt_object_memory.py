@@ -0,0 +1,68 @@
+"""Compare the memory held by pipeline prompts with the previous PromptObject.
+
+Usage: python scripts/benchmark_prompt_object_memory.py [count]
+
+Every prompt is created the way GenerationNode.transform_prompt handles an
+input prompt whose preprocess returns a new PromptObject: the input prompt,
+its orig_prompt and the preprocessed prompt sharing that orig_prompt. Both
+sides allocate what their version of transform_prompt allocates, prompts
+without data share the default dict of the legacy PromptObject.
+"""
+
+import sys
+import tracemalloc
+
+from lamini.generation.base_prompt_object import PromptObject
+
+
+class LegacyPromptObject:
+    """PromptObject before __slots__, with an eager error list"""
+
+    def __init__(self, prompt: str, response: str = None, data: dict = {}) -> None:
+        self.prompt = prompt
+        self.response = response
+        self.error = []
+        self.data = data
+        self.orig_prompt = None
+        self.finish_reason = None
+
+
+def make_legacy(prompt: str):
+    a = LegacyPromptObject(prompt)
+    a.orig_prompt = LegacyPromptObject(prompt=a.prompt, data=a.data)
+    mod_a = LegacyPromptObject(prompt)
+    mod_a.orig_prompt = a.orig_prompt
+    return a, mod_a
+
+
+def make_compact(prompt: str):
+    a = PromptObject(prompt)
+    # Reading a.data would allocate the dict, transform_prompt doesn't.
+    a.orig_prompt = PromptObject(prompt=a.prompt, data=a._data)
+    mod_a = PromptObject(prompt)
+    mod_a.orig_prompt = a.orig_prompt
+    return a, mod_a
+
+
+def measure(make, prompts) -> int:
+    tracemalloc.start()
+    objects = [make(prompt) for prompt in prompts]
+    size, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del objects
+    return size
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 1_000_000
+    prompts = [f"prompt {i}" for i in range(count)]
+    legacy = measure(make_legacy, prompts)
+    compact = measure(make_compact, prompts)
+    print(f"{count} prompts")
+    print(f"legacy PromptObject:  {legacy / 2**20:8.1f} MiB")
+    print(f"compact PromptObject: {compact / 2**20:8.1f} MiB")
+    print(f"saved: {(legacy - compact) / 2**20:.1f} MiB ({1 - compact / legacy:.0%})")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,190 @@
+import asyncio
+import json
+import socket
+import threading
+
+import lamini
+import pytest
+from aiohttp import web
+from lamini.api.streaming_completion import StreamingCompletion
+from lamini.error.error import StreamingUnavailableError
+
+URL = "/v3/streaming_completions"
+
+
+@pytest.fixture
+def stub_server(monkeypatch):
+    """Start a stub Lamini server on a background thread, serving the given
+    {(method, path): handler} routes, and return a StreamingCompletion
+    talking to it"""
+    monkeypatch.setattr(lamini, "job_registry_path", None)
+    loop = asyncio.new_event_loop()
+    runners = []
+
+    def start(routes):
+        app = web.Application()
+        app.router.add_post(URL, submit)
+        for (method, path), handler in routes.items():
+            app.router.add_route(method, URL + "/job" + path, handler)
+        runner = web.AppRunner(app)
+        with socket.socket() as s:
+            s.bind(("127.0.0.1", 0))
+            port = s.getsockname()[1]
+
+        async def serve():
+            await runner.setup()
+            await web.TCPSite(runner, "127.0.0.1", port).start()
+
+        asyncio.run_coroutine_threadsafe(serve(), loop).result()
+        runners.append(runner)
+        return StreamingCompletion(api_key="test", api_url=f"http://127.0.0.1:{port}")
+
+    thread = threading.Thread(target=loop.run_forever, daemon=True)
+    thread.start()
+    yield start
+    for runner in runners:
+        asyncio.run_coroutine_threadsafe(runner.cleanup(), loop).result()
+    loop.call_soon_threadsafe(loop.stop)
+    thread.join()
+    loop.close()
+
+
+async def submit(request):
+    return web.json_response({"id": "job"})
+
+
+def push(content_type, lines, requests=None):
+    """Handler pushing lines, encoded as they are"""
+
+    async def handler(request):
+        if requests is not None:
+            requests.append(dict(request.query))
+        response = web.StreamResponse(headers={"Content-Type": content_type})
+        await response.prepare(request)
+        for line in lines:
+            await response.write(line.encode("utf-8"))
+        await response.write_eof()
+        return response
+
+    return handler
+
+
+def result(outputs, finish_reason, offsets=None):
+    body = {"outputs": outputs, "finish_reason": finish_reason}
+    if offsets is not None:
+        body["offsets"] = offsets
+    return body
+
+
+def event(body):
+    return "data: " + json.dumps(body) + "\n\n"
+
+
+def test_push_parses_server_sent_events(stub_server):
+    completion = stub_server(
+        {
+            ("GET", "/stream"): push(
+                "text/event-stream",
+                [
+                    ": keep-alive\n\n",
+                    event(result(["Hel"], [None])),
+                    # Data fields of one event are joined with newlines
+                    'data: {"outputs": ["Hello"],\ndata: "finish_reason": [null]}\n\n',
+                    event(result(["Hello!"], ["stop"])),
+                    "data: [DONE]\n\n",
+                ],
+            )
+        }
+    )
+
+    stream = completion.create("prompt", "model", transport="push")
+
+    assert [r["outputs"] for r in stream] == [["Hel"], ["Hello"], ["Hello!"]]
+
+
+def test_push_parses_json_lines(stub_server):
+    completion = stub_server(
+        {
+            ("GET", "/stream"): push(
+                "application/x-ndjson",
+                [
+                    json.dumps(result(["a", ""], [None, None])) + "\n",
+                    "\n",
+                    json.dumps(result(["ab", "c"], ["stop", "stop"])) + "\n",
+                ],
+            )
+        }
+    )
+
+    async def stream():
+        results = await completion.async_create("prompt", "model", transport="push")
+        return [r["outputs"] async for r in results]
+
+    assert asyncio.run(stream()) == [["a", ""], ["ab", "c"]]
+
+
+def test_incremental_stream_resumes_at_its_offsets(stub_server):
+    polls = []
+
+    async def poll(request):
+        polls.append(dict(request.query))
+        # Only the text after the requested offset is returned
+        offset = int(request.query["offsets"])
+        return web.json_response(result(["Hello world"[offset:]], ["stop"], [offset]))
+
+    completion = stub_server(
+        {
+            # The stream ends before the result is complete
+            ("GET", "/stream"): push(
+                "text/event-stream",
+                [event(result(["Hel"], [None])), event(result(["Hello"], [None]))],
+            ),
+            ("GET", "/result"): poll,
+        }
+    )
+
+    stream = completion.create(
+        "prompt", "model", polling_interval=0, transport="auto", incremental=True
+    )
+
+    deltas = [r["outputs"][0] for r in stream]
+    assert deltas == ["Hel", "lo", " world"]
+    assert polls == [{"offsets": "5"}]
+
+
+def test_auto_falls_back_to_polling(stub_server):
+    polls = []
+
+    async def not_found(request):
+        return web.json_response({"detail": "not found"}, status=404)
+
+    async def poll(request):
+        polls.append(request)
+        if len(polls) == 1:
+            return web.json_response(result(["Hi"], [None]))
+        return web.json_response(result(["Hi there"], ["stop"]))
+
+    completion = stub_server({("GET", "/stream"): not_found, ("GET", "/result"): poll})
+
+    stream = completion.create("prompt", "model", polling_interval=0, transport="auto")
+    assert [r["outputs"] for r in stream] == [["Hi"], ["Hi there"]]
+    assert stream.transport == "poll"
+
+    async def async_stream():
+        results = await completion.async_create(
+            "prompt", "model", polling_interval=0, transport="auto"
+        )
+        return [r["outputs"] async for r in results]
+
+    polls.clear()
+    assert asyncio.run(async_stream()) == [["Hi"], ["Hi there"]]
+
+
+def test_push_without_fallback_raises(stub_server):
+    completion = stub_server(
+        {("GET", "/stream"): push("application/json", ['{"detail": "no"}'])}
+    )
+
+    stream = completion.create("prompt", "model", transport="push")
+    with pytest.raises(StreamingUnavailableError):
+        next(stream)
@@ -0,0 +1,58 @@
+import asyncio
+
+from lamini.generation.base_prompt_object import PromptObject
+from lamini.generation.generation_node import GenerationNode
+from lamini.generation.hook_executor import HookExecutor
+
+
+class UpperNode(GenerationNode):
+    hook_executor_type = "thread"
+    hook_max_workers = 2
+
+    def preprocess(self, prompt):
+        return PromptObject(prompt.prompt.upper())
+
+
+async def prompts(count):
+    for i in range(count):
+        # Slow enough that map() waits on the next prompt
+        await asyncio.sleep(0.01)
+        yield PromptObject(f"p{i}")
+
+
+def test_map_closed_early_leaves_no_tasks():
+    node = UpperNode("model")
+    executor = HookExecutor(node, "thread", max_workers=2)
+
+    async def consume():
+        results = executor.map("preprocess", prompts(100))
+        a, mod_a = await results.__anext__()
+        await results.aclose()
+        return mod_a.prompt, asyncio.all_tasks() - {asyncio.current_task()}
+
+    try:
+        result, tasks = asyncio.run(consume())
+    finally:
+        executor.shutdown()
+
+    assert result == "P0"
+    assert tasks == set()
+
+
+def test_node_reuses_hook_executor():
+    node = UpperNode("model")
+
+    async def run():
+        return [
+            mod_a.prompt async for _, mod_a in node.run_hook("preprocess", prompts(3))
+        ]
+
+    try:
+        assert asyncio.run(run()) == ["P0", "P1", "P2"]
+        executor = node.hook_executor
+        node.cancel_hook_calls()
+        assert asyncio.run(run()) == ["P0", "P1", "P2"]
+        assert node.hook_executor is executor
+    finally:
+        node.shutdown_hook_executor()
+    assert node.hook_executor is None
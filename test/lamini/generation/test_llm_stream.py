@@ -0,0 +1,126 @@
+import asyncio
+import datetime
+
+import lamini
+import lamini.api.utils.reservations as reservations
+import lamini.generation.llm_stream as llm_stream
+from lamini.generation.llm_stream import LLMStream
+
+
+def make_reservation(dynamic_max_batch_sizes):
+    """Fake reservation endpoint recommending the given batch sizes in turn"""
+    requests = []
+
+    def reservation(request):
+        requests.append(request)
+        return {
+            "reservation_id": len(requests),
+            "capacity_remaining": request["capacity"],
+            "dynamic_max_batch_size": dynamic_max_batch_sizes[len(requests) - 1],
+            "start_time": datetime.datetime.utcnow().isoformat(),
+        }
+
+    return reservation, requests
+
+
+def make_stream(monkeypatch, minibatches):
+    monkeypatch.setattr(lamini, "api_key", "test")
+    monkeypatch.setattr(lamini, "batch_size", 5)
+    monkeypatch.setattr(lamini, "bypass_reservation", False)
+    monkeypatch.setattr(lamini, "static_batching", False)
+    stream = LLMStream(api_url="http://localhost", max_in_flight=2)
+
+    def submit_minibatch(minibatch, *args):
+        minibatches.append(minibatch)
+        return minibatch
+
+    def get_minibatch_result_stream(minibatch):
+        for prompt in minibatch:
+            yield {"output": prompt + "!", "finish_reason": "stop"}
+
+    async def async_submit_minibatch(client, minibatch, *args):
+        return submit_minibatch(minibatch)
+
+    async def async_get_minibatch_result_stream(client, minibatch):
+        for result in get_minibatch_result_stream(minibatch):
+            yield result
+
+    stream.submit_minibatch = submit_minibatch
+    stream.get_minibatch_result_stream = get_minibatch_result_stream
+    stream.async_submit_minibatch = async_submit_minibatch
+    stream.async_get_minibatch_result_stream = async_get_minibatch_result_stream
+    return stream
+
+
+def test_minibatch_size_follows_reservation(monkeypatch):
+    reservation, requests = make_reservation([3, 2, 4])
+    monkeypatch.setattr(
+        reservations,
+        "make_web_request",
+        lambda key, url, method, json: reservation(json),
+    )
+    minibatches = []
+    stream = make_stream(monkeypatch, minibatches)
+
+    prompts = [f"p{i}" for i in range(7)]
+    results = list(stream.generate(prompts, "model"))
+
+    assert [len(minibatch) for minibatch in minibatches] == [3, 2, 2]
+    assert [result["output"] for result in results] == [p + "!" for p in prompts]
+    # One reservation per minibatch, none past the last prompt
+    assert len(requests) == 3
+
+
+def test_async_minibatch_size_follows_reservation(monkeypatch):
+    reservation, requests = make_reservation([4, 1, 5])
+
+    async def make_async_web_request(client, key, url, method, json):
+        return reservation(json)
+
+    monkeypatch.setattr(reservations, "make_async_web_request", make_async_web_request)
+    minibatches = []
+    stream = make_stream(monkeypatch, minibatches)
+
+    async def prompts():
+        for i in range(8):
+            yield f"p{i}"
+
+    async def generate():
+        return [result async for result in stream.async_generate(prompts(), "model")]
+
+    results = asyncio.run(generate())
+
+    assert [len(minibatch) for minibatch in minibatches] == [4, 1, 3]
+    assert [result["output"] for result in results] == [f"p{i}!" for i in range(8)]
+    assert len(requests) == 3
+
+
+def test_minibatch_size_without_reservation(monkeypatch):
+    minibatches = []
+    stream = make_stream(monkeypatch, minibatches)
+    monkeypatch.setattr(lamini, "bypass_reservation", True)
+
+    list(stream.generate([f"p{i}" for i in range(12)], "model"))
+
+    assert [len(minibatch) for minibatch in minibatches] == [5, 5, 2]
+
+
+def test_errors_are_counted_per_minibatch(monkeypatch):
+    monkeypatch.setattr(lamini, "api_key", "test")
+    monkeypatch.setattr(llm_stream, "finish_job", lambda id: None)
+    polls = []
+
+    def make_web_request(key, url, method, json=None):
+        polls.append(url)
+        # The first poll of every minibatch fails
+        if url not in polls[:-1]:
+            raise ValueError("flaky")
+        return {"outputs": ["done"], "finish_reason": ["stop"]}
+
+    monkeypatch.setattr(llm_stream, "make_web_request", make_web_request)
+    stream = LLMStream(api_url="http://localhost")
+    stream.polling_interval = 0
+
+    for id in range(stream.max_errors + 2):
+        results = list(stream.get_minibatch_result_stream(str(id)))
+        assert [result["output"] for result in results] == ["done"]
@@ -0,0 +1,48 @@
+import asyncio
+
+from lamini.generation.base_prompt_object import PromptObject
+from lamini.generation.reorder_buffer import ReorderBuffer, release_sequence
+
+
+def admit(buffer, n):
+    prompts = [PromptObject(str(i)) for i in range(n)]
+    for index, prompt in enumerate(prompts):
+        buffer.admit(prompt, index)
+    return prompts
+
+
+def test_late_result_keeps_order():
+    buffer = ReorderBuffer(window=2)
+    prompts = admit(buffer, 4)
+
+    emitted = []
+    for prompt in prompts[1:]:
+        emitted.extend(buffer.push(prompt))
+    assert emitted == []
+
+    emitted.extend(buffer.push(prompts[0]))
+    assert [p.prompt for p in emitted] == ["0", "1", "2", "3"]
+
+
+def test_released_input_is_passed_over():
+    buffer = ReorderBuffer(window=2)
+    prompts = admit(buffer, 3)
+
+    assert list(buffer.push(prompts[1])) == []
+    release_sequence(prompts[0])
+    assert [p.prompt for p in buffer.push(prompts[2])] == ["1", "2"]
+
+
+def test_wait_for_room():
+    async def run():
+        buffer = ReorderBuffer(window=2)
+        prompts = admit(buffer, 2)
+        assert not buffer.has_room(2)
+        waiter = asyncio.create_task(buffer.wait_for_room(2))
+        await asyncio.sleep(0.01)
+        assert not waiter.done()
+        list(buffer.push(prompts[0]))
+        await asyncio.wait_for(waiter, timeout=1)
+        assert buffer.has_room(2)
+
+    asyncio.run(run())